@@ -0,0 +1,79 @@
+'''
+Counts of how often each cached report is viewed.
+
+The views are counted in memory, and added to the DataCacheAccess table in
+batches - when FLUSH_SIZE views have been counted, or the flush interval has
+passed since the last time - so that viewing a report doesn't cost a write to
+the database. 'paster report-cache generate' uses the counts to regenerate the
+most viewed report/options first (see ReportRegistry._run_items).
+
+Counts not yet written when the process is killed are lost, which is fine for
+the purpose.
+'''
+
+import atexit
+import datetime
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Number of views counted that trigger them to be written
+FLUSH_SIZE = 1000
+
+# key: [num_views, last_viewed] of views not yet written
+_views = {}
+_num_views = [0]
+_last_flush = [time.time()]
+_views_lock = threading.Lock()
+
+
+def flush_interval():
+    '''Returns how many seconds views are counted in memory for, before they
+    are written to the database. Config option:
+
+      ckanext-report.access_flush_interval = 60
+    '''
+    from pylons import config
+    return float(config.get('ckanext-report.access_flush_interval', 60))
+
+
+def record_view(key):
+    '''Counts a view of the report with the given DataCache key. Every so
+    often the counts are written to the database.'''
+    now = datetime.datetime.now()
+    with _views_lock:
+        view = _views.setdefault(key, [0, now])
+        view[0] += 1
+        view[1] = now
+        _num_views[0] += 1
+        due = _num_views[0] >= FLUSH_SIZE or \
+            time.time() - _last_flush[0] >= flush_interval()
+    if due:
+        flush()
+
+
+def flush():
+    '''Writes the views counted so far to the database. Errors are logged
+    rather than raised, as they should not stop a report being viewed.'''
+    from ckan import model
+    from ckanext.report import model as report_model
+    with _views_lock:
+        items = [(key, num_views, last_viewed)
+                 for key, (num_views, last_viewed) in _views.items()]
+        _views.clear()
+        _num_views[0] = 0
+        _last_flush[0] = time.time()
+    if not items:
+        return
+    try:
+        with model.meta.engine.begin() as conn:
+            report_model.DataCacheAccess.add_views(conn, items)
+    except Exception:
+        log.exception('Could not save the views of %s reports', len(items))
+        return
+    log.debug('Saved the views of %s reports', len(items))
+
+
+atexit.register(flush)
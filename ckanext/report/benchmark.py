@@ -0,0 +1,446 @@
+'''
+Benchmarks of the reports against synthetic catalogs.
+
+A catalog of organizations, datasets, resources and TaskStatuses (as written
+by ckanext-archiver and ckanext-qa) is built in a separate database, at each
+of the sizes requested (the number of resources), and then each of these is
+measured:
+
+  * generating the broken-links report - for an organization, the index of
+    organizations, in bulk, and refreshing all of its options into the cache
+  * generating the tagless-datasets report
+  * fetching and decoding the largest cached report from the DataCache
+  * exporting it as CSV and JSON
+  * decoding a large report with the legacy and typed JSON decoders
+
+and the query plan of the broken-links query is checked for the use of the
+partial index on task_status.
+
+Each measurement runs in a fresh process, so that its peak memory can be
+recorded, and the results (timings, SQL query counts and memory) are
+output as JSON, to be compared between builds:
+
+  $ paster report-cache benchmark --db-url postgresql://u:p@localhost/bench \\
+        --sizes 1000,10000,100000 -c development.ini
+
+The benchmark database is emptied and rebuilt, so it must not be the CKAN
+database. To guard against that, it must have no datasets in it to start
+with (unless force is given), and it is emptied again at the end.
+'''
+
+import datetime
+import logging
+import multiprocessing
+import random
+import resource
+import time
+import uuid
+
+from ckan.lib.helpers import OrderedDict
+from ckanext.report import stats
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+RESOURCES_PER_PACKAGE = 5
+PACKAGES_PER_ORGANIZATION = 100
+# Fraction of resources that are broken (404 or 500)
+BROKEN_FRACTION = 0.1
+# Fraction of datasets without tags
+TAGLESS_FRACTION = 0.2
+# Number of rows in the report used to compare the JSON decoders
+DECODER_ROWS = 50000
+# Rows inserted at a time when building a catalog
+INSERT_BATCH_SIZE = 10000
+
+
+def run(db_url, sizes=DEFAULT_SIZES, seed=0, force=False):
+    '''Builds a catalog of each size (number of resources) in the database at
+    db_url and benchmarks the reports against it. Returns the results, for
+    dumping as JSON.
+
+    Raises ValueError if the database has datasets in it, unless force is
+    given, as it is emptied.'''
+    import sqlalchemy
+    from pylons import config
+    from ckan import model
+    if db_url == config.get('sqlalchemy.url'):
+        raise ValueError('The benchmark database must not be the CKAN '
+                         'database - it is emptied')
+    engine = sqlalchemy.create_engine(db_url)
+    if not force and _has_datasets(engine):
+        engine.dispose()
+        raise ValueError('The benchmark database has datasets in it, and it '
+                         'would be emptied. If it really is only for '
+                         'benchmarks, give --force')
+    _use_database(engine)
+    try:
+        results = _run(sizes, seed)
+    finally:
+        _empty_database()
+
+    return OrderedDict((
+        ('generated_at', datetime.datetime.now()),
+        ('database', model.meta.engine.dialect.name),
+        ('parameters', OrderedDict((
+            ('sizes', list(sizes)),
+            ('resources_per_package', RESOURCES_PER_PACKAGE),
+            ('packages_per_organization', PACKAGES_PER_ORGANIZATION),
+            ('broken_fraction', BROKEN_FRACTION),
+            ('tagless_fraction', TAGLESS_FRACTION),
+            ('seed', seed),
+            ))),
+        ('results', results),
+        ))
+
+
+def _run(sizes, seed):
+    results = []
+    for size in sizes:
+        log.info('Building a catalog of %s resources', size)
+        catalog = build_catalog(size, seed=seed)
+        result = OrderedDict((('benchmark', 'broken-links-explain'),
+                              ('size', size)))
+        result.update(explain_broken_links(catalog['largest_organization']))
+        results.append(result)
+        for name, func, args in _benchmarks(catalog):
+            log.info('Benchmark: %s (%s resources)', name, size)
+            result = OrderedDict((('benchmark', name), ('size', size)))
+            result.update(measure_in_subprocess(func, *args))
+            results.append(result)
+
+    results.append(OrderedDict((('benchmark', 'decode-legacy'),
+                                ('size', DECODER_ROWS))))
+    results[-1].update(measure_in_subprocess(_decode, 'legacy', DECODER_ROWS))
+    results.append(OrderedDict((('benchmark', 'decode-typed'),
+                                ('size', DECODER_ROWS))))
+    results[-1].update(measure_in_subprocess(_decode, 'typed', DECODER_ROWS))
+    return results
+
+
+def _benchmarks(catalog):
+    '''Returns (name, func, args) of the benchmarks to run against a
+    catalog.'''
+    org = catalog['largest_organization']
+    return [
+        ('broken-links-organization', _broken_links, (org,)),
+        ('broken-links-index', _broken_links, (None,)),
+        ('broken-links-bulk', _broken_links_bulk, ()),
+        ('broken-links-refresh-all', _refresh_all, ('broken-links',)),
+        ('tagless-organization', _tagless, (org,)),
+        ('tagless-index', _tagless, (None,)),
+        ('tagless-refresh-all', _refresh_all, ('tagless-datasets',)),
+        ('cache-get', _cache_get, ('broken-links', org)),
+        ('export-csv', _export, ('broken-links', org, 'csv')),
+        ('export-json', _export, ('broken-links', org, 'json')),
+        ]
+
+
+def _has_datasets(engine):
+    '''Returns whether the database has a package table with rows in it.'''
+    from sqlalchemy import select
+    from ckan import model
+    with engine.connect() as conn:
+        if not engine.dialect.has_table(conn, 'package'):
+            return False
+        return conn.execute(
+            select([model.package_table.c.id]).limit(1)).first() is not None
+
+
+def _use_database(engine):
+    '''Points CKAN's model at the benchmark database.'''
+    from ckan import model
+    model.init_model(engine)
+
+
+def _empty_database():
+    '''Drops the tables of the catalog built in the benchmark database.'''
+    from ckan import model
+    from ckanext.report import model as report_model
+    model.Session.remove()
+    report_model.metadata.drop_all(model.meta.engine)
+    model.meta.metadata.drop_all(model.meta.engine)
+
+
+def build_catalog(num_resources, seed=0):
+    '''Empties the database and fills it with a catalog with the given number
+    of resources. Returns a dict describing it.'''
+    from ckan import model
+    from ckanext.report import model as report_model
+    rand = random.Random(seed)
+    engine = model.meta.engine
+    _empty_database()
+    model.meta.metadata.create_all(engine)
+    report_model.init_tables()
+
+    num_packages = max(num_resources // RESOURCES_PER_PACKAGE, 1)
+    num_organizations = max(num_packages // PACKAGES_PER_ORGANIZATION, 1)
+    now = datetime.datetime.now()
+
+    org_ids = [_id() for i in xrange(num_organizations)]
+    _insert(model.group_table, (
+        {'id': id_, 'name': 'org-%s' % i, 'title': 'Organization %s' % i,
+         'type': 'organization', 'is_organization': True, 'state': 'active',
+         'approval_status': 'approved', 'created': now}
+        for i, id_ in enumerate(org_ids)))
+
+    tag_id = _id()
+    _insert(model.tag_table, [{'id': tag_id, 'name': 'benchmark'}])
+
+    def packages():
+        for i in xrange(num_packages):
+            yield {'id': _id(), 'name': 'dataset-%s' % i,
+                   'title': 'Dataset %s' % i, 'type': 'dataset',
+                   'owner_org': org_ids[i % num_organizations],
+                   'state': 'active', 'private': False,
+                   'metadata_created': now, 'metadata_modified': now}
+    package_ids = []
+    package_tags = []
+    for batch in _batches(packages(), INSERT_BATCH_SIZE):
+        engine.execute(model.package_table.insert(), batch)
+        for package in batch:
+            package_ids.append(package['id'])
+            if rand.random() >= TAGLESS_FRACTION:
+                package_tags.append({'id': _id(), 'package_id': package['id'],
+                                     'tag_id': tag_id, 'state': 'active'})
+    _insert(model.package_tag_table, package_tags)
+
+    def resources():
+        for i in xrange(num_resources):
+            yield {'id': _id(),
+                   'package_id': package_ids[i % num_packages],
+                   'url': 'http://example.com/data/%s.csv' % i,
+                   'position': i // num_packages, 'state': 'active',
+                   'created': now}
+
+    def task_statuses(resource_id):
+        broken = rand.random() < BROKEN_FRACTION
+        values = {'error_code': rand.choice(('404', '500')) if broken
+                                else '200'}
+        if broken:
+            values['openness_score_reason'] = 'URL unobtainable'
+            values['openness_score_failure_count'] = \
+                str(rand.randint(1, 10))
+        for key, value in values.items():
+            yield {'id': _id(), 'entity_id': resource_id,
+                   'entity_type': 'resource', 'task_type': 'qa',
+                   'key': key, 'value': value, 'state': 'done',
+                   'error': '', 'last_updated': now}
+
+    num_broken = 0
+    for batch in _batches(resources(), INSERT_BATCH_SIZE):
+        engine.execute(model.resource_table.insert(), batch)
+        statuses = [status for res in batch
+                    for status in task_statuses(res['id'])]
+        num_broken += sum(1 for status in statuses
+                          if status['key'] == 'openness_score_reason')
+        _insert(model.task_status_table, statuses)
+
+    return {'num_resources': num_resources,
+            'num_packages': num_packages,
+            'num_organizations': num_organizations,
+            'num_broken_resources': num_broken,
+            # they are all the same size, give or take one
+            'largest_organization': 'org-0'}
+
+
+def explain_broken_links(organization):
+    '''Returns the query plan of the broken-links query for an organization
+    and whether it uses the partial index of broken links on task_status
+    (model.BROKEN_LINKS_INDEX). Only PostgreSQL and SQLite are
+    supported. (Whether the planner can use the index at all is tested in
+    tests/test_reports.py - here it is whether it chooses to.)'''
+    from ckan import model
+    from ckanext.report import model as report_model
+    from ckanext.report import reports
+    engine = model.meta.engine
+    dialect = engine.dialect
+    q = reports._broken_resources_query() \
+        .filter(model.Group.name == organization)
+    compiled = q.statement.compile(dialect=dialect)
+    with engine.connect() as conn:
+        if dialect.name == 'postgresql':
+            conn.execute('ANALYZE')
+            plan = conn.execute('EXPLAIN ' + unicode(compiled),
+                                compiled.params)
+        elif dialect.name == 'sqlite':
+            conn.execute('ANALYZE')
+            plan = conn.execute('EXPLAIN QUERY PLAN ' + unicode(compiled),
+                                [compiled.params[name]
+                                 for name in compiled.positiontup])
+        else:
+            return {'plan': None, 'uses_index': None}
+        plan = '\n'.join(' '.join(unicode(value) for value in row)
+                         for row in plan)
+    return OrderedDict((('uses_index', report_model.BROKEN_LINKS_INDEX in plan),
+                        ('plan', plan)))
+
+
+def _insert(table, rows):
+    from ckan import model
+    for batch in _batches(rows, INSERT_BATCH_SIZE):
+        model.meta.engine.execute(table.insert(), batch)
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _id():
+    return unicode(uuid.uuid4())
+
+
+def measure_in_subprocess(func, *args):
+    '''Runs func(*args) in a new process and returns its measurements: wall
+    and CPU time, SQL queries run, the process's peak memory and how much it
+    grew by during the run (in KB, from ru_maxrss), plus anything that func
+    returns (a dict).'''
+    from ckan import model
+    from ckanext.report.report_registry import _init_worker
+    # the worker is forked, so make sure it doesn't share connections
+    model.Session.remove()
+    model.meta.engine.dispose()
+    pool = multiprocessing.Pool(1, initializer=_init_worker)
+    try:
+        return pool.apply(_measure, (func,) + args)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _measure(func, *args):
+    from ckan import model
+    memory_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with stats.measure() as measurement:
+        extra = func(*args)
+    memory_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    model.Session.remove()
+    result = OrderedDict((
+        ('wall_time', round(measurement.wall_time, 4)),
+        ('cpu_time', round(measurement.cpu_time, 4)),
+        ('num_queries', measurement.num_queries),
+        ('peak_memory_kb', memory_after),
+        ('memory_growth_kb', memory_after - memory_before),
+        ))
+    result.update(extra or {})
+    return result
+
+
+def _report(report_name):
+    from ckanext.report import reports
+    from ckanext.report.report_registry import Report
+    info = {'broken-links': reports.broken_link_info,
+            'tagless-datasets': reports.tagless_report_info}[report_name]
+    return Report(dict(info), 'benchmark')
+
+
+# The benchmarks - each runs in its own process and returns a dict of extra
+# results
+
+def _broken_links(organization):
+    from ckanext.report import reports, table
+    data = reports.broken_link_report(organization)
+    return {'rows': table.num_rows(data)}
+
+
+def _broken_links_bulk():
+    from ckanext.report import reports, table
+    num_reports = 0
+    rows = 0
+    for option_dict, data in reports.broken_link_report_bulk():
+        num_reports += 1
+        rows += table.num_rows(data)
+    return {'reports': num_reports, 'rows': rows}
+
+
+def _tagless(organization):
+    from ckanext.report import reports, table
+    data = reports.tagless_report(organization)
+    return {'rows': table.num_rows(data)}
+
+
+def _refresh_all(report_name):
+    report = _report(report_name)
+    report.refresh_cache_for_all_options()
+    return {'reports': len(report.get_option_combinations())}
+
+
+def _cache_get(report_name, organization):
+    '''Fetches and decodes a cached report, then fetches it again, which is
+    served by the memory cache if it is enabled.'''
+    from ckanext.report import table
+    report = _report(report_name)
+    options = {'organization': organization,
+               'include_sub_organizations': False}
+    _ensure_cached(report, options)
+    start = time.time()
+    data, date = report.get_fresh_report(**options)
+    first = time.time() - start
+    start = time.time()
+    report.get_fresh_report(**options)
+    second = time.time() - start
+    return {'rows': table.num_rows(data), 'first_get_time': round(first, 4),
+            'second_get_time': round(second, 4)}
+
+
+def _export(report_name, organization, format):
+    '''Streams a cached report as CSV or JSON, as the controller does.'''
+    from ckanext.report import table
+    from ckanext.report.controllers import iter_csv, iter_json
+    report = _report(report_name)
+    options = {'organization': organization,
+               'include_sub_organizations': False}
+    _ensure_cached(report, options)
+    data, date = report.get_fresh_report(**options)
+    columns, rows = table.columns_and_rows(table.records(data)[0])
+    if format == 'csv':
+        chunks = iter_csv(columns, rows)
+    else:
+        chunks = iter_json(columns, rows, generated_at=date)
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+    return {'rows': len(rows), 'bytes': size}
+
+
+def _ensure_cached(report, options):
+    from ckanext.report import model as report_model
+    from ckanext.report.report_registry import extract_entity_name
+    data, date = report_model.DataCache.get_if_fresh(
+        extract_entity_name(options), report.generate_key(options))
+    if data is None:
+        report.refresh_cache(options)
+
+
+def _decode(decoder, num_rows):
+    '''Decodes a broken-links-like report of num_rows rows, stored in the
+    legacy (plain JSON) or typed format.'''
+    import json
+    from ckanext.report import model as report_model
+    from ckanext.report.json import DateTimeJsonEncoder, DateTimeJsonDecoder
+    now = datetime.datetime.now()
+    data = {'table': [
+        OrderedDict((('dataset_name', 'dataset-%s' % i),
+                     ('dataset_title', 'Dataset %s' % i),
+                     ('resource_url', 'http://example.com/%s.csv' % i),
+                     ('reason', 'URL unobtainable'),
+                     ('failure_count', i % 10),
+                     ('last_checked', now)))
+        for i in xrange(num_rows)]}
+    if decoder == 'legacy':
+        value = json.dumps(data, cls=DateTimeJsonEncoder)
+        start = time.time()
+        json.loads(value, cls=DateTimeJsonDecoder)
+    else:
+        value = report_model.encode_json(data)
+        start = time.time()
+        report_model.decode_json(value)
+    return {'decode_time': round(time.time() - start, 4),
+            'bytes': len(value)}
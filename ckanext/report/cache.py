@@ -0,0 +1,99 @@
+'''
+In-process cache of values decoded from the DataCache.
+
+Decoding a big report from JSON takes much longer than fetching it, and the
+cached value only changes when the report is regenerated, so each process
+keeps the most recently used decoded values in memory. An entry is only used
+if its created date matches the one in the database, so a report regenerated
+by another process (e.g. the nightly cron) is picked up straight away.
+
+Config options:
+
+  ckanext-report.memory_cache = true
+  ckanext-report.memory_cache.max_entries = 100
+  ckanext-report.memory_cache.max_bytes = 50000000
+
+max_bytes is measured on the stored (JSON) size of the values.
+
+Values are shared between requests, so callers must not modify them.
+'''
+
+import collections
+import logging
+import threading
+
+import ckan.plugins as p
+
+log = logging.getLogger(__name__)
+
+_decoded_values = None
+
+
+class LRUCache(object):
+    '''A thread-safe, least-recently-used cache of values, keyed by
+    (object_id, key) and stamped with their created date. It is bounded by the
+    number of entries and by the total of their sizes.'''
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # (object_id, key): (created, value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, object_id, key, created):
+        '''Returns the value, or None if it is not cached with that created
+        date.'''
+        with self._lock:
+            entry = self._entries.pop((object_id, key), None)
+            if entry is None:
+                return None
+            if entry[0] != created:
+                # out of date
+                self._bytes -= entry[2]
+                return None
+            # move it to the most recently used end
+            self._entries[(object_id, key)] = entry
+            return entry[1]
+
+    def set(self, object_id, key, created, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old_entry = self._entries.pop((object_id, key), None)
+            if old_entry:
+                self._bytes -= old_entry[2]
+            self._entries[(object_id, key)] = (created, value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or \
+                    self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def invalidate(self, object_id, key):
+        with self._lock:
+            entry = self._entries.pop((object_id, key), None)
+            if entry:
+                self._bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+def decoded_values():
+    '''Returns the cache of decoded DataCache values for this process, or
+    None if it is disabled in the config.'''
+    global _decoded_values
+    if _decoded_values is None:
+        from pylons import config
+        if not p.toolkit.asbool(
+                config.get('ckanext-report.memory_cache', True)):
+            _decoded_values = False
+        else:
+            _decoded_values = LRUCache(
+                max_entries=int(config.get(
+                    'ckanext-report.memory_cache.max_entries', 100)),
+                max_bytes=int(config.get(
+                    'ckanext-report.memory_cache.max_bytes', 50000000)))
+    return _decoded_values or None
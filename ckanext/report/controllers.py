@@ -1,21 +1,29 @@
 import datetime
-from ckan.lib.helpers import json as j1
 import ckan.plugins.toolkit as t
 import ckanext.report.helpers as dguhelpers
 from ckanext.report.report_registry import ReportRegistry
 from ckan.lib.render import TemplateNotFound
 from ckanext.report.json import DateTimeJsonEncoder
-#from ckan.common import OrderedDict
-from ckan.lib.helpers import OrderedDict
+from ckanext.report import table
+from ckanext.report import access
 
 c = t.c
 
+# Number of rows written at a time when streaming a CSV or JSON export
+EXPORT_CHUNK_SIZE = 1000
+
+# Request params for paging, sorting and filtering the table on the web page
+TABLE_PARAMS = ('page', 'per_page', 'sort', 'q')
+DEFAULT_PER_PAGE = 100
+MAX_PER_PAGE = 1000
+
 
 class ReportController(t.BaseController):
 
     def index(self):
         registry = ReportRegistry.instance()
         c.reports = registry.get_reports()
+        c.report_metadata = registry.get_metadata()
         return t.render('report/index.html')
 
     def view(self, report_name, organization=None, refresh=False):
@@ -45,6 +53,9 @@ class ReportController(t.BaseController):
             format = c.options.pop('format')
         else:
             format = None
+        # paging, sorting and filtering of the table are not report options
+        table_params = dict((key, c.options.pop(key))
+                            for key in TABLE_PARAMS if key in c.options)
         if 'organization' in report.option_defaults:
             c.options['organization'] = organization
             c.offer_organization_index = \
@@ -79,45 +90,39 @@ class ReportController(t.BaseController):
                 t.abort(400, 'Option not allowed by report: %s' % key)
 
         try:
-            c.data, c.report_date = report.get_fresh_report(**c.options)
+            c.data, c.report_date, c.report_refreshing = \
+                report.get_fresh_or_stale_report(**c.options)
         except t.ObjectNotFound:
             t.abort(404)
+        access.record_view(report.generate_key(c.options))
 
         if format and format != 'html':
-            
-            ensure_data_is_dicts(c.data)
-            anonymise_user_names(c.data, organization=c.options.get('organization'))
-            
-            sorted_list = []
-            for data in c.data:
-              for row in data['table']: 
-                 temp = OrderedDict()              
-                 for k, v in sorted(row.items(), key=lambda x: data['order'].get(x[0])):
-                   temp.update({k:v})
-                 sorted_list.append(temp)  
-            
-              data['table'] = sorted_list
-              
+            # export the (first) table straight from its columnar form,
+            # streamed in chunks, so that no copy of the whole table is made
+            record = table.records(c.data)[0] if c.data else {}
+            columns, rows = table.columns_and_rows(record)
+            rows = anonymise_user_names(columns, rows,
+                                        organization=c.options.get('organization'))
+
             if format == 'csv':
                 filename = 'report_%s.csv' % report.generate_key(c.options).replace('?', '_')
                 t.response.headers['Content-Type'] = 'application/csv'
-                t.response.headers['Content-Disposition'] = str('attachment; filename=%s' % (filename))        
-                for data in c.data:     
-                  return make_csv_from_dicts(data['table'])
+                t.response.headers['Content-Disposition'] = str('attachment; filename=%s' % (filename))
+                return iter_csv(columns, rows)
             elif format == 'json':
                 filename = 'report_%s.json' % report.generate_key(c.options).replace('?', '_')
                 t.response.headers['Content-Type'] = 'application/json'
                 t.response.headers['Content-Disposition'] = str('attachment; filename=%s' % (filename))
-                result = OrderedDict()
-                result['generated_at'] = c.report_date
-                for data in c.data:
-                  result['table'] = data['table']
-                return j1.dumps(result, cls=DateTimeJsonEncoder)
+                return iter_json(columns, rows, generated_at=c.report_date)
             else:
                 t.abort(400, 'Format not known - try html, json or csv')
 
         c.are_some_results = bool(c.data['table'] if 'table' in c.data
                                   else c.data)
+        if report.paged:
+            c.data, c.pagination = paginate_tables(c.data, **table_params)
+        else:
+            c.pagination = None
         if c.are_some_results:
             # you can't pass args into genshi template, so it will just look
             # for c.data
@@ -125,7 +130,65 @@ class ReportController(t.BaseController):
         return t.render('report/view.html')
 
 
+def paginate_tables(data, page=1, per_page=DEFAULT_PER_PAGE, sort=None,
+                    q=None):
+    '''Returns the report data with just a page of each table, after
+    filtering and sorting, plus a dict describing the pagination of the
+    (first) table, or None if there is no table.
+
+    sort is a column name, prefixed with '-' for descending order. q filters
+    the rows to those with a value containing it.
+
+    Only tables in columnar form (see ckanext.report.table) are paged. Ones
+    cached before that are left whole, until they are regenerated.
+    '''
+    try:
+        page = max(int(page), 1)
+        per_page = min(max(int(per_page), 1), MAX_PER_PAGE)
+    except ValueError:
+        t.abort(400, 'page and per_page must be integers')
+    descending = bool(sort) and sort.startswith('-')
+    sort_column = sort[1:] if descending else sort
+
+    pagination = None
+    paged_records = []
+    for record in table.records(data):
+        if isinstance(record, dict) and \
+                isinstance(record.get('table'), table.Table):
+            # a copy, as the data may be shared by the memory cache
+            record = record.copy()
+            record['table'], total = record['table'].page(
+                page=page, per_page=per_page, sort=sort_column,
+                descending=descending, q=q)
+            if pagination is None:
+                pagination = {'page': page, 'per_page': per_page,
+                              'total': total,
+                              'num_pages': max(
+                                  (total + per_page - 1) // per_page, 1),
+                              'sort': sort, 'q': q}
+        paged_records.append(record)
+    if isinstance(data, dict):
+        return paged_records[0], pagination
+    return paged_records, pagination
+
+
 def make_csv_from_dicts(rows):
+    # extract the headers by looking at all the rows and
+    # get a full list of the keys, retaining their ordering
+    headers_ordered = table.column_names(rows)
+    return make_csv(headers_ordered,
+                    ([row.get(header, table.MISSING) for header in headers_ordered]
+                     for row in rows))
+
+
+def make_csv(columns, rows):
+    '''Returns CSV of the given column names and rows of values.'''
+    return ''.join(iter_csv(columns, rows))
+
+
+def iter_csv(columns, rows, chunk_size=EXPORT_CHUNK_SIZE):
+    '''Yields CSV of the given column names and rows of values, in chunks of
+    chunk_size rows.'''
     import csv
     import cStringIO as StringIO
 
@@ -135,22 +198,13 @@ def make_csv_from_dicts(rows):
         dialect='excel',
         quoting=csv.QUOTE_NONNUMERIC
     )
-    # extract the headers by looking at all the rows and
-    # get a full list of the keys, retaining their ordering
-    headers_ordered = []
-    headers_set = set()
-    for row in rows:
-        new_headers = set(row.keys()) - headers_set
-        headers_set |= new_headers
-        for header in row.keys():
-            if header in new_headers:
-                headers_ordered.append(header)
-    csvwriter.writerow(headers_ordered)
-    for row in rows:
+    csvwriter.writerow(columns)
+    for i, row in enumerate(rows):
         items = []
-        for header in headers_ordered:
-            item = row.get(header, 'no record')
-            if isinstance(item, datetime.datetime):
+        for item in row:
+            if item is table.MISSING:
+                item = 'no record'
+            elif isinstance(item, datetime.datetime):
                 item = item.strftime('%Y-%m-%d %H:%M')
             elif isinstance(item, (int, long, float, list, tuple)):
                 item = unicode(item)
@@ -163,30 +217,59 @@ def make_csv_from_dicts(rows):
             csvwriter.writerow(items)
         except Exception, e:
             raise Exception("%s: %s, %s" % (e, row, items))
-    csvout.seek(0)
-    return csvout.read()
+        if (i + 1) % chunk_size == 0:
+            yield csvout.getvalue()
+            csvout.seek(0)
+            csvout.truncate()
+    yield csvout.getvalue()
 
 
-def ensure_data_is_dicts(dataDict):
-    '''Ensure that the data is a list of dicts, rather than a list of tuples
-    with column names, as sometimes is the case. Changes it in place'''
-    for data in dataDict:       
-      if data['table'] and isinstance(data['table'][0], (list, tuple)):
-        new_data = []
-        columns = data['columns']
-        for row in data['table']:
-            new_data.append(OrderedDict(zip(columns, row)))
-        data['table'] = new_data
-        del data['columns']
+def iter_json(columns, rows, generated_at, chunk_size=EXPORT_CHUNK_SIZE):
+    '''Yields JSON of the given column names and rows of values, in chunks of
+    chunk_size rows. It is the same as dumping:
+    {"generated_at": generated_at, "table": [{column: value, ...}, ...]}'''
+    encoder = DateTimeJsonEncoder()
+    encoded_columns = [encoder.encode(column) for column in columns]
+    yield '{"generated_at": %s, "table": [' % encoder.encode(generated_at)
+    chunk = []
+    for i, row in enumerate(rows):
+        chunk.append('{%s}' % ', '.join(
+            '%s: %s' % (column, encoder.encode(value))
+            for column, value in zip(encoded_columns, row)
+            if value is not table.MISSING))
+        if (i + 1) % chunk_size == 0:
+            yield (', ' if i + 1 > chunk_size else '') + ', '.join(chunk)
+            chunk = []
+    if chunk:
+        yield (', ' if i + 1 > len(chunk) else '') + ', '.join(chunk)
+    yield ']}'
 
 
-def anonymise_user_names(dataDict, organization=None):
+def anonymise_user_names(columns, rows, organization=None):
     '''Ensure any columns with names in are anonymised, unless the current user
-    has privileges.'''
-    for data in dataDict:
-      column_names = data['table'][0].keys() if data['table'] else []
-      for col in column_names:
-        if col.lower() in ('user', 'username', 'user name', 'author'):
-            for row in data['table']:
-                row[col] = dguhelpers.user_link_info(row[col],
-                              organisation=organization)[0]
+    has privileges. Returns the rows, or if they need changing, a generator of
+    anonymised copies of them.
+
+    The names are looked up straight away, rather than as the rows are
+    generated, because the export is streamed after the request's database
+    session has been removed.'''
+    user_columns = [i for i, col in enumerate(columns)
+                    if col.lower() in ('user', 'username', 'user name', 'author')]
+    if not user_columns:
+        return rows
+    user_names = set(row[i] for row in rows for i in user_columns
+                     if row[i] is not table.MISSING)
+    display_names = dict(
+        (user_name, dguhelpers.user_link_info(user_name,
+                                              organisation=organization)[0])
+        for user_name in user_names)
+    return _anonymise_rows(rows, user_columns, display_names)
+
+
+def _anonymise_rows(rows, user_columns, display_names):
+    for row in rows:
+        row = list(row)
+        for i in user_columns:
+            if row[i] is not table.MISSING:
+                row[i] = display_names[row[i]]
+        yield row
@@ -19,6 +19,24 @@ def relative_url_for(**kwargs):
             del args[k]
     return p.toolkit.url_for(**args)
 
+def sort_url(column):
+    '''Returns the existing URL but sorted by the given column of the report
+    table - or in descending order if it is already sorted by it.'''
+    if p.toolkit.request.params.get('sort') == column:
+        column = '-' + column
+    return relative_url_for(sort=column, page=None)
+
+
+def sort_class(column):
+    '''Returns the tablesorter CSS classes for the header of the given column
+    of the report table, showing if it is sorted by it.'''
+    sort = p.toolkit.request.params.get('sort')
+    if sort == column:
+        return 'header headerSortDown'
+    elif sort == '-' + column:
+        return 'header headerSortUp'
+    return 'header'
+
 def chunks(list_, size):
     '''Splits up a given list into 'size' sized chunks.'''
     for i in xrange(0, len(list_), size):
@@ -31,5 +31,25 @@ class IReport(p.Interface):
             'generate': feedback_report
                           # The report function. Should return the data as a
                           # JSON-ifyable object.
+            'generate_bulk': feedback_report_bulk
+                          # (optional) A function that generates the report
+                          # for all the option combinations at once, which
+                          # can be much quicker than calling 'generate' for
+                          # each. It should yield (option_dict, data) tuples.
+            'watermark': feedback_report_watermark,
+            'changed_option_combinations': feedback_report_changed_combinations,
+            'summarize': feedback_report_summary,
+                          # (optional) These allow 'paster report-cache
+                          # generate --incremental' to regenerate only the
+                          # option combinations whose data has changed.
+                          # 'watermark' returns a value marking how up to date
+                          # the data is (e.g. the latest change time), which is
+                          # saved after each run.
+                          # 'changed_option_combinations' takes the watermark
+                          # saved by the last run and yields the option
+                          # combinations that may have changed since.
+                          # 'summarize' takes a list of (option_dict, data) of
+                          # the option combinations with an organization (etc)
+                          # and returns the data for the ones without.
         }
         """
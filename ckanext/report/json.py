@@ -2,6 +2,7 @@
 
 import re
 import datetime
+import dateutil.parser
 from ckan.lib.helpers import json as j
 
 class DateTimeJsonEncoder(j.JSONEncoder):
@@ -23,9 +24,85 @@ class DateTimeJsonDecoder(j.JSONDecoder):
         j.JSONDecoder.__init__(self, object_hook=self.dict_to_object,*args,**kwargs)
 
     def dict_to_object(self, d):
-        import dateutil.parser
         for k, v in d.iteritems():
             if isinstance(v, basestring):
                 if DateTimeJsonDecoder.dt.match(v):
                     d[k] = dateutil.parser.parse(v)
         return d
+
+
+# The key of the object that a datetime is wrapped in by TypedJsonEncoder
+DATETIME_TAG = '__datetime__'
+
+
+class TypedJsonEncoder(DateTimeJsonEncoder):
+    """ Serialises datetime.datetime objects tagged as such, i.e. as
+    {"__datetime__": "<isoformat>"}, so that TypedJsonDecoder can restore
+    them without examining every other string. Used for storing values in the
+    DataCache, rather than for JSON that is served to users.
+
+    Strings that DateTimeJsonDecoder would read back as datetimes are tagged
+    too (see iso_strings_to_datetimes), so a value comes back with the same
+    types as it always has. """
+    def encode(self, obj):
+        return j.JSONEncoder.encode(self, iso_strings_to_datetimes(obj))
+
+    def default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            return {DATETIME_TAG: obj.isoformat()}
+        return j.JSONEncoder.default(self, obj)
+
+
+def iso_strings_to_datetimes(value):
+    """ Returns a copy of the value with the strings in ISO format that are
+    values of an object converted to datetimes, as DateTimeJsonDecoder does
+    when decoding. The cells of a columnar table (see
+    ckanext.report.table.to_columnar) count as values of an object, as they
+    were before the table was made columnar. Strings elsewhere, e.g. in lists,
+    are left alone. """
+    if isinstance(value, dict):
+        columnar = 'columns' in value and isinstance(value.get('table'), list)
+        converted = value.__class__()
+        for k, v in value.iteritems():
+            if columnar and k == 'table':
+                v = [[_iso_string_to_datetime(cell) for cell in row]
+                     if isinstance(row, (list, tuple)) else row for row in v]
+            else:
+                v = _iso_string_to_datetime(v)
+            converted[k] = v
+        return converted
+    if isinstance(value, (list, tuple)):
+        return [iso_strings_to_datetimes(item) for item in value]
+    return value
+
+
+def _iso_string_to_datetime(value):
+    if isinstance(value, basestring):
+        if DateTimeJsonDecoder.dt.match(value):
+            return dateutil.parser.parse(value)
+        return value
+    return iso_strings_to_datetimes(value)
+
+
+class TypedJsonDecoder(j.JSONDecoder):
+    """ Decodes JSON written by TypedJsonEncoder. Plain strings are left alone -
+    only the tagged datetimes are parsed. """
+    def __init__(self,*args,**kwargs):
+        j.JSONDecoder.__init__(self, object_hook=self.dict_to_object,*args,**kwargs)
+
+    def dict_to_object(self, d):
+        if len(d) == 1 and DATETIME_TAG in d:
+            return parse_isoformat(d[DATETIME_TAG])
+        return d
+
+
+def parse_isoformat(value):
+    '''Parses a string produced by datetime.isoformat(). strptime handles the
+    usual (naive) ones much more quickly than dateutil.'''
+    try:
+        if '.' in value:
+            return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        # e.g. it has a timezone
+        return dateutil.parser.parse(value)
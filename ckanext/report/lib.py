@@ -2,7 +2,56 @@
 These functions are for use by other extensions for their reports.
 '''
 
+import contextlib
+import logging
+import threading
+
 import ckan.plugins as p
+from sqlalchemy import or_, select
+
+from ckanext.report import lock
+
+log = logging.getLogger(__name__)
+
+# The organization hierarchy, when it is memoized for a run (see
+# memoized_organization_tree)
+_memo = threading.local()
+# Whether this thread is in a generation run (see generation_run)
+_run = threading.local()
+
+# Number of rows fetched at a time by stream_query
+STREAM_BATCH_SIZE = 1000
+
+# The lock held while the organization totals are recounted
+ORGANIZATION_TOTALS_LOCK = 'report#organization_totals'
+# Seconds to wait for another process that is recounting them
+ORGANIZATION_TOTALS_LOCK_TIMEOUT = 300
+
+
+def stream_query(query, batch_size=STREAM_BATCH_SIZE):
+    '''Yields the rows of an SQLAlchemy ORM query, without holding them all
+    in memory at once. On PostgreSQL it uses a server-side cursor, fetching
+    batch_size rows at a time. (Other databases fetch the whole result.)
+
+    It is meant for queries of columns, rather than of whole objects - the
+    rows are plain result rows, with values accessed by column name or label
+    (e.g. row.name). The query runs on its own connection, so the session
+    can be committed (e.g. by the cache writes between reports) while the
+    rows are being read.
+    '''
+    from ckan import model
+    conn = model.meta.engine.connect()
+    try:
+        result = conn.execution_options(stream_results=True) \
+                     .execute(query.statement)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        conn.close()
 
 
 def all_organizations(include_none=False):
@@ -11,42 +60,293 @@ def all_organizations(include_none=False):
     from ckan import model
     if include_none:
         yield None
-    organizations = model.Session.query(model.Group).\
+    organizations = model.Session.query(model.Group.name).\
         filter(model.Group.type=='organization').\
-        filter(model.Group.state=='active').order_by('name')
-    for organization in organizations:
+        filter(model.Group.state=='active').order_by(model.Group.name)
+    for organization in stream_query(organizations):
         yield organization.name
 
 
-def go_down_tree(organization):
+def go_down_tree(organization, one_query=True):
     '''Provided with an organization object, it walks down the hierarchy and yields
     each organization, including the one you supply.
 
     Essentially this is a slower version of Group.get_children_group_hierarchy
     because it returns Group objects, rather than dicts.
+
+    The sub-organizations are found with one recursive query (or from the
+    memoized organization tree, if there is one), or if one_query is False,
+    by querying the children of each organization in turn.
     '''
+    from ckan import model
+    if not one_query:
+        yield organization
+        for child in organization.get_children_groups(type='organization'):
+            for grandchild in go_down_tree(child, one_query=False):
+                yield grandchild
+        return
     yield organization
-    for child in organization.get_children_groups(type='organization'):
-        for grandchild in go_down_tree(child):
-            yield grandchild
+    sub_org_ids = set(organization_subtree_ids(organization.id))
+    sub_org_ids.discard(organization.id)
+    if sub_org_ids:
+        for sub_org in model.Session.query(model.Group) \
+                .filter(model.Group.id.in_(sub_org_ids)) \
+                .order_by(model.Group.name):
+            yield sub_org
+
+
+def organization_subtree(organization_id):
+    '''Returns a recursive CTE of the ids ('id' column) of the given
+    organization and all the (active) organizations below it in the
+    hierarchy, for use in another query. Cycles in the hierarchy are ignored.
+    '''
+    from ckan import model
+    tree = model.Session.query(model.Group.id.label('id')) \
+                .filter(model.Group.id == organization_id) \
+                .cte(name='organization_tree', recursive=True)
+    # the recursive part refers to the CTE by an alias, as SQLAlchemy (0.9)
+    # otherwise sees two unrelated CTEs of the same name. A child's Member
+    # has its group_id, and the parent as its table_id.
+    parent = tree.alias('parent')
+    children = model.Session.query(model.Member.group_id) \
+                    .join(parent, model.Member.table_id == parent.c.id) \
+                    .join(model.Group, model.Group.id == model.Member.group_id) \
+                    .filter(model.Member.table_name == 'group') \
+                    .filter(model.Member.state == 'active') \
+                    .filter(model.Group.type == 'organization') \
+                    .filter(model.Group.state == 'active')
+    # UNION rather than UNION ALL, so that a cycle ends the recursion
+    return tree.union(children)
+
+
+def organization_subtree_ids(organization_id):
+    '''Returns the ids of the given organization and all the organizations
+    below it in the hierarchy - from the memoized organization tree if there
+    is one, otherwise with one recursive query.'''
+    from ckan import model
+    tree = _memoized_tree()
+    if tree:
+        return tree.subtree_ids(organization_id)
+    subtree = organization_subtree(organization_id)
+    return [id_ for id_, in model.Session.query(subtree.c.id)]
 
 
 def filter_by_organizations(query, organization, include_sub_organizations):
     '''Given an SQLAlchemy ORM query object, it returns it filtered by the
     given organization and optionally its sub organizations too.
+
+    The sub organizations are found within the query, with a recursive CTE,
+    unless the organization tree is memoized, in which case their ids are
+    taken from that.
     '''
     from ckan import model
     if not organization:
         return query
+    tree = _memoized_tree()
     if isinstance(organization, basestring):
-        organization = model.Group.get(organization)
-        assert organization
+        if tree:
+            organization_id = tree.organization_id(organization)
+        else:
+            organization_id = model.Session.query(model.Group.id) \
+                .filter(or_(model.Group.name == organization,
+                            model.Group.id == organization)) \
+                .scalar()
+        assert organization_id, organization
+    else:
+        organization_id = organization.id
     if include_sub_organizations:
-        orgs = sorted([x for x in go_down_tree(organization)], key=lambda x: x.name)
-        org_ids = [org.id for org in orgs]
-        return query.filter(model.Package.owner_org.in_(org_ids))
+        if tree:
+            return query.filter(model.Package.owner_org.in_(
+                tree.subtree_ids(organization_id)))
+        subtree = organization_subtree(organization_id)
+        return query.filter(model.Package.owner_org.in_(
+            select([subtree.c.id])))
     else:
-        return query.filter(model.Package.owner_org == organization.id)
+        return query.filter(model.Package.owner_org == organization_id)
+
+
+class OrganizationTree(object):
+    '''An index of the organization hierarchy, loaded with two queries, so
+    that the sub-organizations of any organization can be found without
+    querying the database again.
+
+    It gives the same answers as the queries used without it: any
+    organization can be looked up (by name or id), whatever its state, and
+    the organizations below it are the active ones.'''
+    def __init__(self, ids_by_name, children):
+        self.ids_by_name = ids_by_name  # name: id
+        self.ids = set(ids_by_name.values())
+        self.children = children  # parent id: [active child id, ...]
+
+    @classmethod
+    def load(cls):
+        from ckan import model
+        ids_by_name = {}
+        active_ids = set()
+        q = model.Session.query(model.Group.name, model.Group.id,
+                                model.Group.state) \
+                 .filter(model.Group.type == 'organization')
+        for name, id_, state in q:
+            ids_by_name[name] = id_
+            if state == 'active':
+                active_ids.add(id_)
+        children = {}
+        q = model.Session.query(model.Member.group_id, model.Member.table_id) \
+                 .filter(model.Member.table_name == 'group') \
+                 .filter(model.Member.state == 'active')
+        for child_id, parent_id in q:
+            if child_id in active_ids:
+                children.setdefault(parent_id, []).append(child_id)
+        return cls(ids_by_name, children)
+
+    def organization_id(self, organization):
+        '''Returns the id of the organization with the given id or name, or
+        None if there isn't one.'''
+        if organization in self.ids:
+            return organization
+        return self.ids_by_name.get(organization)
+
+    def subtree_ids(self, organization_id):
+        '''Returns the ids of the organization and all those below it.'''
+        ids = [organization_id]
+        seen = set(ids)
+        for id_ in ids:
+            for child_id in self.children.get(id_, []):
+                if child_id not in seen:
+                    seen.add(child_id)
+                    ids.append(child_id)
+        return ids
+
+
+@contextlib.contextmanager
+def memoized_organization_tree():
+    '''Within this block (in this thread), the organization hierarchy is
+    loaded once, when it is first needed, and used by filter_by_organizations
+    and go_down_tree, rather than querying it for every report/option
+    combination. Use it around a run of report generation, during which the
+    hierarchy is not expected to change.'''
+    depth = getattr(_memo, 'depth', 0)
+    if not depth:
+        _memo.tree = None
+    _memo.depth = depth + 1
+    try:
+        yield
+    finally:
+        _memo.depth = depth
+        if not depth:
+            _memo.tree = None
+
+
+@contextlib.contextmanager
+def generation_run(refresh_totals=True):
+    '''Marks a run of report generation (in this thread). At the start of
+    the run, the organization totals are refreshed (unless refresh_totals is
+    False, e.g. because the process that started the run has done it), and
+    during it they are read as they are, rather than being recounted for each
+    report/option combination. The organization hierarchy is memoized too
+    (see memoized_organization_tree).'''
+    depth = getattr(_run, 'depth', 0)
+    _run.depth = depth + 1
+    try:
+        with memoized_organization_tree():
+            if not depth and refresh_totals:
+                refresh_organization_totals()
+            yield
+    finally:
+        _run.depth = depth
+
+
+def in_generation_run():
+    return bool(getattr(_run, 'depth', 0))
+
+
+def refresh_organization_totals():
+    '''Recounts the materialized totals of active datasets and resources of
+    all the organizations, in a transaction of its own, so the session is
+    not committed. Only one process recounts them at a time - if another is
+    already doing so, this waits for it to finish instead.'''
+    from ckan import model
+    from ckanext.report import model as report_model
+    with lock.try_lock(ORGANIZATION_TOTALS_LOCK) as locked:
+        if locked:
+            with model.meta.engine.begin() as conn:
+                report_model.refresh_organization_totals(conn)
+            return
+    log.info('Organization totals are being refreshed by another process - '
+             'waiting for it')
+    with lock.acquire(ORGANIZATION_TOTALS_LOCK,
+                      timeout=ORGANIZATION_TOTALS_LOCK_TIMEOUT):
+        pass
+
+
+def organization_totals():
+    '''Returns the totals of all the active organizations, as a dict of
+    organization name: dict with keys: id, title, num_packages (active
+    datasets), num_packages_with_resources and num_resources (active
+    resources of active datasets).
+
+    During a generation run they are read from a table that is refreshed at
+    the start of the run (see generation_run). Outside a run (e.g. a report
+    generated on demand) they are counted afresh, without being written.'''
+    return _organization_totals()
+
+
+def organization_totals_for(organization, include_sub_organizations=False):
+    '''Returns the totals (a dict, as for organization_totals, with
+    num_packages, num_packages_with_resources and num_resources) of the given
+    organization (name), optionally added up with those of all its sub
+    organizations. Returns None if the organization is not found.'''
+    from ckan import model
+    organization_id = model.Session.query(model.Group.id) \
+        .filter(model.Group.name == organization).scalar()
+    if not organization_id:
+        return None
+    if include_sub_organizations:
+        organization_ids = organization_subtree_ids(organization_id)
+    else:
+        organization_ids = [organization_id]
+    totals = _organization_totals(organization_ids)
+    if organization not in totals:
+        # not active
+        return None
+    result = dict(totals[organization])
+    for key in ('num_packages', 'num_packages_with_resources',
+                'num_resources'):
+        result[key] = sum(org_totals[key] for org_totals in totals.values())
+    return result
+
+
+def _organization_totals(organization_ids=None):
+    '''Returns the totals (see organization_totals) of all the organizations
+    or just those with the given ids - read from the table in a generation
+    run, otherwise counted.'''
+    from ckan import model
+    from ckanext.report import model as report_model
+    if in_generation_run():
+        table = report_model.organization_totals_table
+        q = table.select()
+        if organization_ids is not None:
+            q = q.where(table.c.organization_id.in_(organization_ids))
+    else:
+        q = report_model.count_organization_totals(organization_ids)
+    totals = {}
+    for row in model.Session.execute(q):
+        totals[row.organization_name] = {
+            'id': row.organization_id,
+            'title': row.organization_title,
+            'num_packages': row.num_packages,
+            'num_packages_with_resources': row.num_packages_with_resources,
+            'num_resources': row.num_resources,
+            }
+    return totals
+
+
+def _memoized_tree():
+    if not getattr(_memo, 'depth', 0):
+        return None
+    if _memo.tree is None:
+        _memo.tree = OrganizationTree.load()
+    return _memo.tree
 
 
 def dataset_notes(pkg):
@@ -0,0 +1,170 @@
+'''
+Locks on report cache keys, so that a report is not generated by more than
+one request or process at a time.
+
+On PostgreSQL these are advisory locks, so they work across processes and
+servers. Each lock is held on its own connection, separate from the ORM
+session, so it is unaffected by commits and rollbacks during generation. On
+other databases they only work within the process.
+'''
+
+import contextlib
+import hashlib
+import logging
+import struct
+import threading
+import time
+
+from sqlalchemy import func, select
+
+from ckanext.report import stats
+
+log = logging.getLogger(__name__)
+
+# Seconds between attempts to get a lock that is held by someone else
+POLL_INTERVAL = 0.5
+
+_local_locks = set()
+_local_locks_lock = threading.Lock()
+
+
+def lock_id(key):
+    '''Returns the advisory lock id (a signed 64 bit integer) for a key.'''
+    return struct.unpack('>q', hashlib.md5(_encode(key)).digest()[:8])[0]
+
+
+@contextlib.contextmanager
+def acquire(key, timeout=0):
+    '''Gets the lock for the given key, waiting up to timeout seconds for
+    it. Yields True if it got it, which is then released at the end of the
+    block, or False if someone else held it for the whole time.
+
+        with acquire(key, timeout=30) as locked:
+            if locked:
+                ...
+    '''
+    from ckan import model
+    deadline = time.time() + timeout
+    while not _local_acquire(key):
+        if time.time() >= deadline:
+            yield False
+            return
+        time.sleep(POLL_INTERVAL)
+    try:
+        engine = model.meta.engine
+        if engine.dialect.name != 'postgresql':
+            yield True
+            return
+        id_ = lock_id(key)
+        conn = engine.connect()
+        try:
+            while True:
+                with stats.not_counted():
+                    locked = conn.execute(
+                        select([func.pg_try_advisory_lock(id_)])).scalar()
+                if locked or time.time() >= deadline:
+                    break
+                time.sleep(POLL_INTERVAL)
+            try:
+                yield locked
+            finally:
+                if locked:
+                    with stats.not_counted():
+                        conn.execute(
+                            select([func.pg_advisory_unlock(id_)]))
+        finally:
+            conn.close()
+    finally:
+        _local_release(key)
+
+
+def try_lock(key):
+    '''Tries to get the lock for the given key, without waiting. See
+    acquire.'''
+    return acquire(key, timeout=0)
+
+
+@contextlib.contextmanager
+def try_lock_many(keys):
+    '''Tries to get the locks for the given keys, without waiting, all on one
+    connection. Yields the list of the keys it got, which are released at the
+    end of the block.
+
+        with try_lock_many(keys) as locked_keys:
+            ...
+    '''
+    from ckan import model
+    locked_keys = [key for key in keys if _local_acquire(key)]
+    try:
+        engine = model.meta.engine
+        if engine.dialect.name != 'postgresql' or not locked_keys:
+            yield locked_keys
+            return
+        conn = engine.connect()
+        held = []
+        try:
+            for key in locked_keys:
+                with stats.not_counted():
+                    if conn.execute(select([func.pg_try_advisory_lock(
+                            lock_id(key))])).scalar():
+                        held.append(key)
+                    else:
+                        _local_release(key)
+            try:
+                yield held
+            finally:
+                for key in held:
+                    with stats.not_counted():
+                        conn.execute(
+                            select([func.pg_advisory_unlock(lock_id(key))]))
+        finally:
+            conn.close()
+    finally:
+        for key in locked_keys:
+            _local_release(key)
+
+
+def is_locked(key):
+    '''Returns whether anyone (this process or, on PostgreSQL, any other)
+    holds the lock for the key, without trying to get it.'''
+    from ckan import model
+    if is_locked_locally(key):
+        return True
+    engine = model.meta.engine
+    if engine.dialect.name != 'postgresql':
+        return False
+    # a bigint advisory lock is shown in pg_locks split into two oids
+    id_ = lock_id(key) & 0xffffffffffffffff
+    with stats.not_counted():
+        return bool(engine.execute('''
+            SELECT count(*) FROM pg_locks
+            WHERE locktype = 'advisory' AND granted
+              AND database = (SELECT oid FROM pg_database
+                              WHERE datname = current_database())
+              AND classid = %s AND objid = %s AND objsubid = 1
+            ''', (id_ >> 32, id_ & 0xffffffff)).scalar())
+
+
+def _encode(key):
+    if isinstance(key, unicode):
+        return key.encode('utf8')
+    return key
+
+
+def _local_acquire(key):
+    with _local_locks_lock:
+        if key in _local_locks:
+            return False
+        _local_locks.add(key)
+        return True
+
+
+def _local_release(key):
+    with _local_locks_lock:
+        _local_locks.discard(key)
+
+
+def is_locked_locally(key):
+    '''Returns whether this process holds the lock for the key.'''
+    with _local_locks_lock:
+        return key in _local_locks
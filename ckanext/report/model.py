@@ -1,17 +1,28 @@
 from __future__ import absolute_import
 
+import base64
 import datetime
 import logging
 import json
+import zlib
 
 from sqlalchemy import types, Table, Column, Index, MetaData
+from sqlalchemy import func, bindparam, text, and_, case, literal
+from sqlalchemy import select, inspect
 from sqlalchemy.orm import mapper
 
 from ckan import model
 
 log = logging.getLogger(__name__)
 
-__all__ = ['DataCache', 'data_cache_table', 'init_tables']
+__all__ = ['DataCache', 'data_cache_table', 'DataCacheStats',
+           'data_cache_stats_table', 'organization_totals_table',
+           'refresh_organization_totals', 'count_organization_totals',
+           'GenerationRun',
+           'generation_run_table', 'generation_run_item_table',
+           'DataCacheAccess', 'data_cache_access_table',
+           'init_tables', 'migrate_tables',
+           'encode_json', 'decode_json', 'compress_existing_values']
 
 metadata = MetaData()
 
@@ -23,9 +34,131 @@ data_cache_table = Table(
     Column('key', types.UnicodeText, nullable=False),
     Column('value', types.UnicodeText),
     Column('created', types.DateTime, default=datetime.datetime.now),
+    # the start of the key, up to the '?' (see report_name_from_key)
+    Column('report_name', types.UnicodeText),
 )
-Index('idx_data_cache_object_id_key', data_cache_table.c.object_id,
-      data_cache_table.c.key)
+Index('idx_data_cache_report_name', data_cache_table.c.report_name)
+# object_id is often None, so it is coalesced, otherwise NULLs would never
+# conflict and set_many could not upsert them
+Index('idx_data_cache_object_id_key_unique',
+      func.coalesce(data_cache_table.c.object_id, ''),
+      data_cache_table.c.key, unique=True)
+
+# Measurements of the generation of each DataCache value (see
+# ckanext.report.stats), from the last time it was generated
+data_cache_stats_table = Table(
+    'data_cache_stats', metadata,
+    Column('id', types.UnicodeText, primary_key=True,
+           default=model.types.make_uuid),
+    Column('object_id', types.UnicodeText),
+    Column('key', types.UnicodeText, nullable=False),
+    Column('report_name', types.UnicodeText, index=True),
+    Column('created', types.DateTime, default=datetime.datetime.now),
+    Column('wall_time', types.Float),
+    Column('cpu_time', types.Float),
+    Column('num_queries', types.Integer),
+    Column('num_rows', types.Integer),
+    Column('size', types.Integer),
+)
+Index('idx_data_cache_stats_object_id_key_unique',
+      func.coalesce(data_cache_stats_table.c.object_id, ''),
+      data_cache_stats_table.c.key, unique=True)
+
+# Totals of each (active) organization's active datasets and resources, for
+# reports to share rather than each counting them. See
+# refresh_organization_totals.
+organization_totals_table = Table(
+    'report_organization_totals', metadata,
+    Column('organization_id', types.UnicodeText, primary_key=True),
+    Column('organization_name', types.UnicodeText, index=True),
+    Column('organization_title', types.UnicodeText),
+    Column('num_packages', types.Integer),
+    Column('num_packages_with_resources', types.Integer),
+    Column('num_resources', types.Integer),
+    Column('refreshed', types.DateTime),
+)
+
+# Runs of report generation, and the progress of each, so that a run that
+# is stopped (by a deadline, or killed) can be resumed. See GenerationRun.
+generation_run_table = Table(
+    'report_generation_run', metadata,
+    Column('id', types.UnicodeText, primary_key=True,
+           default=model.types.make_uuid),
+    # comma separated, or NULL for all the reports
+    Column('report_names', types.UnicodeText),
+    Column('started', types.DateTime, default=datetime.datetime.now),
+    Column('finished', types.DateTime),
+    # running, stopped (at the deadline, or with items skipped) or complete
+    Column('state', types.UnicodeText),
+)
+generation_run_item_table = Table(
+    'report_generation_run_item', metadata,
+    Column('id', types.UnicodeText, primary_key=True,
+           default=model.types.make_uuid),
+    Column('run_id', types.UnicodeText, nullable=False, index=True),
+    Column('report_name', types.UnicodeText),
+    # the DataCache key, or '<report_name>#bulk' for a whole report
+    Column('key', types.UnicodeText),
+    # done, failed or skipped (see GenerationRun.record)
+    Column('state', types.UnicodeText),
+    Column('error', types.UnicodeText),
+    Column('finished', types.DateTime, default=datetime.datetime.now),
+)
+
+# How often each DataCache key has been viewed (see ckanext.report.access),
+# so that the most viewed are regenerated first
+data_cache_access_table = Table(
+    'data_cache_access', metadata,
+    Column('key', types.UnicodeText, primary_key=True),
+    Column('report_name', types.UnicodeText, index=True),
+    Column('num_views', types.Integer, nullable=False, default=0),
+    Column('last_viewed', types.DateTime),
+)
+
+# Marks a value stored in the typed JSON format (JSON can't start with 't:')
+TYPED_JSON_PREFIX = u't:'
+# Marks a value stored zlib compressed and base64 encoded. The decompressed
+# value has its own prefix (or none, if it is plain JSON).
+COMPRESSED_PREFIX = u'z:'
+
+# Values older than this are not returned by get_if_fresh
+FRESH_MAX_AGE = datetime.timedelta(days=1)
+
+# How many keys to look up in one IN clause
+KEY_BATCH_SIZE = 500
+
+UPSERT_SQL = text('''
+INSERT INTO data_cache (id, object_id, key, value, created, report_name)
+VALUES (:id, :object_id, :key, :value, :created, :report_name)
+ON CONFLICT (COALESCE(object_id, ''), key)
+DO UPDATE SET value = EXCLUDED.value, created = EXCLUDED.created,
+              report_name = EXCLUDED.report_name
+''')
+
+ADD_VIEWS_SQL = text('''
+INSERT INTO data_cache_access (key, report_name, num_views, last_viewed)
+VALUES (:key, :report_name, :num_views, :last_viewed)
+ON CONFLICT (key)
+DO UPDATE SET num_views = data_cache_access.num_views + EXCLUDED.num_views,
+              last_viewed = GREATEST(data_cache_access.last_viewed,
+                                     EXCLUDED.last_viewed)
+''')
+
+STATS_UPSERT_SQL = text('''
+INSERT INTO data_cache_stats (id, object_id, key, report_name, created,
+                              wall_time, cpu_time, num_queries, num_rows,
+                              size)
+VALUES (:id, :object_id, :key, :report_name, :created,
+        :wall_time, :cpu_time, :num_queries, :num_rows, :size)
+ON CONFLICT (COALESCE(object_id, ''), key)
+DO UPDATE SET report_name = EXCLUDED.report_name, created = EXCLUDED.created,
+              wall_time = EXCLUDED.wall_time, cpu_time = EXCLUDED.cpu_time,
+              num_queries = EXCLUDED.num_queries,
+              num_rows = EXCLUDED.num_rows, size = EXCLUDED.size
+''')
+
+# How many rows to delete at a time, each in its own transaction
+DELETE_BATCH_SIZE = 500
 
 
 class DataCache(object):
@@ -69,13 +202,28 @@ class DataCache(object):
         """
         Retrieves the value and date that it was written if the record with
         object_id/key exists. If not it will return None/None.
+
+        Without convert_json, the value is returned as it was given to set(),
+        i.e. values stored as JSON are plain JSON text, whatever form they
+        are stored in (see plain_value).
+
+        Values converted from JSON may come from the in-process cache (see
+        ckanext.report.cache), so must not be modified by the caller.
         """
-        from ckanext.report.json import DateTimeJsonDecoder
+        from ckanext.report.cache import decoded_values
 
-        item = model.Session.query(cls)\
-                   .filter(cls.key == key)\
-                   .filter(cls.object_id == object_id)\
-                   .first()
+        memory_cache = decoded_values() if convert_json else None
+        if memory_cache:
+            # only fetch the value if it's not already decoded in memory
+            item = model.Session.query(cls.created)\
+                       .filter(cls.key == key)\
+                       .filter(cls.object_id == object_id)\
+                       .first()
+        else:
+            item = model.Session.query(cls.value, cls.created)\
+                       .filter(cls.key == key)\
+                       .filter(cls.object_id == object_id)\
+                       .first()
         if not item:
             #log.debug('Does not exist in cache: %s/%s', object_id, key)
             return (None, None)
@@ -87,15 +235,42 @@ class DataCache(object):
                          object_id, key, age, max_age)
                 return (None, None)
 
+        if memory_cache:
+            value = memory_cache.get(object_id, key, item.created)
+            if value is not None:
+                return value, item.created
+            value = model.Session.query(cls.value)\
+                        .filter(cls.key == key)\
+                        .filter(cls.object_id == object_id)\
+                        .scalar()
+            value = decompress_value(value)
+            decoded_value = decode_json(value)
+            memory_cache.set(object_id, key, item.created, decoded_value,
+                             len(value))
+            return decoded_value, item.created
+
         value = item.value
         if convert_json:
-            value = json.loads(value, cls=DateTimeJsonDecoder)
+            value = decode_json(value)
+        else:
+            value = plain_value(value)
         #log.debug('Cache load: %s/%s "%s"...', object_id, key, repr(value)[:40])
         return value, item.created
 
+    @classmethod
+    def get_created(cls, object_id, key):
+        """
+        Returns the date that the record with object_id/key was written, or
+        None if it doesn't exist, without fetching the value.
+        """
+        return model.Session.query(cls.created) \
+                    .filter(cls.key == key) \
+                    .filter(cls.object_id == object_id) \
+                    .scalar()
+
     @classmethod
     def get_if_fresh(cls, *args, **kwargs):
-        return cls.get(*args, max_age=datetime.timedelta(days=1), **kwargs)
+        return cls.get(*args, max_age=FRESH_MAX_AGE, **kwargs)
 
     @classmethod
     def set(cls, object_id, key, value, convert_json=False):
@@ -105,26 +280,752 @@ class DataCache(object):
         create a new record.  All values will be returned as a string, unless
         convert_json is done to convert from JSON.
         """
-        from ckanext.report.json import DateTimeJsonEncoder
 
         if convert_json:
-            value = json.dumps(value, cls=DateTimeJsonEncoder)
+            value = encode_json(value)
 
         item = model.Session.query(cls) \
                    .filter(cls.key == key) \
                    .filter(cls.object_id == object_id).first()
         if item is None:
-            item = DataCache(object_id=object_id, key=key, value=value)
+            item = DataCache(object_id=object_id, key=key, value=value,
+                             report_name=report_name_from_key(key))
             model.Session.add(item)
         else:
             item.value = value
+            item.report_name = report_name_from_key(key)
         item.created = datetime.datetime.now()
 
+        _invalidate_memory_cache([(object_id, key)])
+
         log.debug('Cache save: %s/%s', object_id, key)
         model.Session.flush()
         return item.created
 
+    @classmethod
+    def get_all_metadata(cls, report_name=None):
+        """
+        Returns the (object_id, key, created) of every record (or just those
+        of the given report, i.e. with keys starting with its name), in one
+        query. The values are not read.
+        """
+        q = model.Session.query(cls.object_id, cls.key, cls.created)
+        if report_name:
+            q = q.filter(cls.report_name == report_name)
+        return q.all()
+
+    @classmethod
+    def get_report_summaries(cls):
+        """
+        Returns a dict of report name: (num_cached, oldest_date, newest_date,
+        size) summarizing the records of every report, from one grouped
+        query, so there is one row per report, however many records it has.
+        size is the total length of the stored values, which on PostgreSQL
+        is octet_length, as that is known without reading the (TOASTed)
+        values.
+        """
+        if model.meta.engine.dialect.name == 'postgresql':
+            size = func.octet_length(cls.value)
+        else:
+            size = func.length(cls.value)
+        q = model.Session.query(cls.report_name, func.count(cls.id),
+                                func.min(cls.created), func.max(cls.created),
+                                func.sum(size)) \
+                 .filter(cls.report_name != None) \
+                 .group_by(cls.report_name)
+        return dict((row[0], tuple(row[1:])) for row in q)
+
+    @classmethod
+    def get_created_for_keys(cls, keys):
+        """
+        Returns a dict of key: the date the record with that key was written,
+        for those of the given keys that are cached, without fetching the
+        values.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        return dict(model.Session.query(cls.key, cls.created)
+                         .filter(cls.key.in_(keys)).all())
+
+    @classmethod
+    def delete_keys(cls, report_name, keys, batch_size=DELETE_BATCH_SIZE):
+        """
+        Deletes the records of the given report with the given keys (whatever
+        their object_id), along with their DataCacheStats and
+        DataCacheAccess, in batches of
+        batch_size, committing each batch so that no lock is held for long.
+
+        Returns the number of records deleted.
+        """
+        deleted = 0
+        for batch in _batches(list(keys), batch_size):
+            result = model.Session.execute(
+                data_cache_table.delete()
+                .where(data_cache_table.c.report_name == report_name)
+                .where(data_cache_table.c.key.in_(batch)))
+            model.Session.execute(
+                data_cache_stats_table.delete()
+                .where(data_cache_stats_table.c.report_name == report_name)
+                .where(data_cache_stats_table.c.key.in_(batch)))
+            model.Session.execute(
+                data_cache_access_table.delete()
+                .where(data_cache_access_table.c.report_name == report_name)
+                .where(data_cache_access_table.c.key.in_(batch)))
+            model.Session.commit()
+            deleted += result.rowcount
+        log.debug('Cache delete: %s/%s items', report_name, deleted)
+        return deleted
+
+    @classmethod
+    def get_many(cls, keys, convert_json=False, max_age=None):
+        """
+        Retrieves the values and dates for a list of (object_id, key) in a
+        single query (per KEY_BATCH_SIZE keys).
+
+        Returns a dict of (object_id, key): (value, created), with (None, None)
+        for any that do not exist (or are older than max_age), as for get().
+        """
+
+        keys = list(keys)
+        results = dict((object_id_key, (None, None)) for object_id_key in keys)
+        now = datetime.datetime.now()
+        for batch in _batches(list(set(key for object_id, key in keys)),
+                              KEY_BATCH_SIZE):
+            q = model.Session.query(cls.object_id, cls.key, cls.value,
+                                    cls.created) \
+                     .filter(cls.key.in_(batch))
+            for object_id, key, value, created in q:
+                if (object_id, key) not in results:
+                    continue
+                if max_age and now - created > max_age:
+                    continue
+                if convert_json:
+                    value = decode_json(value)
+                else:
+                    value = plain_value(value)
+                results[(object_id, key)] = (value, created)
+        return results
+
+    @classmethod
+    def set_many(cls, items, convert_json=False):
+        """
+        Stores many values at once. items is a list of (object_id, key, value).
+        Existing records are updated and the rest are inserted, all with the
+        same created date, which is returned. Unlike set(), it does not go
+        through the ORM, so it is far fewer round trips to the database.
+
+        On PostgreSQL 9.5+ it is a batched INSERT ... ON CONFLICT. On other
+        databases the existing records are looked up in one query and then
+        updated and inserted in two batches.
+        """
+
+        created = datetime.datetime.now()
+        rows = []
+        for object_id, key, value in items:
+            if convert_json:
+                value = encode_json(value)
+            rows.append({'id': model.types.make_uuid(), 'object_id': object_id,
+                         'key': key, 'value': value, 'created': created,
+                         'report_name': report_name_from_key(key)})
+        if not rows:
+            return created
+
+        if supports_upsert(model.Session.bind.dialect):
+            model.Session.execute(UPSERT_SQL, rows)
+        else:
+            existing_ids = {}
+            for batch in _batches(list(set(row['key'] for row in rows)),
+                                  KEY_BATCH_SIZE):
+                q = model.Session.query(cls.id, cls.object_id, cls.key) \
+                         .filter(cls.key.in_(batch))
+                for id_, object_id, key in q:
+                    existing_ids[(object_id, key)] = id_
+            updates = []
+            inserts = []
+            for row in rows:
+                id_ = existing_ids.get((row['object_id'], row['key']))
+                if id_:
+                    updates.append({'_id': id_, '_value': row['value'],
+                                    '_created': created,
+                                    '_report_name': row['report_name']})
+                else:
+                    inserts.append(row)
+            if updates:
+                model.Session.execute(
+                    data_cache_table.update()
+                    .where(data_cache_table.c.id == bindparam('_id'))
+                    .values(value=bindparam('_value'),
+                            created=bindparam('_created'),
+                            report_name=bindparam('_report_name')),
+                    updates)
+            if inserts:
+                model.Session.execute(data_cache_table.insert(), inserts)
+        # any DataCache objects already loaded by the ORM are now out of date
+        model.Session.expire_all()
+        _invalidate_memory_cache((row['object_id'], row['key'])
+                                 for row in rows)
+
+        log.debug('Cache save: %s items', len(rows))
+        return created
+
 mapper(DataCache, data_cache_table)
 
+
+class DataCacheStats(object):
+    """
+    Measurements of how long each DataCache value took to generate, how many
+    SQL queries it ran, and how big the result is. Only the latest
+    measurement of each (object_id, key) is kept.
+
+    num_rows - the number of rows in the report's table(s)
+    size - the length of the value as stored in the DataCache
+    """
+
+    COLUMNS = ('wall_time', 'cpu_time', 'num_queries', 'num_rows', 'size')
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def set_many(cls, items, created):
+        """
+        Stores the measurements for many values at once, replacing any
+        previous ones. items is a list of (object_id, key, report_name,
+        stats_dict), where stats_dict has keys from COLUMNS.
+
+        On PostgreSQL 9.5+ they are upserted, otherwise the previous ones are
+        deleted first.
+        """
+        rows = []
+        for object_id, key, report_name, stats in items:
+            row = {'id': model.types.make_uuid(), 'object_id': object_id,
+                   'key': key, 'report_name': report_name,
+                   'created': created}
+            for column in cls.COLUMNS:
+                row[column] = stats.get(column)
+            rows.append(row)
+        if not rows:
+            return
+        if supports_upsert(model.Session.bind.dialect):
+            model.Session.execute(STATS_UPSERT_SQL, rows)
+            model.Session.expire_all()
+            return
+        object_id_keys = set((row['object_id'], row['key']) for row in rows)
+        for batch in _batches(list(set(row['key'] for row in rows)),
+                              KEY_BATCH_SIZE):
+            q = model.Session.query(cls.id, cls.object_id, cls.key) \
+                     .filter(cls.key.in_(batch))
+            old_ids = [id_ for id_, object_id, key in q
+                       if (object_id, key) in object_id_keys]
+            if old_ids:
+                model.Session.execute(data_cache_stats_table.delete().where(
+                    data_cache_stats_table.c.id.in_(old_ids)))
+        model.Session.execute(data_cache_stats_table.insert(), rows)
+        model.Session.expire_all()
+
+    @classmethod
+    def get_all(cls, report_names=None):
+        """
+        Returns the measurements (of the given reports, or all of them),
+        slowest first.
+        """
+        q = model.Session.query(cls)
+        if report_names:
+            q = q.filter(cls.report_name.in_(report_names))
+        return q.order_by(cls.wall_time.desc()).all()
+
+    def as_dict(self):
+        stats = {'object_id': self.object_id, 'key': self.key,
+                 'report_name': self.report_name, 'created': self.created}
+        for column in self.COLUMNS:
+            stats[column] = getattr(self, column)
+        return stats
+
+mapper(DataCacheStats, data_cache_stats_table)
+
+
+class GenerationRun(object):
+    """
+    A run of report generation. The report/options done (or failed) are
+    recorded as the run goes along, each committed, so that if the run
+    stops before the end it can be resumed without redoing them.
+    """
+
+    RUNNING = u'running'
+    STOPPED = u'stopped'
+    COMPLETE = u'complete'
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def start(cls, report_names=None):
+        run = cls(report_names=_join_names(report_names), state=cls.RUNNING,
+                  started=datetime.datetime.now())
+        model.Session.add(run)
+        model.Session.commit()
+        return run
+
+    @classmethod
+    def latest_unfinished(cls, report_names=None):
+        """
+        Returns the latest run of the given reports (or of all of them) that
+        did not complete, or None.
+        """
+        q = model.Session.query(cls) \
+                 .filter(cls.report_names == _join_names(report_names)) \
+                 .filter(cls.state != cls.COMPLETE) \
+                 .order_by(cls.started.desc())
+        return q.first()
+
+    def done_keys(self):
+        """
+        Returns the keys that have been done (successfully) in this run.
+        """
+        q = select([generation_run_item_table.c.key]) \
+            .where(generation_run_item_table.c.run_id == self.id) \
+            .where(generation_run_item_table.c.state == u'done')
+        return set(key for key, in model.Session.execute(q))
+
+    def record(self, report_name, key, error=None, skipped=False):
+        """
+        Records (and commits) that the report/options have been done, or
+        failed with the given error message, or were skipped (because
+        another process was generating them) and so are still to be done.
+        """
+        if error:
+            state = u'failed'
+        elif skipped:
+            state = u'skipped'
+        else:
+            state = u'done'
+        model.Session.execute(generation_run_item_table.insert().values(
+            id=model.types.make_uuid(), run_id=self.id,
+            report_name=report_name, key=key, state=state, error=error,
+            finished=datetime.datetime.now()))
+        model.Session.commit()
+
+    def failures(self):
+        """
+        Returns (report_name, key, error) of the items that failed in this run
+        and were not done later in it.
+        """
+        items = generation_run_item_table
+        q = select([items.c.report_name, items.c.key, items.c.error]) \
+            .where(items.c.run_id == self.id) \
+            .where(items.c.state == u'failed') \
+            .order_by(items.c.finished)
+        done = self.done_keys()
+        return [(report_name, key, error)
+                for report_name, key, error in model.Session.execute(q)
+                if key not in done]
+
+    def finish(self, state):
+        self.state = state
+        self.finished = datetime.datetime.now()
+        model.Session.add(self)
+        model.Session.commit()
+
+mapper(GenerationRun, generation_run_table)
+
+
+class DataCacheAccess(object):
+    """
+    How many times each DataCache key has been viewed, and when it was last
+    viewed. The views are counted in memory and added here in batches (see
+    ckanext.report.access).
+    """
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def add_views(cls, conn, items):
+        """
+        Adds to the view counts. items is a list of (key, num_views,
+        last_viewed). It is run on the given connection rather than the
+        Session, so that it doesn't commit (or roll back) anything of the
+        request that happens to trigger it.
+        """
+        rows = [{'key': key, 'report_name': report_name_from_key(key),
+                 'num_views': num_views, 'last_viewed': last_viewed}
+                for key, num_views, last_viewed in items]
+        if not rows:
+            return
+        if supports_upsert(conn.dialect):
+            conn.execute(ADD_VIEWS_SQL, rows)
+            return
+        table = data_cache_access_table
+        for row in rows:
+            result = conn.execute(
+                table.update()
+                .where(table.c.key == row['key'])
+                .values(num_views=table.c.num_views + row['num_views'],
+                        last_viewed=case(
+                            [(table.c.last_viewed > row['last_viewed'],
+                              table.c.last_viewed)],
+                            else_=row['last_viewed'])))
+            if not result.rowcount:
+                conn.execute(table.insert(), row)
+
+    @classmethod
+    def get_views(cls, report_name):
+        """
+        Returns a dict of the report's viewed keys: (num_views, last_viewed).
+        """
+        table = data_cache_access_table
+        q = select([table.c.key, table.c.num_views, table.c.last_viewed]) \
+            .where(table.c.report_name == report_name)
+        return dict((key, (num_views, last_viewed))
+                    for key, num_views, last_viewed in model.Session.execute(q))
+
+mapper(DataCacheAccess, data_cache_access_table)
+
+
+def supports_upsert(dialect):
+    '''Returns whether the database supports INSERT ... ON CONFLICT, i.e. it
+    is PostgreSQL 9.5 or later. Otherwise the existing rows are looked up
+    and updated separately.'''
+    return dialect.name == 'postgresql' and \
+        (dialect.server_version_info or ()) >= (9, 5)
+
+
+def _join_names(report_names):
+    return u','.join(sorted(report_names)) if report_names else None
+
+
+def encode_json(value):
+    '''Serializes a value to JSON for storing in the DataCache. It is written
+    in the typed format, with datetimes tagged, so that decode_json doesn't
+    have to examine every string to find them. (Strings in ISO format, which
+    were always read back as datetimes, are tagged as datetimes too.) Large
+    values are compressed (see compress_value).'''
+    from ckanext.report.json import TypedJsonEncoder
+    return compress_value(
+        TYPED_JSON_PREFIX + json.dumps(value, cls=TypedJsonEncoder))
+
+
+def decode_json(value):
+    '''Deserializes a value stored in the DataCache. Values stored before the
+    typed format existed are plain JSON, with datetimes recognized by their
+    ISO format.'''
+    from ckanext.report.json import TypedJsonDecoder, DateTimeJsonDecoder
+    value = decompress_value(value)
+    if value.startswith(TYPED_JSON_PREFIX):
+        return json.loads(value[len(TYPED_JSON_PREFIX):],
+                          cls=TypedJsonDecoder)
+    return json.loads(value, cls=DateTimeJsonDecoder)
+
+
+def plain_value(value):
+    '''Returns a value stored in the DataCache as plain JSON text (or
+    whatever else was stored), as it was before values were compressed and
+    stored in the typed format - i.e. decompressed, and with any datetimes in
+    ISO format rather than tagged. This is what DataCache.get returns without
+    convert_json, as extensions reading the DataCache expect.'''
+    from ckanext.report.json import TypedJsonDecoder, DateTimeJsonEncoder
+    if not value:
+        return value
+    value = decompress_value(value)
+    if value.startswith(TYPED_JSON_PREFIX):
+        value = json.dumps(json.loads(value[len(TYPED_JSON_PREFIX):],
+                                      cls=TypedJsonDecoder),
+                           cls=DateTimeJsonEncoder)
+    return value
+
+
+def compress_value(value):
+    '''Compresses an encoded value, if it is larger than the configured
+    threshold. Config options:
+
+      ckanext-report.data_cache.compress = true
+      ckanext-report.data_cache.compress_threshold = 16384
+
+    The threshold is the number of characters of JSON.
+    '''
+    threshold = _compress_threshold()
+    if threshold is None or len(value) <= threshold or \
+            value.startswith(COMPRESSED_PREFIX):
+        return value
+    return COMPRESSED_PREFIX + \
+        base64.b64encode(zlib.compress(value.encode('utf8'))).decode('ascii')
+
+
+def decompress_value(value):
+    if not value.startswith(COMPRESSED_PREFIX):
+        return value
+    return zlib.decompress(
+        base64.b64decode(value[len(COMPRESSED_PREFIX):])).decode('utf8')
+
+
+def _compress_threshold():
+    from pylons import config
+    import ckan.plugins.toolkit as t
+    if not t.asbool(config.get('ckanext-report.data_cache.compress', True)):
+        return None
+    return int(config.get('ckanext-report.data_cache.compress_threshold',
+                          16384))
+
+
+def compress_existing_values(report_names, batch_size=100):
+    '''Compresses existing DataCache values of the given reports that are
+    over the compression threshold - i.e. ones stored before compression was
+    enabled or the threshold was lowered. It works through the table in
+    batches, committing each one.
+
+    Returns stats about the space saved: a dict with the number of values
+    examined and compressed, and their total size before and after.
+    '''
+    stats = {'values': 0, 'compressed': 0,
+             'size_before': 0, 'size_after': 0}
+    key_filter = DataCache.report_name.in_(report_names)
+    last_id = None
+    while True:
+        q = model.Session.query(DataCache.id, DataCache.value) \
+                 .filter(key_filter)
+        if last_id is not None:
+            q = q.filter(DataCache.id > last_id)
+        rows = q.order_by(DataCache.id).limit(batch_size).all()
+        if not rows:
+            break
+        updates = []
+        for id_, value in rows:
+            stats['values'] += 1
+            stats['size_before'] += len(value or '')
+            new_value = compress_value(value) if value else value
+            stats['size_after'] += len(new_value or '')
+            if new_value != value:
+                stats['compressed'] += 1
+                updates.append({'_id': id_, '_value': new_value})
+        if updates:
+            model.Session.execute(
+                data_cache_table.update()
+                .where(data_cache_table.c.id == bindparam('_id'))
+                .values(value=bindparam('_value')),
+                updates)
+        model.Session.commit()
+        last_id = rows[-1][0]
+    log.info('Compressed %(compressed)s of %(values)s values: '
+             '%(size_before)s -> %(size_after)s characters', stats)
+    return stats
+
+
+def report_name_from_key(key):
+    '''Returns the name of the report that a DataCache key (as made by
+    Report.generate_key) is for - the part before the '?'. Keys with a '#' in
+    them (e.g. a report's watermark) are for keeping track of reports, rather
+    than being cached reports, so they have no report_name.'''
+    if '#' in key:
+        return None
+    return key.split('?', 1)[0]
+
+
+def _invalidate_memory_cache(object_id_keys):
+    from ckanext.report.cache import decoded_values
+    memory_cache = decoded_values()
+    if memory_cache:
+        for object_id, key in object_id_keys:
+            memory_cache.invalidate(object_id, key)
+
+
+def _batches(list_, size):
+    for i in xrange(0, len(list_), size):
+        yield list_[i:i+size]
+
+
+def count_organization_totals(organization_ids=None):
+    '''Returns a select of the totals of all the active organizations, or
+    just those with the given ids, counted in one grouped query, with the
+    columns of the organization_totals_table (apart from 'refreshed').'''
+    group = model.group_table
+    package = model.package_table
+    resource = model.resource_table
+    q = select([group.c.id.label('organization_id'),
+                group.c.name.label('organization_name'),
+                group.c.title.label('organization_title'),
+                func.count(package.c.id.distinct())
+                    .label('num_packages'),
+                func.count(case([(resource.c.id != None, package.c.id)])
+                           .distinct()).label('num_packages_with_resources'),
+                func.count(resource.c.id).label('num_resources')]) \
+        .select_from(
+            group.outerjoin(package, and_(package.c.owner_org == group.c.id,
+                                          package.c.state == 'active'))
+                 .outerjoin(resource, and_(resource.c.package_id == package.c.id,
+                                           resource.c.state == 'active'))) \
+        .where(group.c.is_organization == True) \
+        .where(group.c.state == 'active') \
+        .group_by(group.c.id, group.c.name, group.c.title)
+    if organization_ids is not None:
+        q = q.where(group.c.id.in_(list(organization_ids) or [None]))
+    return q
+
+
+def refresh_organization_totals(conn):
+    '''Recounts all the totals in the organization_totals_table, on the
+    given connection, which should be in a transaction of its own (see
+    lib.refresh_organization_totals).'''
+    totals = organization_totals_table
+    q = count_organization_totals()
+    q = q.column(literal(datetime.datetime.now(), types.DateTime))
+    conn.execute(totals.delete())
+    conn.execute(totals.insert(inline=True).from_select(
+        ['organization_id', 'organization_name', 'organization_title',
+         'num_packages', 'num_packages_with_resources', 'num_resources',
+         'refreshed'], q))
+    log.debug('Organization totals refreshed')
+
+
+def _delete_duplicates(conn):
+    '''Deletes all but the newest record of each (object_id, key) that has
+    more than one. The duplicates are found with GROUP BY, rather than a
+    window function, which older databases (e.g. SQLite before 3.25) don't
+    have, and there are usually few of them.'''
+    table = data_cache_table
+    object_id = func.coalesce(table.c.object_id, '')
+    duplicated = conn.execute(
+        select([object_id, table.c.key])
+        .group_by(object_id, table.c.key)
+        .having(func.count() > 1)).fetchall()
+    for duplicate_object_id, key in duplicated:
+        rows = conn.execute(
+            select([table.c.id, table.c.created])
+            .where(object_id == duplicate_object_id)
+            .where(table.c.key == key)).fetchall()
+        rows.sort(key=lambda row: (row.created is not None, row.created,
+                                   row.id), reverse=True)
+        old_ids = [row.id for row in rows[1:]]
+        conn.execute(table.delete().where(table.c.id.in_(old_ids)))
+        log.info('Deleted %s duplicate cache records of %s/%s',
+                 len(old_ids), duplicate_object_id or None, key)
+
+
+def _backfill_report_names(conn):
+    '''Sets the report_name of records that were stored before it existed
+    (see report_name_from_key).'''
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('''
+            UPDATE data_cache SET report_name = split_part(key, '?', 1)
+            WHERE report_name IS NULL AND key NOT LIKE '%#%'
+            '''))
+        return
+    table = data_cache_table
+    keys = [key for key, in conn.execute(
+        select([table.c.key.distinct()])
+        .where(table.c.report_name == None)
+        .where(~table.c.key.contains('#')))]
+    for key in keys:
+        conn.execute(table.update()
+                     .where(table.c.key == key)
+                     .values(report_name=report_name_from_key(key)))
+
+
+def _index_exists(conn, name):
+    '''Returns whether the database has an index with the given name.
+    (CREATE INDEX IF NOT EXISTS needs PostgreSQL 9.5.)'''
+    if conn.dialect.name == 'postgresql':
+        q = text("SELECT 1 FROM pg_class WHERE relname = :name "
+                 "AND relkind = 'i'")
+    else:
+        q = text("SELECT 1 FROM sqlite_master WHERE name = :name "
+                 "AND type = 'index'")
+    return conn.execute(q, name=name).scalar() is not None
+
+
+def _create_index(conn, name, sql):
+    '''Creates an index with the given CREATE INDEX statement, unless it
+    exists already.'''
+    if not _index_exists(conn, name):
+        conn.execute(text(sql))
+
+
 def init_tables():
     metadata.create_all(model.meta.engine)
+    migrate_tables()
+
+
+def migrate_tables():
+    '''Brings existing tables up to date with the current schema. Each step
+    is safe to run more than once.'''
+    with model.meta.engine.begin() as conn:
+        # (object_id, key) is made unique, so remove any duplicates, keeping
+        # the newest
+        _delete_duplicates(conn)
+        _create_index(conn, 'idx_data_cache_object_id_key_unique', '''
+            CREATE UNIQUE INDEX idx_data_cache_object_id_key_unique
+            ON data_cache (COALESCE(object_id, ''), key)
+            ''')
+        conn.execute(text('''
+            DROP INDEX IF EXISTS idx_data_cache_object_id_key
+            '''))
+        # report_name was added, to find a report's records by
+        if 'report_name' not in [column['name'] for column in
+                                 inspect(conn).get_columns('data_cache')]:
+            conn.execute(text('''
+                ALTER TABLE data_cache ADD COLUMN report_name TEXT
+                '''))
+        _create_index(conn, 'idx_data_cache_report_name', '''
+            CREATE INDEX idx_data_cache_report_name
+            ON data_cache (report_name)
+            ''')
+        _backfill_report_names(conn)
+    _create_broken_links_index(model.meta.engine)
+
+
+# The broken-links report looks for the error_code TaskStatuses of broken
+# links. The index only has those rows, and its condition must match the
+# report's (reports.broken_link_filter) for the planner to use it.
+BROKEN_LINKS_INDEX = 'idx_task_status_broken_links'
+BROKEN_LINKS_INDEX_WHERE = {
+    'postgresql': '''
+        key = 'error_code' AND value ~ '^[0-9]{3}$'
+        AND value BETWEEN '400' AND '600' AND value <> '511'
+        ''',
+    None: '''
+        key = 'error_code' AND length(value) = 3
+        AND substr(value, 2, 1) BETWEEN '0' AND '9'
+        AND substr(value, 3, 1) BETWEEN '0' AND '9'
+        AND value BETWEEN '400' AND '600' AND value <> '511'
+        ''',
+    }
+
+
+def _create_broken_links_index(engine):
+    '''Creates the partial index of broken links on task_status, unless it
+    exists already, and drops the one it replaces, whose condition let
+    through codes like '4xx'.
+
+    task_status can be large and is written to by other extensions all the
+    time, so on PostgreSQL the index is built CONCURRENTLY, which doesn't
+    block writes, but can't run in a transaction.'''
+    old_index = 'idx_task_status_broken_link'
+    if engine.dialect.name != 'postgresql':
+        with engine.begin() as conn:
+            _create_index(conn, BROKEN_LINKS_INDEX, '''
+                CREATE INDEX %s ON task_status (entity_id) WHERE %s
+                ''' % (BROKEN_LINKS_INDEX, BROKEN_LINKS_INDEX_WHERE[None]))
+            conn.execute(text('DROP INDEX IF EXISTS %s' % old_index))
+        return
+    conn = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        valid = conn.execute(text('''
+            SELECT pg_index.indisvalid FROM pg_index
+            JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+            WHERE pg_class.relname = :name
+            '''), name=BROKEN_LINKS_INDEX).scalar()
+        if valid is False:
+            # left behind by a concurrent build that failed
+            conn.execute(text('DROP INDEX %s' % BROKEN_LINKS_INDEX))
+        if not valid:
+            conn.execute(text('''
+                CREATE INDEX CONCURRENTLY %s ON task_status (entity_id)
+                WHERE %s
+                ''' % (BROKEN_LINKS_INDEX,
+                       BROKEN_LINKS_INDEX_WHERE['postgresql'])))
+        conn.execute(text('DROP INDEX IF EXISTS %s' % old_index))
+    finally:
+        conn.close()
@@ -31,6 +31,8 @@ class ReportPlugin(p.SingletonPlugin):
         from ckanext.report import helpers as h
         return {
             'report__relative_url_for': h.relative_url_for,
+            'report__sort_url': h.sort_url,
+            'report__sort_class': h.sort_class,
             'report__chunks': h.chunks,
             'report__organization_list': h.organization_list,
             'report__is_sysadmin': h.is_sysadmin,
@@ -1,16 +1,78 @@
 import logging
 import copy
+import datetime
 import re
+import threading
 
 from ckan import model
 from ckan.common import OrderedDict
 from ckanext.report.interfaces import IReport
+from ckanext.report import table
+from ckanext.report import lib
+from ckanext.report import lock
+from ckanext.report import stats
 
 log = logging.getLogger(__name__)
 
 REPORT_KEYS_REQUIRED = set(('name', 'generate', 'template', 'option_defaults',
                             'option_combinations'))
-REPORT_KEYS_OPTIONAL = set(('title', 'description'))
+# optional functions, which default to None
+REPORT_KEYS_OPTIONAL_FUNCTIONS = set(('generate_bulk', 'watermark',
+                                      'changed_option_combinations',
+                                      'summarize'))
+REPORT_KEYS_OPTIONAL = set(('title', 'description', 'paged')) | \
+                       REPORT_KEYS_OPTIONAL_FUNCTIONS
+
+# How many reports generated by a generate_bulk function to write to the
+# DataCache at a time
+CACHE_WRITE_BATCH_SIZE = 50
+
+# The age bands of cached reports counted by Report.cache_status
+CACHE_AGE_BANDS = ((datetime.timedelta(hours=1), '<1h'),
+                   (datetime.timedelta(days=1), '<1d'),
+                   (datetime.timedelta(days=7), '<7d'),
+                   (None, '>=7d'))
+
+# Keys of the reports being refreshed in background threads of this process
+_background_refreshes = set()
+_background_refreshes_lock = threading.Lock()
+
+
+def stale_while_revalidate():
+    '''Returns whether reports that are more than a day old should be served
+    while they are regenerated in the background, rather than regenerated
+    during the request. Config option:
+
+      ckanext-report.stale_while_revalidate = false
+    '''
+    from pylons import config
+    import ckan.plugins as p
+    return p.toolkit.asbool(
+        config.get('ckanext-report.stale_while_revalidate', False))
+
+
+def refresh_lock_timeout():
+    '''Returns how many seconds a request to refresh a report waits for
+    another request or process that is already refreshing it. Config option:
+
+      ckanext-report.refresh_lock_timeout = 30
+    '''
+    from pylons import config
+    return float(config.get('ckanext-report.refresh_lock_timeout', 30))
+
+
+def lazy_refresh_after():
+    '''Returns the timedelta after which a report/options that has not been
+    viewed is regarded as rarely viewed, or None if they are all treated
+    alike. Generation runs skip the rarely viewed ones until they are that
+    old - until then they are only regenerated when someone views them and
+    they are found to be stale. Config option (in days):
+
+      ckanext-report.lazy_refresh_after = 0
+    '''
+    from pylons import config
+    days = float(config.get('ckanext-report.lazy_refresh_after', 0))
+    return datetime.timedelta(days=days) if days else None
 
 
 class Report(object):
@@ -43,6 +105,10 @@ class Report(object):
                 self.title = re.sub('[_-]', ' ', self.name.capitalize())
             elif key == 'description':
                 self.description = ''
+            elif key == 'paged':
+                self.paged = False
+            elif key in REPORT_KEYS_OPTIONAL_FUNCTIONS:
+                setattr(self, key, None)
             else:
                 raise NotImplemented
 
@@ -72,40 +138,492 @@ class Report(object):
         else:
             return '%s' % self.name
 
+    def get_option_combinations(self):
+        '''Returns a list of all the option combinations to generate.'''
+        return list(self.option_combinations()) \
+               if self.option_combinations else [{}]
+
     def refresh_cache_for_all_options(self):
-        '''Generates the report for all the option combinations and caches them.'''
+        '''Generates the report for all the option combinations and caches them.
+
+        If the report has a generate_bulk function, that is used to generate
+        all the option combinations together, rather than one at a time,
+        and the results are written to the cache in batches. Otherwise each
+        one is written as soon as it is generated.
+
+        Only one process generates a report/option combination at a time - if
+        another is already generating it (or the whole report, with
+        generate_bulk), it is skipped.
+
+        Returns the keys of those skipped ('<name>#bulk' if the whole report
+        was).'''
         log.info('Report: %s %s', self.plugin, self.name)
-        option_combinations = list(self.option_combinations()) \
-                              if self.option_combinations else [{}]
-        for option_dict in option_combinations:
-            self.refresh_cache(option_dict)
+        with lib.generation_run():
+            if self.generate_bulk:
+                with lock.try_lock('%s#bulk' % self.name) as locked:
+                    if not locked:
+                        log.info('  report is already being generated - '
+                                 'skipped')
+                        return ['%s#bulk' % self.name]
+                    skipped = self._refresh_all_options()
+            else:
+                skipped = self._refresh_all_options()
         log.info('  report done')
+        return skipped
+
+    def _refresh_all_options(self):
+        watermark = self.watermark() if self.watermark else None
+        if self.generate_bulk:
+            skipped = self._save_results_to_cache(self.generate_bulk())
+        else:
+            skipped = self._refresh_each(self.get_option_combinations())
+        if self.watermark:
+            self._save_watermark(watermark)
+        return skipped
+
+    def refresh_cache_incremental(self):
+        '''Generates and caches the report for just the option combinations
+        whose data has changed since the last run, according to the report's
+        changed_option_combinations function. The report's summarize function
+        then produces the option combinations that summarize the others
+        (i.e. those without an organization etc.) from their cached data.
+
+        The report's watermark (e.g. the time of the latest change to the data
+        it uses) is saved at the end of each run, to be compared with on the
+        next run. If any option combination was skipped, because another
+        process was generating it, the watermark is left as it was, so that
+        the next run picks up the changes again. If the report does not
+        support incremental refreshes, or there has not been a run yet, all
+        the option combinations are generated.'''
+        if not (self.watermark and self.changed_option_combinations):
+            log.info('Report %s cannot be refreshed incrementally', self.name)
+            return self.refresh_cache_for_all_options()
+        since = self.get_watermark()
+        if since is None:
+            log.info('Report %s has no watermark yet', self.name)
+            return self.refresh_cache_for_all_options()
+
+        log.info('Report: %s %s (changes since %s)', self.plugin, self.name,
+                 since)
+        watermark = self.watermark()
+        changed = [option_dict
+                   for option_dict in self.changed_option_combinations(since)
+                   if not self.summarize or extract_entity_name(option_dict)]
+        log.info('  %s option combinations changed', len(changed))
+        with lib.generation_run():
+            skipped = self._refresh_each(changed)
+
+            if self.summarize:
+                skipped += self._refresh_summaries()
+        if skipped:
+            log.info('  %s option combinations skipped - the watermark is '
+                     'left at %s', len(skipped), since)
+        else:
+            self._save_watermark(watermark)
+        log.info('  report done')
+
+    def _refresh_summaries(self):
+        '''Regenerates the option combinations with no entity (e.g.
+        organization=None) with the report's summarize function, from the
+        cached data of the others. Their locks are held until they are saved
+        and committed.
+
+        Returns the keys of those skipped because another process was
+        already generating them.'''
+        from ckanext.report import model as report_model
+        option_combinations = self.get_option_combinations()
+        summary_options = [option_dict for option_dict in option_combinations
+                           if not extract_entity_name(option_dict)]
+        entity_options = [option_dict for option_dict in option_combinations
+                          if extract_entity_name(option_dict)]
+        keys = [(extract_entity_name(option_dict),
+                 self.generate_key(option_dict))
+                for option_dict in entity_options]
+        cached = report_model.DataCache.get_many(keys, convert_json=True)
+        results = [(option_dict, cached[key][0])
+                   for option_dict, key in zip(entity_options, keys)
+                   if cached[key][0] is not None]
+        skipped = []
+        with stats.measure() as measurement:
+            summary_data = self.summarize(results)
+        for option_dict in summary_options:
+            key = self.generate_key(option_dict,
+                                    defaults_for_missing_keys=False)
+            with lock.try_lock(key) as locked:
+                if not locked:
+                    log.info('  options: %r already being generated - '
+                             'skipped', option_dict)
+                    skipped.append(key)
+                    continue
+                self._save_to_cache([(option_dict, summary_data,
+                                      measurement)])
+                model.Session.commit()
+        return skipped
+
+    def _save_results_to_cache(self, results):
+        '''Saves an iterable of (option_dict, data) to the DataCache, in
+        batches, measuring the generation of each one.
+
+        Returns the keys of those skipped (see _save_batch).'''
+        skipped = []
+        for batch in _batches(_measure_each(results), CACHE_WRITE_BATCH_SIZE):
+            skipped += self._save_batch(batch)
+        return skipped
 
-    def refresh_cache(self, option_dict):
+    def _save_batch(self, batch):
+        '''Saves a batch of (option_dict, data, measurement) to the DataCache
+        and commits, holding the lock of each one's key meanwhile. Ones that
+        another process is generating (e.g. for a request, see
+        refresh_cache) are left for it to save.
+
+        Returns the keys of the ones that were skipped.'''
+        keys = [self.generate_key(option_dict,
+                                  defaults_for_missing_keys=False)
+                for option_dict, data, measurement in batch]
+        with lock.try_lock_many(keys) as locked_keys:
+            locked_keys = set(locked_keys)
+            to_save = [result for result, key in zip(batch, keys)
+                       if key in locked_keys]
+            if to_save:
+                self._save_to_cache(to_save)
+                model.Session.commit()
+        skipped = [key for key in keys if key not in locked_keys]
+        for key in skipped:
+            log.info('  %s already being generated - skipped', key)
+        return skipped
+
+    def _watermark_key(self):
+        return '%s#watermark' % self.name
+
+    def get_watermark(self):
+        '''Returns the watermark saved by the last run of the report, or
+        None.'''
+        from ckanext.report import model as report_model
+        watermark, date = report_model.DataCache.get(
+            None, self._watermark_key(), convert_json=True)
+        return watermark
+
+    def _save_watermark(self, watermark):
+        from ckanext.report import model as report_model
+        log.info('  watermark: %s', watermark)
+        report_model.DataCache.set_many(
+            [(None, self._watermark_key(), watermark)], convert_json=True)
+        model.Session.commit()
+
+    def _refresh_each(self, option_combinations):
+        '''Generates and caches the report for each of the option
+        combinations in turn. Each one's lock is held until it is saved and
+        committed, so a request waiting for it (see refresh_cache) finds it
+        in the cache rather than generating it again. Ones that another
+        process is already generating are skipped.
+
+        Returns the keys of the ones that were skipped.'''
+        skipped = []
+        for option_dict in option_combinations:
+            key = self.generate_key(option_dict,
+                                    defaults_for_missing_keys=False)
+            with lock.try_lock(key) as locked:
+                if not locked:
+                    log.info('  options: %r already being generated - '
+                             'skipped', option_dict)
+                    skipped.append(key)
+                    continue
+                self._generate_and_save(option_dict)
+        return skipped
+
+    def refresh_cache(self, option_dict, timeout=None):
         '''Generates a report for the given options and caches it.
 
+        Only one request or process generates the report for a key at a time.
+        If another is already generating it, this waits for it to finish (up
+        to timeout seconds, which defaults to the refresh_lock_timeout config)
+        and returns the report it generated. If it doesn't finish in time, the
+        previously cached report is returned, or if there isn't one, the
+        report is generated anyway. Likewise, while the whole report is being
+        generated with generate_bulk, the previously cached report is
+        returned, if there is one.
+
         Returns (data, date)
         '''
         from ckanext.report import model as report_model
+        entity_name = extract_entity_name(option_dict)
+        key = self.generate_key(option_dict)
+        if self.generate_bulk and lock.is_locked('%s#bulk' % self.name):
+            data, date = report_model.DataCache.get(entity_name, key,
+                                                    convert_json=True)
+            if data is not None:
+                log.info('  options: %r being refreshed with the whole '
+                         'report', option_dict)
+                return data, date
+        if timeout is None:
+            timeout = refresh_lock_timeout()
+        started = datetime.datetime.now()
+        with lock.acquire(key, timeout=timeout) as locked:
+            if locked:
+                waited = datetime.datetime.now() - started
+                if waited >= datetime.timedelta(seconds=lock.POLL_INTERVAL):
+                    # it may have been refreshed while waiting for the lock
+                    data, date = report_model.DataCache.get(
+                        entity_name, key, convert_json=True, max_age=waited)
+                    if data is not None:
+                        log.info('  options: %r refreshed by another process',
+                                 option_dict)
+                        return data, date
+                return self._generate_and_save(option_dict)
+        log.info('  options: %r still being refreshed by another process',
+                 option_dict)
+        data, date = report_model.DataCache.get(entity_name, key,
+                                                convert_json=True)
+        if data is not None:
+            return data, date
+        log.warning('Timed out waiting for report %s to be refreshed - '
+                    'generating it anyway', key)
+        return self._generate_and_save(option_dict)
+
+    def _generate_and_save(self, option_dict):
         log.info('  options: %r', option_dict)
-        data = self.generate(**option_dict)
-        # option_combinations should specify every key, so mustn't allow
-        # default values
-        key = self.generate_key(option_dict, defaults_for_missing_keys=False)
-        date = report_model.DataCache.set(extract_entity_name(option_dict),
-                                          key, data, convert_json=True)
+        with stats.measure() as measurement:
+            data = self.generate(**option_dict)
+        date = self._save_to_cache([(option_dict, data, measurement)])
         model.Session.commit()
         return data, date
 
+    def _save_to_cache(self, results):
+        '''Saves a list of (option_dict, data, measurement) to the DataCache
+        (without committing), and the measurements of their generation to
+        DataCacheStats. Tables are stored in columnar form.
+
+        Returns the date they were saved.
+        '''
+        from ckanext.report import model as report_model
+        items = []
+        stats_items = []
+        for option_dict, data, measurement in results:
+            entity_name = extract_entity_name(option_dict)
+            # option_combinations should specify every key, so mustn't allow
+            # default values
+            key = self.generate_key(option_dict,
+                                    defaults_for_missing_keys=False)
+            value = report_model.encode_json(table.to_columnar(data))
+            items.append((entity_name, key, value))
+            if measurement:
+                report_stats = measurement.as_dict()
+                report_stats['num_rows'] = table.num_rows(data)
+                report_stats['size'] = len(value)
+                log.info('  options: %r took %.1fs (%.1fs CPU), %s queries, '
+                         '%s rows, %s bytes', option_dict,
+                         report_stats['wall_time'], report_stats['cpu_time'],
+                         report_stats['num_queries'],
+                         report_stats['num_rows'], report_stats['size'])
+                stats_items.append((entity_name, key, self.name,
+                                    report_stats))
+        date = report_model.DataCache.set_many(items)
+        report_model.DataCacheStats.set_many(stats_items, date)
+        return date
+
     def get_fresh_report(self, **option_dict):
+        '''Returns the report data (from the cache, unless it is missing or
+        more than a day old) and the date it was generated. Any table that
+        was cached in columnar form is returned as a table.Table, so it
+        mustn't be altered.'''
+        data, date, refreshing = self.get_fresh_or_stale_report(**option_dict)
+        return data, date
+
+    def get_fresh_or_stale_report(self, **option_dict):
+        '''Like get_fresh_report, but if stale-while-revalidate is configured
+        and the cached report is more than a day old, the old report is
+        returned straight away and it is regenerated in the background.
+
+        Returns (data, date, refreshing) where refreshing says whether it is
+        being regenerated in the background.
+        '''
         from ckanext.report import model as report_model
         entity_name = extract_entity_name(option_dict)
         key = self.generate_key(option_dict)
-        data, date = report_model.DataCache.get_if_fresh(
+        if stale_while_revalidate():
+            data, date = report_model.DataCache.get(
                 entity_name, key, convert_json=True)
+            if data is not None and \
+                    datetime.datetime.now() - date > report_model.FRESH_MAX_AGE:
+                self.refresh_cache_in_background(option_dict)
+                return table.from_columnar(data), date, True
+        else:
+            data, date = report_model.DataCache.get_if_fresh(
+                    entity_name, key, convert_json=True)
         if data is None:
             data, date = self.refresh_cache(option_dict)
-        return data, date
+            # in the same form as it is read from the cache
+            data = table.to_columnar(data)
+        return table.from_columnar(data), date, False
+
+    def refresh_cache_in_background(self, option_dict):
+        '''Regenerates the report for the given options in a background
+        thread. Only one regeneration runs for each key - if one is already
+        running (in any process), this does nothing.'''
+        key = self.generate_key(option_dict)
+        with _background_refreshes_lock:
+            if key in _background_refreshes:
+                return
+            _background_refreshes.add(key)
+        thread = threading.Thread(target=self._refresh_cache_in_thread,
+                                  args=(dict(option_dict), key))
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_cache_in_thread(self, option_dict, key):
+        try:
+            # if it is already being refreshed, leave it to that
+            self.refresh_cache(option_dict, timeout=0)
+        except Exception:
+            log.exception('Background refresh of report %s failed', key)
+            model.Session.rollback()
+        finally:
+            model.Session.remove()
+            with _background_refreshes_lock:
+                _background_refreshes.discard(key)
+
+    def cache_status(self, option_combinations=None):
+        '''Returns how much of the report is cached, from one query of the
+        DataCache, as a dict:
+
+          num_combinations - number of option combinations
+          num_cached - number of those that are cached
+          coverage - the fraction of them that are cached
+          num_fresh - number cached less than a day ago
+          ages - dict of age band ('<1h', '<1d', '<7d', '>=7d'): number
+                 cached
+          oldest_date, newest_date - of the cached ones
+          missing - keys of the option combinations that are not cached
+          stale - keys of those cached more than a day ago
+          orphaned - keys cached that are not (or no longer) option
+                     combinations
+
+        option_combinations defaults to all the report's.
+        '''
+        status, options_by_key = self._cache_status(option_combinations)
+        return status
+
+    def get_stale_option_combinations(self):
+        '''Returns the option combinations that are not cached, or were cached
+        more than a day ago.'''
+        status, options_by_key = self._cache_status()
+        return [options_by_key[key]
+                for key in status['missing'] + status['stale']]
+
+    def _cache_status(self, option_combinations=None):
+        from ckanext.report import model as report_model
+        if option_combinations is None:
+            option_combinations = self.get_option_combinations()
+        options_by_key = OrderedDict(
+            (self.generate_key(option_dict, defaults_for_missing_keys=False),
+             option_dict)
+            for option_dict in option_combinations)
+        cached = dict((key, created) for object_id, key, created in
+                      report_model.DataCache.get_all_metadata(self.name))
+        now = datetime.datetime.now()
+        ages = OrderedDict((band, 0) for limit, band in CACHE_AGE_BANDS)
+        missing = []
+        stale = []
+        for key in options_by_key:
+            created = cached.get(key)
+            if created is None:
+                missing.append(key)
+                continue
+            age = now - created
+            if age > report_model.FRESH_MAX_AGE:
+                stale.append(key)
+            for limit, band in CACHE_AGE_BANDS:
+                if limit is None or age < limit:
+                    ages[band] += 1
+                    break
+        cached_dates = [cached[key] for key in options_by_key
+                        if key in cached]
+        num_combinations = len(options_by_key)
+        num_cached = len(cached_dates)
+        status = OrderedDict((
+            ('report_name', self.name),
+            ('num_combinations', num_combinations),
+            ('num_cached', num_cached),
+            ('coverage', float(num_cached) / num_combinations
+                         if num_combinations else 1.0),
+            ('num_fresh', num_cached - len(stale)),
+            ('ages', ages),
+            ('oldest_date', min(cached_dates) if cached_dates else None),
+            ('newest_date', max(cached_dates) if cached_dates else None),
+            ('missing', missing),
+            ('stale', stale),
+            ('orphaned', sorted(key for key in cached
+                                if key not in options_by_key)),
+            ))
+        return status, options_by_key
+
+    def garbage_collect(self):
+        '''Deletes the report's cached records for options that are no longer
+        in its option_combinations (e.g. of organizations that have been
+        deleted), in batches. The report's watermark is kept.
+
+        Returns the number of records deleted.
+        '''
+        from ckanext.report import model as report_model
+        orphaned = [key for key in self.cache_status()['orphaned']
+                    if '#' not in key]
+        if not orphaned:
+            return 0
+        log.info('Report %s: deleting %s orphaned cache keys', self.name,
+                 len(orphaned))
+        return report_model.DataCache.delete_keys(self.name, orphaned)
+
+    def refresh_cache_for_options(self, option_combinations):
+        '''Generates and caches the report for just the given option
+        combinations, one at a time (even if the report has generate_bulk).
+        The watermark is not updated, as not everything is regenerated.
+
+        Returns the keys of those skipped because another process was
+        already generating them.'''
+        log.info('Report: %s %s (%s option combinations)', self.plugin,
+                 self.name, len(option_combinations))
+        with lib.generation_run():
+            skipped = self._refresh_each(option_combinations)
+        log.info('  report done')
+        return skipped
+
+    def refresh_cache_with_checkpoints(self, checkpoint, deadline=None):
+        '''Generates and caches the report for all the option combinations
+        with its generate_bulk function, like refresh_cache_for_all_options,
+        but calls checkpoint(key) for each option combination once it is
+        saved and committed, so that a run that stops part way through knows
+        which ones are done. With a deadline (a datetime), it stops after
+        the batch being saved when the deadline is reached.
+
+        Returns 'done', 'stopped' (at the deadline) or 'skipped' (if another
+        process is already generating the report).'''
+        log.info('Report: %s %s', self.plugin, self.name)
+        with lib.generation_run():
+            with lock.try_lock('%s#bulk' % self.name) as locked:
+                if not locked:
+                    log.info('  report is already being generated - skipped')
+                    return 'skipped'
+                watermark = self.watermark() if self.watermark else None
+                results = self.generate_bulk()
+                try:
+                    for batch in _batches(_measure_each(results),
+                                          CACHE_WRITE_BATCH_SIZE):
+                        skipped = self._save_batch(batch)
+                        for option_dict, data, measurement in batch:
+                            key = self.generate_key(
+                                option_dict, defaults_for_missing_keys=False)
+                            if key not in skipped:
+                                checkpoint(key)
+                        if deadline and datetime.datetime.now() >= deadline:
+                            log.info('  deadline reached - stopping')
+                            return 'stopped'
+                finally:
+                    if hasattr(results, 'close'):
+                        results.close()
+                if self.watermark:
+                    self._save_watermark(watermark)
+        log.info('  report done')
+        return 'done'
 
     def get_cached_date(self, **option_dict):
         from ckanext.report import model as report_model
@@ -113,8 +631,7 @@ class Report(object):
             option_dict = self.option_defaults
         entity_name = extract_entity_name(option_dict)
         key = self.generate_key(option_dict)
-        data, date = report_model.DataCache.get(entity_name, key)
-        return date
+        return report_model.DataCache.get_created(entity_name, key)
 
     def get_template(self):
         return self.template
@@ -125,6 +642,32 @@ class Report(object):
         return defaulted_options
 
 
+def _measure_each(results):
+    '''Wraps an iterable of (option_dict, data), yielding (option_dict, data,
+    measurement), where the measurement is of producing that item. For a
+    generator, that is the generation of that report.'''
+    results = iter(results)
+    while True:
+        with stats.measure() as measurement:
+            try:
+                option_dict, data = next(results)
+            except StopIteration:
+                return
+        yield option_dict, data, measurement
+
+
+def _batches(iterable, size):
+    '''Splits up an iterable into lists of up to the given size.'''
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def extract_entity_name(option_dict):
     '''Hunts for an option key that is the entity name and returns its
     value. Used in the DataCache storage.'''
@@ -168,10 +711,309 @@ class ReportRegistry(object):
     def get_report(self, report_name):
         return self._reports[report_name]
 
+    def get_metadata(self):
+        '''Returns a summary of what is cached for every report, loaded in two
+        queries (one grouped by report, and one of the reports with their
+        default options), however many reports and option combinations there
+        are.
+
+        Returns a dict of report name: dict with keys:
+          cached_date - when the report with the default options was
+                        generated (or None)
+          oldest_date, newest_date - of all its cached option combinations
+          num_cached - number of option combinations cached
+          size - total size of its cached values (as stored)
+        '''
+        from ckanext.report import model as report_model
+        summaries = report_model.DataCache.get_report_summaries()
+        default_keys = dict((name, report.generate_key(report.option_defaults))
+                            for name, report in self._reports.items())
+        cached_dates = report_model.DataCache.get_created_for_keys(
+            default_keys.values())
+        metadata = {}
+        for name in self._reports:
+            num_cached, oldest_date, newest_date, size = \
+                summaries.get(name, (0, None, None, 0))
+            metadata[name] = {
+                'cached_date': cached_dates.get(default_keys[name]),
+                'oldest_date': oldest_date,
+                'newest_date': newest_date,
+                'num_cached': num_cached,
+                'size': int(size or 0),
+                }
+        return metadata
+
     def refresh_cache_for_all_reports(self):
         '''Generates all the reports for all the option combinations and caches them.'''
-        for report in self._reports.values():
-            report.refresh_cache_for_all_options()
+        with lib.generation_run():
+            for report in self._reports.values():
+                report.refresh_cache_for_all_options()
+
+    def refresh_cache_in_run(self, report_names=None, deadline=None,
+                             resume=False, only_stale=False):
+        '''Generates the given reports (all of them if not specified) and
+        caches them, as a run that records its progress, so that:
+
+        * a report/options that fails is recorded, and the run carries on
+        * with a deadline (a datetime), the run stops when it is reached,
+          after the report/options in progress (or for a report with
+          generate_bulk, after the batch of options being saved)
+        * with resume, the latest run (of the same reports) that didn't
+          complete is continued, skipping what it has done already
+        * a report/options that another process was generating is recorded
+          as skipped, and the run doesn't count as complete, so that it is
+          done when the run is resumed
+
+        The option combinations are done in order of priority (see
+        _run_items), so that if a run doesn't get through them all, it is
+        the least viewed and freshest that are left for the next one. A
+        report with generate_bulk is done all at once (unless
+        only_stale, in which case only its missing or stale options are
+        done), recording each option as it is saved. If the run stopped part
+        way through it, the rest of its options are done one at a time when
+        the run is resumed.
+
+        Returns (run, failures, complete) where failures is a list of
+        (report_name, key, error_message) and complete says whether it got
+        through everything.
+        '''
+        from ckanext.report import model as report_model
+        run = None
+        if resume:
+            run = report_model.GenerationRun.latest_unfinished(report_names)
+            if run:
+                log.info('Resuming generation run %s from %s', run.id,
+                         run.started)
+            else:
+                log.info('No unfinished generation run to resume')
+        if not run:
+            run = report_model.GenerationRun.start(report_names)
+        done_keys = run.done_keys()
+
+        with lib.generation_run():
+            items = self._items_to_do(
+                self._run_items(report_names, only_stale), done_keys)
+            log.info('Generation run %s: %s report/options to do, %s done '
+                     'already', run.id, len(items), len(done_keys))
+            complete = True
+            num_skipped = 0
+            for report, option_dict, key in items:
+                if deadline and datetime.datetime.now() >= deadline:
+                    log.info('Deadline reached - stopping the run')
+                    complete = False
+                    break
+                error = None
+                skipped = False
+                try:
+                    if option_dict is None:
+                        outcome = report.refresh_cache_with_checkpoints(
+                            lambda done_key: run.record(report.name,
+                                                        done_key),
+                            deadline=deadline)
+                        if outcome == 'stopped':
+                            log.info('Deadline reached - stopping the run')
+                            complete = False
+                            break
+                        skipped = outcome == 'skipped'
+                    else:
+                        skipped = bool(
+                            report.refresh_cache_for_options([option_dict]))
+                except Exception, e:
+                    log.exception('Report %s failed for options %r',
+                                  report.name, option_dict)
+                    model.Session.rollback()
+                    error = '%s: %s' % (e.__class__.__name__, e)
+                if skipped:
+                    num_skipped += 1
+                run.record(report.name, key, error, skipped=skipped)
+            if num_skipped:
+                log.info('%s report/options were being generated by another '
+                         'process and were skipped - they will be done when '
+                         'the run is resumed', num_skipped)
+                complete = False
+
+        failures = run.failures()
+        run.finish(report_model.GenerationRun.COMPLETE if complete
+                   else report_model.GenerationRun.STOPPED)
+        log.info('Generation run %s %s, %s failed', run.id,
+                 'complete' if complete else 'stopped', len(failures))
+        return run, failures, complete
+
+    def _items_to_do(self, items, done_keys):
+        '''Returns the run items (see _run_items) that are not done yet. A
+        report with generate_bulk that some of the options of are done (as
+        the run stopped part way through it) is split up into its options
+        that are not done, to do one at a time.'''
+        from ckanext.report import model as report_model
+        done_report_names = set(report_model.report_name_from_key(key)
+                                for key in done_keys)
+        to_do = []
+        for report, option_dict, key in items:
+            if key in done_keys:
+                continue
+            if option_dict is None and report.name in done_report_names:
+                for option_dict in report.get_option_combinations():
+                    key = report.generate_key(option_dict,
+                                              defaults_for_missing_keys=False)
+                    if key not in done_keys:
+                        to_do.append((report, option_dict, key))
+                continue
+            to_do.append((report, option_dict, key))
+        return to_do
+
+    def _run_items(self, report_names=None, only_stale=False):
+        '''Returns (report, option_dict, key) of what a run is to generate,
+        in order of priority: the missing ones first (the most viewed of
+        them first), then by how stale they are multiplied by how often
+        they are viewed, so the popular ones are kept fresh. option_dict is
+        None for a whole report with generate_bulk, which counts the views
+        of all its options and is as old as its oldest.
+
+        If lazy_refresh_after is configured, the cached options that have
+        not been viewed in that time, and were cached since then, are left
+        out.'''
+        from ckanext.report import model as report_model
+        if report_names:
+            reports = [self.get_report(name) for name in report_names]
+        else:
+            reports = self.get_reports()
+        now = datetime.datetime.now()
+        lazy_after = lazy_refresh_after()
+        items = []
+        num_lazy = 0
+        for report in reports:
+            cached = dict(
+                (key, created) for object_id, key, created in
+                report_model.DataCache.get_all_metadata(report.name))
+            views = report_model.DataCacheAccess.get_views(report.name)
+            if report.generate_bulk and not only_stale:
+                oldest = min(cached.values()) if cached else None
+                num_views = sum(num_views for num_views, last_viewed
+                                in views.values())
+                items.append((_priority(oldest, num_views, now), report,
+                              None, '%s#bulk' % report.name))
+                continue
+            if only_stale:
+                option_combinations = report.get_stale_option_combinations()
+            else:
+                option_combinations = report.get_option_combinations()
+            for option_dict in option_combinations:
+                key = report.generate_key(option_dict,
+                                          defaults_for_missing_keys=False)
+                created = cached.get(key)
+                num_views, last_viewed = views.get(key, (0, None))
+                if lazy_after and created and now - created < lazy_after \
+                        and (last_viewed is None or
+                             now - last_viewed >= lazy_after):
+                    num_lazy += 1
+                    continue
+                items.append((_priority(created, num_views, now), report,
+                              option_dict, key))
+        if num_lazy:
+            log.info('Leaving %s rarely viewed report/options to be '
+                     'refreshed when viewed', num_lazy)
+        items.sort(key=lambda item: item[0])
+        return [item[1:] for item in items]
+
+    def refresh_cache_in_parallel(self, report_names=None, workers=2,
+                                  only_stale=False):
+        '''Generates the given reports (all of them if not specified) for all
+        their option combinations and caches them, spreading the (report,
+        option_dict) jobs across a pool of worker processes. A report with
+        generate_bulk is a single job.
+
+        If only_stale, only the option combinations that are not cached, or
+        were cached more than a day ago, are generated (each as a job).
+
+        The jobs are started in order of priority, and rarely viewed ones
+        may be left out (see _run_items).
+
+        As in a serial run, a report/options that another process is already
+        generating is skipped.
+
+        A job that fails is logged and the run continues. Returns (failures,
+        skipped) where failures is a list of (report_name, option_dict,
+        error_message) for the failed jobs and skipped is a list of the keys
+        that were skipped.
+        '''
+        import multiprocessing
+        jobs = [(report.name, option_dict) for report, option_dict, key
+                in self._run_items(report_names, only_stale)]
+        log.info('Generating %s report/option combinations with %s workers',
+                 len(jobs), workers)
+
+        # The totals are counted once for the run, not in every job
+        lib.refresh_organization_totals()
+
+        # The workers are forked, so make sure they don't inherit this
+        # process's connections
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        failures = []
+        skipped = []
+        pool = multiprocessing.Pool(workers, initializer=_init_worker)
+        try:
+            for report_name, option_dict, error, job_skipped in \
+                    pool.imap_unordered(_refresh_cache_job, jobs):
+                if error:
+                    failures.append((report_name, option_dict, error))
+                skipped += job_skipped
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        log.info('Generated %s report/option combinations, %s failed, %s '
+                 'skipped', len(jobs), len(failures), len(skipped))
+        return failures, skipped
+
+
+def _priority(created, num_views, now):
+    '''Returns the sort key of a report/options in a run, given when it was
+    cached (None if it isn't) and how many times it has been viewed.'''
+    if created is None:
+        return (0, -num_views)
+    age = (now - created).total_seconds()
+    return (1, -age * (1 + num_views))
+
+
+def _init_worker():
+    '''Runs at the start of each worker process. It gets its own engine
+    connections and session, rather than sharing the parent's.'''
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+
+def _refresh_cache_job(job):
+    '''Generates and caches one report/option combination, in a worker
+    process. An option_dict of None means all the option combinations, for a
+    report with generate_bulk. Like a serial run, it skips those that another
+    process is already generating (see Report._refresh_each).
+
+    Returns (report_name, option_dict, error_message, skipped), where
+    error_message is None if it succeeded and skipped is a list of the keys
+    skipped.'''
+    report_name, option_dict = job
+    error = None
+    skipped = []
+    try:
+        report = ReportRegistry.instance().get_report(report_name)
+        # the parent process refreshed the totals for the run
+        with lib.generation_run(refresh_totals=False):
+            if option_dict is None:
+                skipped = report.refresh_cache_for_all_options()
+            else:
+                skipped = report._refresh_each([option_dict])
+    except Exception, e:
+        log.exception('Report %s failed for options %r', report_name,
+                      option_dict)
+        model.Session.rollback()
+        error = '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        model.Session.remove()
+    return report_name, option_dict, error, skipped
 
 
 #    'name': 'feedback-report',
@@ -7,89 +7,119 @@ from ckan.lib.helpers import OrderedDict
 from ckanext.report import lib
 from sqlalchemy import func
 from sqlalchemy import or_
-from sqlalchemy import between
-from sqlalchemy import cast, Numeric
+from sqlalchemy import and_
+from sqlalchemy import case
+from sqlalchemy.orm import aliased
 import collections
+import itertools
 
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 
 
+# Maximum number of the tagless datasets listed in the tagless report
+TAGLESS_SAMPLE_SIZE = 100
+
+
 def tagless_report(organization, include_sub_organizations=False):
     '''
     Produces a report on packages without tags.
     Returns something like this:
         {
          'table': [
-            {'name': 'river-levels', 'title': 'River levels', 'notes': 'Harvested', 'user': 'bob', 'created': '2008-06-13T10:24:59.435631'},
-            {'name': 'co2-monthly', 'title' 'CO2 monthly', 'notes': '', 'user': 'bob', 'created': '2009-12-14T08:42:45.473827'},
+            {'name': 'river-levels', 'title': 'River levels', 'notes': 'Harvested', 'user': 'bob', 'created': datetime(2008, 6, 13, 10, 24, 59, 435631)},
+            {'name': 'co2-monthly', 'title' 'CO2 monthly', 'notes': '', 'user': 'bob', 'created': datetime(2009, 12, 14, 8, 42, 45, 473827)},
             ],
          'num_packages': 56,
+         'num_tagless_packages': 2,
          'packages_without_tags_percent': 4,
          'average_tags_per_package': 3.5,
         }
+    The table lists up to TAGLESS_SAMPLE_SIZE of the packages without tags.
     '''
-    # Find the packages without tags
+    # Count the packages, tagless packages and taggings in one query, over
+    # the number of tags of each package
+    q = model.Session.query(model.Package.id.label('package_id'),
+                            func.count(model.PackageTag.id).label('num_tags')) \
+             .outerjoin(model.PackageTag) \
+             .group_by(model.Package.id)
+    q = lib.filter_by_organizations(q, organization, include_sub_organizations)
+    tag_counts = q.subquery()
+    num_packages, num_tagless_packages, num_taggings = model.Session.query(
+        func.count(tag_counts.c.package_id),
+        func.sum(case([(tag_counts.c.num_tags == 0, 1)], else_=0)),
+        func.sum(tag_counts.c.num_tags)).one()
+    num_tagless_packages = int(num_tagless_packages or 0)
+    num_taggings = int(num_taggings or 0)
+    if num_packages:
+        average_tags_per_package = round(float(num_taggings) / num_packages, 1)
+    else:
+        average_tags_per_package = None
+    packages_without_tags_percent = lib.percent(num_tagless_packages,
+                                                num_packages)
+
+    # A sample of the packages without tags
     q = model.Session.query(model.Package) \
              .outerjoin(model.PackageTag) \
              .filter(model.PackageTag.id == None)
-    '''if organization:
-        q = lib.filter_by_organizations(q, organization,
-                                        include_sub_organizations)'''
+    q = lib.filter_by_organizations(q, organization, include_sub_organizations)
     tagless_pkgs = [OrderedDict((
             ('name', pkg.name),
             ('title', pkg.title),
             ('notes', lib.dataset_notes(pkg)),
-            ('created', pkg.metadata_created.isoformat()),
-            )) for pkg in q.slice(0,5)]
-
-    # Average number of tags per package
-    q = model.Session.query(model.Package)
-    q = lib.filter_by_organizations(q, organization, include_sub_organizations)
-    num_packages = q.count()
-    q = q.join(model.PackageTag)
-    num_taggings = q.count()
-    if num_packages:
-        average_tags_per_package = round(float(num_taggings) / num_packages, 1)
-    else:
-        average_tags_per_package = None
-    packages_without_tags_percent = lib.percent(len(tagless_pkgs), num_packages)
+            ('created', pkg.metadata_created),
+            )) for pkg in q.order_by(model.Package.name)
+                           .limit(TAGLESS_SAMPLE_SIZE)]
 
     return {
         'table': tagless_pkgs,
         'num_packages': num_packages,
-        'packages_without_tags_percent': packages_without_tags_percent,
-        'num_packages': num_packages,
+        'num_tagless_packages': num_tagless_packages,
         'packages_without_tags_percent': packages_without_tags_percent,
         'average_tags_per_package': average_tags_per_package,
         }
 
 
+# Column order of the broken-links tables - the index of organizations and
+# the report for one organization
+BROKEN_LINK_SUMMARY_ORDER = {'organization_name': 1, 'organization_title' : 2, 'broken_package_count' : 3, 'broken_resource_count' : 4, 'broken_resource_percent' : 5, 'package_count' : 6, 'broken_package_percent' : 7}
+BROKEN_LINK_ORGANIZATION_ORDER = {'dataset_name':1, 'dataset_title':2, 'resource_id':3, 'resource_position':4, 'resource_url':5, 'reason':6, 'failure_count':7}
+
+# The TaskStatus keys that the broken-links report is generated from
+BROKEN_LINK_TASK_STATUS_KEYS = ('error_code', 'openness_score_failure_count',
+                                'openness_score_reason')
+
+
+def broken_link_filter(task_status=None):
+    '''Returns the filter for the TaskStatuses that show a resource's link is
+    broken - an error_code from 400 to 600, except 511. The codes are
+    compared as strings of 3 digits, rather than cast to numbers, so that
+    it can use the partial index on task_status, which has the same
+    condition (see ckanext.report.model.BROKEN_LINKS_INDEX_WHERE), and isn't
+    upset by non-numeric values.'''
+    if task_status is None:
+        task_status = model.TaskStatus
+    value = task_status.value
+    if model.meta.engine.dialect.name == 'postgresql':
+        three_digits = value.op('~')('^[0-9]{3}$')
+    else:
+        three_digits = and_(func.length(value) == 3,
+                            func.substr(value, 2, 1).between('0', '9'),
+                            func.substr(value, 3, 1).between('0', '9'))
+    return and_(task_status.key == 'error_code',
+                three_digits,
+                value.between('400', '600'),
+                value != '511')
+
+
 def broken_link_report(organization, include_sub_organizations=False):
     
     if not organization:
-        grp_totals = {}
-
-        sql = model.Session.query(model.Group.name, func.count(model.Package.id.distinct()).label('total_grp_pkg_count'), \
-               func.count(model.Resource.id.distinct()).label('total_grp_res_cnt')) \
-               .join(model.Package, model.Group.id == model.Package.owner_org) \
-               .join(model.Resource, model.Resource.package_id == model.Package.id) \
-               .filter(model.Group.is_organization == True) \
-               .filter(model.Package.state == 'active') \
-               .filter(model.Resource.state == 'active') \
-               .filter(model.Group.state == 'active') \
-               .group_by(model.Group.name)
-
-        pp.pprint(sql)
-
-        for row in sql:
-            grp_totals[row.name] =  OrderedDict((
-                                            ('total_grp_pkg_count', row.total_grp_pkg_count),
-                                            ('total_grp_res_cnt', row.total_grp_res_cnt),
-                                       ))
+        # Totals of packages and resources of each organization
+        grp_totals = lib.organization_totals()
 
         broken_links = []
-        order = {'organization_name': 1, 'organization_title' : 2, 'broken_package_count' : 3, 'broken_resource_count' : 4, 'broken_resource_percent' : 5, 'package_count' : 6, 'broken_package_percent' : 7}
+        order = BROKEN_LINK_SUMMARY_ORDER
         
         q = model.Session.query(model.Group.name.label('grp_name'), model.Group.title.label('grp_title'),  \
                   func.count(model.Package.name.distinct()).label('dataset_cnt'), \
@@ -98,113 +128,228 @@ def broken_link_report(organization, include_sub_organizations=False):
                  .join(model.Resource, model.Resource.package_id == model.Package.id) \
                  .join(model.TaskStatus, model.TaskStatus.entity_id == model.Resource.id) \
                  .filter(model.Group.is_organization == True) \
-                 .filter(between(cast(model.TaskStatus.value, Numeric(3)), 400, 600)) \
-                 .filter(cast(model.TaskStatus.value, Numeric(3)) != 511) \
-                 .filter(model.TaskStatus.key == 'error_code' )\
+                 .filter(broken_link_filter()) \
                  .filter(model.Package.state == 'active') \
                  .filter(model.Resource.state == 'active') \
                  .filter(model.Group.state == 'active') \
                  .group_by(model.Group.name, model.Group.title) \
                  .order_by(model.Group.title)
 
-        for row in q:
-
+        for row in lib.stream_query(q):
+          totals = grp_totals.get(row.grp_name, {})
           broken_links.append(OrderedDict((
                    ('organization_name', row.grp_name),
                    ('organization_title', row.grp_title),
                    ('broken_package_count', row.dataset_cnt),
                    ('broken_resource_count', row.broken_link_cnt),
-                   ('broken_resource_percent', lib.percent(row.broken_link_cnt, grp_totals[row.grp_name]['total_grp_res_cnt'])),
-                   ('package_count', grp_totals[row.grp_name]['total_grp_pkg_count']),
-                   ('broken_package_percent', lib.percent(row.dataset_cnt, grp_totals[row.grp_name]['total_grp_pkg_count'])),
+                   ('broken_resource_percent', lib.percent(row.broken_link_cnt, totals.get('num_resources'))),
+                   ('package_count', totals.get('num_packages_with_resources')),
+                   ('broken_package_percent', lib.percent(row.dataset_cnt, totals.get('num_packages_with_resources'))),
                 )) )
-               
-        #if organization:
-        #    q = lib.filter_by_organizations(q, organization,
-        #                                    include_sub_organizations)        
-        
-        q = q.subquery()
-        q1 = model.Session.query(func.sum(q.c.dataset_cnt).label('total_brkn_dataset'), func.sum(q.c.broken_link_cnt).label('total_brkn_link')).first()
 
-        total_brkn_dataset = q1.total_brkn_dataset	     
-        total_brkn_link = q1.total_brkn_link
-        
-    else:
-        broken_links = []
-        order = {'dataset_name':1, 'dataset_title':2, 'resource_id':3, 'resource_position':4, 'resource_url':5, 'reason':6, 'failure_count':7}
+        total_brkn_dataset = sum(row['broken_package_count'] for row in broken_links)
+        total_brkn_link = sum(row['broken_resource_count'] for row in broken_links)
 
-        
-        sql = model.Session.query(model.Package.name, model.Package.title, model.Resource.id, model.Resource.position, model.Resource.url, model.TaskStatus.value, model.TaskStatus.entity_id) \
-                     .join(model.Group, model.Group.id == model.Package.owner_org) \
-                     .join(model.Resource, model.Resource.package_id == model.Package.id) \
-                     .join(model.TaskStatus, model.TaskStatus.entity_id == model.Resource.id) \
-                     .filter(model.Group.is_organization == True) \
-                     .filter(between(cast(model.TaskStatus.value, Numeric(3)), 400, 600)) \
-                     .filter(cast(model.TaskStatus.value, Numeric(3)) != 511) \
-                     .filter(model.TaskStatus.key == 'error_code' )\
-                     .filter(model.Package.state == 'active') \
-                     .filter(model.Resource.state == 'active') \
-                     .filter(model.Group.state == 'active') \
-        			 .filter(model.Group.name == organization)
- 
-        for row in sql:
-           q = model.Session.query(model.TaskStatus.value) \
-                   .filter(model.TaskStatus.key == 'openness_score_failure_count') \
-                   .filter(model.TaskStatus.entity_id == row.entity_id)
-        
-           q2 = model.Session.query(model.TaskStatus.value) \
-                   .filter(model.TaskStatus.key == 'openness_score_reason') \
-                   .filter(model.TaskStatus.entity_id == row.entity_id) 
-                                    
-           broken_links.append(OrderedDict((
-                      ('dataset_name', row.name),
-                      ('dataset_title', row.title),
-                      ('resource_id', row.id),
-                      ('resource_position', row.position),
-                      ('resource_url', row.url),
-                      ('reason', q2.first().value),
-                      ('failure_count', q.first().value),
-                   )) )
-                 
-                   
-        sql = sql.subquery()
-        
-        q1 = model.Session.query(func.count(sql.c.name.distinct()).label('total_brkn_dataset'), func.count(sql.c.id).label('total_brkn_link')).first()
-       
-        total_brkn_dataset = q1.total_brkn_dataset	     
-        total_brkn_link = q1.total_brkn_link
-        
-    # Number of total resources and package
-    q = model.Session.query(model.Package)\
-                           .filter(model.Package.state == 'active')
+        # Number of total resources and packages
+        num_packages = sum(totals['num_packages']
+                           for totals in grp_totals.values())
+        num_res = sum(totals['num_resources']
+                      for totals in grp_totals.values())
+        return _broken_link_result(total_brkn_dataset, num_packages,
+                                   total_brkn_link, num_res, order,
+                                   broken_links)
 
-    if organization:
-        q = lib.filter_by_organizations(q, organization, include_sub_organizations)
+    broken_links = []
+    order = BROKEN_LINK_ORGANIZATION_ORDER
 
-    num_packages = q.count()
+    
+    # The reason and failure count are fetched in the same query (they
+    # are None if the resource has no such TaskStatus)
+    sql = _broken_resources_query() \
+                 .filter(model.Group.name == organization)
 
-    q = q.join(model.Group, model.Group.id == model.Package.owner_org)\
-         .join(model.Resource) \
-         .filter(model.Package.state == 'active') \
-         .filter(model.Resource.state == 'active') \
-         .filter(model.Group.state == 'active')
+    broken_datasets = set()
+    for row in lib.stream_query(sql):
+        broken_datasets.add(row.name)
+        broken_links.append(_broken_link_row(row))
 
-    num_res = q.count()
+    total_brkn_dataset = len(broken_datasets)
+    total_brkn_link = len(broken_links)
 
-    resultData = []
-    resultData.append( OrderedDict((
+    # Number of total resources and packages
+    totals = lib.organization_totals_for(organization,
+                                         include_sub_organizations) or {}
+    return _broken_link_result(total_brkn_dataset,
+                               totals.get('num_packages', 0),
+                               total_brkn_link,
+                               totals.get('num_resources', 0), order,
+                               broken_links,
+                               organization_title=totals.get('title', organization),
+                               num_packages_with_resources=totals.get('num_packages_with_resources', 0))
+
+
+def _broken_resources_query():
+    '''Returns a query for the broken resources of all organizations, one row
+    per resource. The openness_score_reason and openness_score_failure_count
+    TaskStatus values are outer joined, so there is no need to look them up
+    for each row.'''
+    reason = aliased(model.TaskStatus)
+    failure_count = aliased(model.TaskStatus)
+    return model.Session.query(model.Group.name.label('organization'), model.Package.name, model.Package.title, model.Resource.id, model.Resource.position, model.Resource.url, \
+                               reason.value.label('reason'), failure_count.value.label('failure_count')) \
+                 .join(model.Package, model.Group.id == model.Package.owner_org) \
+                 .join(model.Resource, model.Resource.package_id == model.Package.id) \
+                 .join(model.TaskStatus, model.TaskStatus.entity_id == model.Resource.id) \
+                 .outerjoin(reason, and_(reason.entity_id == model.Resource.id,
+                                         reason.key == 'openness_score_reason')) \
+                 .outerjoin(failure_count, and_(failure_count.entity_id == model.Resource.id,
+                                                failure_count.key == 'openness_score_failure_count')) \
+                 .filter(model.Group.is_organization == True) \
+                 .filter(broken_link_filter()) \
+                 .filter(model.Package.state == 'active') \
+                 .filter(model.Resource.state == 'active') \
+                 .filter(model.Group.state == 'active')
+
+
+def _broken_link_row(row):
+    return OrderedDict((
+              ('dataset_name', row.name),
+              ('dataset_title', row.title),
+              ('resource_id', row.id),
+              ('resource_position', row.position),
+              ('resource_url', row.url),
+              ('reason', row.reason),
+              ('failure_count', row.failure_count),
+           ))
+
+
+def _broken_link_result(total_brkn_dataset, num_packages, total_brkn_link,
+                        num_res, order, broken_links, organization_title=None,
+                        num_packages_with_resources=None):
+    '''Assembles the report data. The report for an organization also records
+    its title and number of packages with resources, so that the index of
+    organizations can be produced from it (see broken_link_summary).'''
+    result = OrderedDict((
                ('num_broken_packages', total_brkn_dataset),
                ('num_packages', num_packages),
                ('broken_package_percent', lib.percent(total_brkn_dataset, num_packages)),
                ('num_broken_resources', total_brkn_link),
                ('num_resources', num_res),
                ('broken_resource_percent', lib.percent(total_brkn_link, num_res)),
-               ('order', order),
-               ('table', broken_links),
-               )) )       
+               ))
+    if organization_title is not None:
+        result['organization_title'] = organization_title
+        result['num_packages_with_resources'] = num_packages_with_resources
+    result['order'] = order
+    result['table'] = broken_links
+
+    resultData = []
+    resultData.append(result)
 
     return resultData
 
+
+def broken_link_report_bulk():
+    '''
+    Produces the broken-links report for all the organizations in one go,
+    rather than calling broken_link_report for each one. The broken resources
+    of every organization are fetched by one query and partitioned by
+    organization name, and the totals are read from the organization totals
+    (see lib.organization_totals).
+
+    Yields (option_dict, data) for the index of organizations and for each
+    organization that has broken links, with the same data that
+    broken_link_report would return for those options.
+    '''
+    yield {'organization': None, 'include_sub_organizations': False}, \
+        broken_link_report(None)
+
+    sql = _broken_resources_query().order_by(model.Group.name)
+
+    # Totals for each organization, keyed by organization name
+    grp_totals = lib.organization_totals()
+
+    for organization, rows in itertools.groupby(lib.stream_query(sql),
+                                                key=lambda row: row.organization):
+        broken_links = []
+        broken_datasets = set()
+        for row in rows:
+            broken_datasets.add(row.name)
+            broken_links.append(_broken_link_row(row))
+        totals = grp_totals.get(organization, {})
+        yield {'organization': organization,
+               'include_sub_organizations': False}, \
+            _broken_link_result(len(broken_datasets),
+                                totals.get('num_packages', 0),
+                                len(broken_links),
+                                totals.get('num_resources', 0),
+                                BROKEN_LINK_ORGANIZATION_ORDER, broken_links,
+                                organization_title=totals.get('title', organization),
+                                num_packages_with_resources=totals.get('num_packages_with_resources', 0))
+
+
+def broken_link_summary(results):
+    '''
+    Produces the index of organizations (the report for organization=None)
+    from the reports for each organization, rather than querying all the
+    broken links again. Used when regenerating the report incrementally.
+
+    results is a list of (option_dict, data) of the organizations' reports.
+    '''
+    broken_links = []
+    for option_dict, data in results:
+        record = data[0]
+        if not record['num_broken_resources']:
+            continue
+        num_packages_with_resources = record.get(
+            'num_packages_with_resources', record['num_packages'])
+        broken_links.append(OrderedDict((
+                   ('organization_name', option_dict['organization']),
+                   ('organization_title', record.get('organization_title', option_dict['organization'])),
+                   ('broken_package_count', record['num_broken_packages']),
+                   ('broken_resource_count', record['num_broken_resources']),
+                   ('broken_resource_percent', lib.percent(record['num_broken_resources'], record['num_resources'])),
+                   ('package_count', num_packages_with_resources),
+                   ('broken_package_percent', lib.percent(record['num_broken_packages'], num_packages_with_resources)),
+                )) )
+    broken_links.sort(key=lambda row: row['organization_title'])
+    total_brkn_dataset = sum(row['broken_package_count'] for row in broken_links)
+    total_brkn_link = sum(row['broken_resource_count'] for row in broken_links)
+
+    grp_totals = lib.organization_totals()
+    num_packages = sum(totals['num_packages']
+                       for totals in grp_totals.values())
+    num_res = sum(totals['num_resources'] for totals in grp_totals.values())
+
+    return _broken_link_result(total_brkn_dataset, num_packages,
+                               total_brkn_link, num_res,
+                               BROKEN_LINK_SUMMARY_ORDER, broken_links)
+
+
+def broken_link_watermark():
+    '''Returns the time of the latest change to the TaskStatuses that the
+    broken-links report is generated from.'''
+    return model.Session.query(func.max(model.TaskStatus.last_updated)) \
+                .filter(model.TaskStatus.key.in_(BROKEN_LINK_TASK_STATUS_KEYS)) \
+                .scalar()
+
+
+def broken_report_changed_option_combinations(since):
+    '''Yields the option combinations for the organizations that have
+    resources with TaskStatuses (that the broken-links report uses) changed
+    since the given time.'''
+    sql = model.Session.query(model.Group.name.distinct().label('organization')) \
+                .join(model.Package, model.Group.id == model.Package.owner_org) \
+                .join(model.Resource, model.Resource.package_id == model.Package.id) \
+                .join(model.TaskStatus, model.TaskStatus.entity_id == model.Resource.id) \
+                .filter(model.Group.is_organization == True) \
+                .filter(model.TaskStatus.key.in_(BROKEN_LINK_TASK_STATUS_KEYS)) \
+                .filter(model.TaskStatus.last_updated > since)
+    for row in lib.stream_query(sql):
+        yield {'organization': row.organization,
+               'include_sub_organizations': False
+              }
+
 def tagless_report_option_combinations():
     for organization in lib.all_organizations(include_none=True):
             yield {'organization': organization,
@@ -217,9 +362,7 @@ def broken_report_option_combinations():
                 .join(model.Resource, model.Resource.package_id == model.Package.id) \
                 .join(model.TaskStatus, model.TaskStatus.entity_id == model.Resource.id) \
                 .filter(model.Group.is_organization == True) \
-                .filter(between(cast(model.TaskStatus.value, Numeric(3)), 400, 600)) \
-                .filter(cast(model.TaskStatus.value, Numeric(3)) != 511) \
-                .filter(model.TaskStatus.key == 'error_code' )\
+                .filter(broken_link_filter()) \
                 .filter(model.Package.state == 'active') \
                 .filter(model.Resource.state == 'active') \
                 .filter(model.Group.state == 'active')
@@ -228,7 +371,7 @@ def broken_report_option_combinations():
              'include_sub_organizations': False
             }
             
-   for row in sql:
+   for row in lib.stream_query(sql):
       yield {'organization': row.organization,
              'include_sub_organizations': False
             }
@@ -242,6 +385,7 @@ tagless_report_info = {
     'option_combinations': tagless_report_option_combinations,
     'generate': tagless_report,
     'template': 'report/tagless-datasets.html',
+    'paged': True,
     }
 
 broken_link_info = {
@@ -253,6 +397,11 @@ broken_link_info = {
                                         )),
     'option_combinations': broken_report_option_combinations,
     'generate': broken_link_report,
+    'generate_bulk': broken_link_report_bulk,
+    'watermark': broken_link_watermark,
+    'changed_option_combinations': broken_report_changed_option_combinations,
+    'summarize': broken_link_summary,
     'template': 'report/broken-links.html',
+    'paged': True,
 
 	}         
@@ -0,0 +1,103 @@
+'''
+Measurement of report generation.
+
+Each report/option combination that is generated is timed, and the SQL
+statements it runs are counted (with a SQLAlchemy event hook), so that the
+slow ones can be found. The measurements are saved in the DataCacheStats
+table alongside the cached report, and shown by 'paster report-cache stats'.
+'''
+
+import contextlib
+import os
+import threading
+import time
+
+_counter = threading.local()
+_listening_engines = set()
+_listening_lock = threading.Lock()
+
+
+class Measurement(object):
+    '''The resources used generating a report.
+
+    wall_time - seconds elapsed
+    cpu_time - seconds of CPU used by this process (user + system)
+    num_queries - number of SQL statements run by this thread
+    '''
+    def __init__(self):
+        self.wall_time = None
+        self.cpu_time = None
+        self.num_queries = None
+
+    def as_dict(self):
+        return {'wall_time': self.wall_time,
+                'cpu_time': self.cpu_time,
+                'num_queries': self.num_queries}
+
+    def __repr__(self):
+        return '<Measurement wall=%.3fs cpu=%.3fs queries=%s>' % (
+            self.wall_time or 0, self.cpu_time or 0, self.num_queries)
+
+
+@contextlib.contextmanager
+def measure():
+    '''Measures the code run in the block.
+
+        with measure() as measurement:
+            data = report.generate()
+        print measurement.wall_time
+    '''
+    _listen()
+    measurement = Measurement()
+    queries_before = queries_run()
+    cpu_before = _cpu_time()
+    wall_before = time.time()
+    try:
+        yield measurement
+    finally:
+        measurement.wall_time = time.time() - wall_before
+        measurement.cpu_time = _cpu_time() - cpu_before
+        measurement.num_queries = queries_run() - queries_before
+
+
+def queries_run():
+    '''Returns the number of SQL statements this thread has run since
+    counting started.'''
+    return getattr(_counter, 'count', 0)
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+@contextlib.contextmanager
+def not_counted():
+    '''The SQL statements run in the block are not counted, e.g. those that
+    take and release locks, which are not part of generating a report.'''
+    paused = getattr(_counter, 'paused', 0)
+    _counter.paused = paused + 1
+    try:
+        yield
+    finally:
+        _counter.paused = paused
+
+
+def _count_query(conn, cursor, statement, parameters, context,
+                 executemany):
+    if getattr(_counter, 'paused', 0):
+        return
+    _counter.count = getattr(_counter, 'count', 0) + 1
+
+
+def _listen():
+    '''Starts counting the SQL statements run on CKAN's engine.'''
+    from sqlalchemy import event
+    from ckan import model
+    engine = model.meta.engine
+    if id(engine) in _listening_engines:
+        return
+    with _listening_lock:
+        if id(engine) not in _listening_engines:
+            event.listen(engine, 'before_cursor_execute', _count_query)
+            _listening_engines.add(id(engine))
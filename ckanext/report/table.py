@@ -0,0 +1,291 @@
+'''
+Columnar storage of report tables.
+
+Reports return their 'table' as a list of dicts, which repeats every column
+name on every row. Before it is cached it is converted to a list of column
+names plus a list of rows of values, which is smaller to store and quicker to
+decode:
+
+    {'columns': ['name', 'title'],
+     'table': [['river-levels', 'River levels'],
+               ['co2-monthly', 'CO2 monthly']]}
+
+When it is read back, the table is wrapped in a Table, which templates can
+use as before (e.g. row['name'] or row.name) without a dict being built for
+every row.
+
+The order of the rows when sorted by a column is worked out the first time
+a page sorted by it is asked for, and kept in the record's 'sort_index', so
+while the decoded report is in the memory cache (see ckanext.report.cache),
+the next pages are served without sorting it again. It is not stored in the
+DataCache, as an order for every column would add a number per row per
+column to it.
+'''
+
+from ckan.common import OrderedDict
+
+
+def records(data):
+    '''Returns the report data as a list of records (dicts with a table).
+    Most reports return a dict, but some return a list of them.'''
+    if isinstance(data, dict):
+        return [data]
+    return data
+
+
+def to_columnar(data):
+    '''Returns the report data with any table of dicts converted to columns
+    and rows. The columns are in the order given by the record's 'order'
+    (column: position), if it has one, otherwise the order they are first
+    found in the rows. A table whose rows don't all have the same columns is
+    left as dicts. The data passed in is not altered.'''
+    if isinstance(data, dict):
+        return _record_to_columnar(data)
+    if isinstance(data, list):
+        return [_record_to_columnar(record) for record in data]
+    return data
+
+
+def _record_to_columnar(record):
+    if not isinstance(record, dict):
+        return record
+    rows = record.get('table')
+    if not rows or 'columns' in record or \
+            not all(isinstance(row, dict) for row in rows):
+        return record
+    columns = _ordered_column_names(record)
+    # A table whose rows don't all have every column is left as it is, as
+    # a missing value couldn't then be told apart from None (see MISSING)
+    if not all(len(row) == len(columns) for row in rows):
+        return record
+    record = record.copy()
+    record['columns'] = columns
+    record['table'] = [[row.get(column) for column in columns]
+                       for row in rows]
+    return record
+
+
+def num_rows(data):
+    '''Returns the total number of rows in the report data's tables.'''
+    return sum(len(record.get('table') or [])
+               for record in records(data) or [] if isinstance(record, dict))
+
+
+def sort_positions(rows, column_index):
+    '''Returns the positions of the rows, in the order of the rows sorted by
+    the given column (ascending, case-insensitive).'''
+    return sorted(xrange(len(rows)),
+                  key=lambda i: _sort_key(rows[i][column_index]))
+
+
+def _sort_key(value):
+    if isinstance(value, basestring):
+        return value.lower()
+    return value
+
+
+def column_names(rows):
+    '''Returns the keys of all the rows (dicts), retaining their ordering.'''
+    columns = []
+    columns_set = set()
+    for row in rows:
+        for column in row.keys():
+            if column not in columns_set:
+                columns_set.add(column)
+                columns.append(column)
+    return columns
+
+
+def from_columnar(data):
+    '''Returns the report data with any columnar tables wrapped in a Table.
+    Only the records are copied, not the rows, so it is cheap, and the data
+    passed in (which may be shared by the memory cache) is not altered.'''
+    if isinstance(data, dict):
+        return _record_from_columnar(data)
+    if isinstance(data, list):
+        return [_record_from_columnar(record) for record in data]
+    return data
+
+
+def _record_from_columnar(record):
+    if not isinstance(record, dict) or 'columns' not in record or \
+            isinstance(record.get('table'), Table):
+        return record
+    # The Table adds the sort orders it works out to this dict, so they are
+    # kept with the data passed in. (Values cached by older versions have an
+    # order for every column already.)
+    record.setdefault('sort_index', {})
+    record = record.copy()
+    record['table'] = Table(record['columns'], record['table'] or [],
+                            sort_index=record.get('sort_index'))
+    return record
+
+
+def _ordered_column_names(record):
+    '''Returns the column names of a record's table of dicts, in the order
+    given by the record's 'order' (column: position), if it has one,
+    otherwise the order they are first found in the rows.'''
+    columns = column_names(record['table'])
+    if record.get('order'):
+        order = record['order']
+        columns.sort(key=lambda column: order.get(column))
+    return columns
+
+
+def columns_and_rows(record):
+    '''Returns (columns, rows) for a record's table, whichever form it is
+    in. In a table of dicts, a column that a row doesn't have has the value
+    MISSING.'''
+    table = record.get('table') or []
+    if isinstance(table, Table):
+        return table.columns, table.rows
+    if 'columns' in record:
+        return record['columns'], table
+    if not all(isinstance(row, dict) for row in table):
+        return [], table
+    columns = _ordered_column_names(record)
+    return columns, [[row.get(column, MISSING) for column in columns]
+                     for row in table]
+
+
+class _Missing(object):
+    def __repr__(self):
+        return 'MISSING'
+
+# The value given by columns_and_rows for a column that a row doesn't have
+MISSING = _Missing()
+
+
+class Table(object):
+    '''A read-only sequence of Rows, over a list of column names and a list of
+    rows of values. sort_index (optional) is a dict of column name: row
+    positions in the order sorted by that column, to which the orders are
+    added as they are worked out.'''
+    def __init__(self, columns, rows, sort_index=None):
+        self.columns = columns
+        self.rows = rows
+        self.sort_index = sort_index if sort_index is not None else {}
+        self._index = dict((column, i) for i, column in enumerate(columns))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        index = self._index
+        for values in self.rows:
+            yield Row(index, values)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return Table(self.columns, self.rows[i])
+        return Row(self._index, self.rows[i])
+
+    def page(self, page=1, per_page=100, sort=None, descending=False,
+             q=None):
+        '''Returns a Table of the rows on the given page (numbered from 1) and
+        the total number of rows, after filtering and sorting.
+
+        sort - column name to sort by (using the sort_index, which the
+               order is added to if it isn't there yet)
+        descending - sort in descending order
+        q - only include rows with a value containing this text
+            (case-insensitive)
+
+        Without q, only the rows on the page are looked at, so the time taken
+        does not depend on the size of the table.
+        '''
+        start = (page - 1) * per_page
+        end = start + per_page
+        order = None
+        if sort in self._index:
+            order = self.sort_index.get(sort)
+            if order is None:
+                order = sort_positions(self.rows, self._index[sort])
+                self.sort_index[sort] = order
+        else:
+            descending = False
+        if q:
+            matches = self._matching_positions(q)
+            positions = [i for i in (order or xrange(len(self.rows)))
+                         if i in matches]
+            if descending:
+                positions.reverse()
+            total = len(positions)
+            positions = positions[start:end]
+        else:
+            total = len(self.rows)
+            if order is None:
+                positions = xrange(start, min(end, total))
+            elif descending:
+                positions = [order[total - 1 - i]
+                             for i in xrange(start, min(end, total))]
+            else:
+                positions = order[start:end]
+        return Table(self.columns, [self.rows[i] for i in positions]), total
+
+    def _matching_positions(self, q):
+        q = q.lower()
+        matches = set()
+        for i, values in enumerate(self.rows):
+            for value in values:
+                if value is not None and q in unicode(value).lower():
+                    matches.add(i)
+                    break
+        return matches
+
+    def __repr__(self):
+        return '<Table columns=%r rows=%s>' % (self.columns, len(self.rows))
+
+
+class Row(object):
+    '''A row of a Table. Values can be got by column name, like a dict
+    (row['name'] or row.get('name')) or as an attribute (row.name), or by
+    position, like a tuple (row[0]).'''
+    __slots__ = ('_index', '_values')
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            try:
+                return self._values[self._index[key]]
+            except KeyError:
+                raise KeyError(key)
+        return self._values[key]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            # e.g. __html__ or __deepcopy__ looked up on the object
+            raise AttributeError(name)
+        try:
+            return self._values[self._index[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def get(self, key, default=None):
+        if key in self._index:
+            return self._values[self._index[key]]
+        return default
+
+    def keys(self):
+        return sorted(self._index, key=self._index.get)
+
+    def items(self):
+        return zip(self.keys(), self._values)
+
+    def as_dict(self):
+        return OrderedDict(self.items())
+
+    def __repr__(self):
+        return '<Row %r>' % (self.as_dict(),)
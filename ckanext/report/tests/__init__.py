@@ -0,0 +1,62 @@
+'''
+Tests of ckanext-report. They need CKAN's test setup - run them from the
+directory of this extension, with CKAN's source in ../ckan:
+
+    nosetests --ckan --with-pylons=test.ini ckanext/report/tests
+'''
+
+
+def reset_db():
+    '''Empties CKAN's tables and the report tables, creating the latter if
+    need be.'''
+    import ckan.tests.helpers as helpers
+    from ckan import model
+    from ckanext.report import model as report_model
+    helpers.reset_db()
+    report_model.init_tables()
+    for table in reversed(report_model.metadata.sorted_tables):
+        model.Session.execute(table.delete())
+    model.Session.commit()
+
+
+def create_organization(name, parent=None, state='active'):
+    '''Creates an organization (and makes it a child of parent, if given)
+    directly in the model, which is quicker than the actions and doesn't
+    need the search index.'''
+    from ckan import model
+    model.repo.new_revision()
+    organization = model.Group(name=name, title=name.replace('-', ' ').title(),
+                               type='organization')
+    organization.is_organization = True
+    organization.state = state
+    model.Session.add(organization)
+    model.Session.flush()
+    if parent:
+        model.Session.add(model.Member(group=organization, table_id=parent.id,
+                                       table_name='group', capacity='parent',
+                                       state='active'))
+    model.Session.commit()
+    return organization
+
+
+def create_dataset(name, organization=None, tags=(), num_resources=0,
+                   state='active'):
+    '''Creates a dataset directly in the model, with the given tags and
+    number of resources.'''
+    from ckan import model
+    model.repo.new_revision()
+    package = model.Package(name=name, title=name.replace('-', ' ').title())
+    package.owner_org = organization.id if organization else None
+    package.state = state
+    model.Session.add(package)
+    for tag_name in tags:
+        tag = model.Tag.by_name(tag_name) or model.Tag(name=tag_name)
+        model.Session.add(model.PackageTag(package=package, tag=tag))
+    model.Session.flush()
+    for i in range(num_resources):
+        resource = model.Resource(url='http://example.com/%s/%s' % (name, i))
+        resource.package_id = package.id
+        resource.position = i
+        model.Session.add(resource)
+    model.Session.commit()
+    return package
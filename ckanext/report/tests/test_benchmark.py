@@ -0,0 +1,44 @@
+import copy
+
+from nose.tools import assert_raises
+
+from pylons import config
+import sqlalchemy
+
+from ckan import model
+from ckanext.report import benchmark
+from ckanext.report.tests import reset_db, create_dataset
+
+
+class TestRun(object):
+    def setup(self):
+        reset_db()
+
+    def test_refuses_the_ckan_database(self):
+        with assert_raises(ValueError):
+            benchmark.run(config['sqlalchemy.url'], sizes=[10])
+
+    def test_refuses_a_database_with_datasets(self):
+        create_dataset('precious')
+        # the CKAN database, by another url
+        url = copy.copy(model.meta.engine.url)
+        url.query = dict(url.query, application_name='benchmark')
+        db_url = str(url)
+        assert db_url != config['sqlalchemy.url']
+        with assert_raises(ValueError):
+            benchmark.run(db_url, sizes=[10])
+        assert model.Package.by_name('precious')
+
+
+class TestHasDatasets(object):
+    def setup(self):
+        reset_db()
+
+    def test_has_datasets(self):
+        assert not benchmark._has_datasets(model.meta.engine)
+        create_dataset('dataset')
+        assert benchmark._has_datasets(model.meta.engine)
+
+    def test_no_package_table(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        assert not benchmark._has_datasets(engine)
@@ -0,0 +1,101 @@
+import datetime
+
+import mock
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.report import cache
+from ckanext.report import model as report_model
+from ckanext.report.cache import LRUCache
+from ckanext.report.tests import reset_db
+
+DATE = datetime.datetime(2015, 1, 1)
+LATER = datetime.datetime(2015, 1, 2)
+
+
+class TestLRUCache(object):
+    def test_get(self):
+        lru = LRUCache(max_entries=10, max_bytes=100)
+        lru.set(None, 'a', DATE, {'a': 1}, 10)
+        assert_equal(lru.get(None, 'a', DATE), {'a': 1})
+        assert_equal(lru.get('org', 'a', DATE), None)
+
+    def test_out_of_date(self):
+        lru = LRUCache(max_entries=10, max_bytes=100)
+        lru.set(None, 'a', DATE, {'a': 1}, 10)
+        assert_equal(lru.get(None, 'a', LATER), None)
+        # and it is dropped
+        assert_equal(lru.get(None, 'a', DATE), None)
+        assert_equal(lru._bytes, 0)
+
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(max_entries=2, max_bytes=100)
+        lru.set(None, 'a', DATE, 1, 10)
+        lru.set(None, 'b', DATE, 2, 10)
+        lru.get(None, 'a', DATE)
+        lru.set(None, 'c', DATE, 3, 10)
+        assert_equal(lru.get(None, 'b', DATE), None)
+        assert_equal(lru.get(None, 'a', DATE), 1)
+        assert_equal(lru.get(None, 'c', DATE), 3)
+
+    def test_max_bytes(self):
+        lru = LRUCache(max_entries=10, max_bytes=25)
+        lru.set(None, 'a', DATE, 1, 10)
+        lru.set(None, 'b', DATE, 2, 10)
+        lru.set(None, 'c', DATE, 3, 10)
+        assert_equal(lru.get(None, 'a', DATE), None)
+        assert_equal(lru._bytes, 20)
+        # too big to cache at all
+        lru.set(None, 'd', DATE, 4, 26)
+        assert_equal(lru.get(None, 'd', DATE), None)
+        assert_equal(lru.get(None, 'c', DATE), 3)
+
+    def test_invalidate(self):
+        lru = LRUCache(max_entries=10, max_bytes=100)
+        lru.set(None, 'a', DATE, 1, 10)
+        lru.invalidate(None, 'a')
+        assert_equal(lru.get(None, 'a', DATE), None)
+        assert_equal(lru._bytes, 0)
+
+
+class TestDataCacheMemoryCache(object):
+    def setup(self):
+        reset_db()
+        cache.decoded_values().clear()
+
+    def _get(self):
+        return report_model.DataCache.get(None, u'report?a=1',
+                                          convert_json=True)[0]
+
+    def test_decoded_once(self):
+        report_model.DataCache.set(None, u'report?a=1', {'a': 1},
+                                   convert_json=True)
+        model.Session.commit()
+        with mock.patch.object(report_model, 'decode_json',
+                               wraps=report_model.decode_json) as decode:
+            assert_equal(self._get(), {'a': 1})
+            assert_equal(self._get(), {'a': 1})
+        assert_equal(decode.call_count, 1)
+
+    def test_new_value_is_read(self):
+        report_model.DataCache.set(None, u'report?a=1', {'a': 1},
+                                   convert_json=True)
+        model.Session.commit()
+        assert_equal(self._get(), {'a': 1})
+        report_model.DataCache.set_many([(None, u'report?a=1', {'a': 2})],
+                                        convert_json=True)
+        model.Session.commit()
+        assert_equal(self._get(), {'a': 2})
+
+    def test_value_written_by_another_process_is_read(self):
+        report_model.DataCache.set(None, u'report?a=1', {'a': 1},
+                                   convert_json=True)
+        model.Session.commit()
+        assert_equal(self._get(), {'a': 1})
+        # written directly, so this process's memory cache isn't invalidated
+        table = report_model.data_cache_table
+        model.Session.execute(table.update().values(
+            value=report_model.encode_json({'a': 2}),
+            created=datetime.datetime.now() + datetime.timedelta(seconds=1)))
+        model.Session.commit()
+        assert_equal(self._get(), {'a': 2})
@@ -0,0 +1,145 @@
+import csv
+import json
+import StringIO
+
+import mock
+from nose.tools import assert_equal
+
+import ckan.tests.helpers as helpers
+from ckan.common import OrderedDict
+from ckanext.report import controllers, table
+from ckanext.report.report_registry import ReportRegistry
+from ckanext.report.tests import reset_db, create_organization, \
+    create_dataset
+
+
+class TestExport(object):
+    def setup(self):
+        reset_db()
+        self.app = helpers._get_test_app()
+        org = create_organization('test-org')
+        for name in ('tagless-1', 'tagless-2'):
+            create_dataset(name, org)
+        create_dataset('tagged', org, tags=['tag'])
+
+    def test_csv(self):
+        response = self.app.get('/report/tagless-datasets?format=csv')
+        rows = list(csv.reader(StringIO.StringIO(response.body)))
+        assert_equal(rows[0][:2], ['name', 'title'])
+        assert_equal(sorted(row[0] for row in rows[1:]),
+                     ['tagless-1', 'tagless-2'])
+
+    def test_json(self):
+        response = self.app.get('/report/tagless-datasets?format=json')
+        data = json.loads(response.body)
+        assert_equal(sorted(row['name'] for row in data['table']),
+                     ['tagless-1', 'tagless-2'])
+        assert data['generated_at']
+
+
+class TestPaging(object):
+    def setup(self):
+        reset_db()
+        self.app = helpers._get_test_app()
+        org = create_organization('test-org')
+        for name in ('tagless-1', 'tagless-2', 'tagless-3'):
+            create_dataset(name, org)
+
+    def test_paged_report(self):
+        response = self.app.get('/report/tagless-datasets?per_page=2&sort=-name')
+        assert 'tagless-3' in response.body
+        assert 'tagless-1' not in response.body
+        assert 'Page 1 / 2' in response.body
+
+    def test_report_that_is_not_paged(self):
+        report = ReportRegistry.instance().get_report('tagless-datasets')
+        with mock.patch.object(report, 'paged', False):
+            response = self.app.get('/report/tagless-datasets?per_page=2')
+        for name in ('tagless-1', 'tagless-2', 'tagless-3'):
+            assert name in response.body, name
+        assert 'Page 1 /' not in response.body
+
+
+class TestPaginateTables(object):
+    def _data(self, num_rows):
+        return {'table': [{'n': i} for i in range(num_rows)]}
+
+    def test_page(self):
+        data = table.from_columnar(table.to_columnar(self._data(5)))
+        paged, pagination = controllers.paginate_tables(data, page=2,
+                                                        per_page=2)
+        assert_equal([row.n for row in paged['table']], [2, 3])
+        assert_equal(pagination['num_pages'], 3)
+        assert_equal(pagination['total'], 5)
+        # the data passed in (which may be in the memory cache) is whole
+        assert_equal(len(data['table']), 5)
+
+    def test_table_cached_before_columnar_form_is_left_whole(self):
+        data = self._data(5)
+        paged, pagination = controllers.paginate_tables(data, per_page=2)
+        assert_equal(paged, self._data(5))
+        assert_equal(pagination, None)
+
+
+class TestIterJson(object):
+    def test_chunks_make_valid_json(self):
+        for num_rows in (0, 1, 3, 4, 7):
+            rows = [[i, u'row %s' % i] for i in range(num_rows)]
+            output = ''.join(controllers.iter_json(
+                ['id', 'name'], rows, generated_at=None, chunk_size=3))
+            assert_equal(json.loads(output),
+                         {'generated_at': None,
+                          'table': [{'id': i, 'name': u'row %s' % i}
+                                    for i in range(num_rows)]})
+
+
+class TestIterCsv(object):
+    def test_chunks(self):
+        rows = [[i, u'row %s' % i] for i in range(7)]
+        chunks = list(controllers.iter_csv(['id', 'name'], rows,
+                                           chunk_size=3))
+        assert_equal(len(chunks), 3)
+        assert_equal(list(csv.reader(StringIO.StringIO(''.join(chunks)))),
+                     [['id', 'name']] +
+                     [[str(i), 'row %s' % i] for i in range(7)])
+
+
+    def test_missing_values(self):
+        # as the CSV export has always shown them
+        rows = [[1, table.MISSING], [2, None]]
+        assert_equal(list(csv.reader(StringIO.StringIO(
+                         ''.join(controllers.iter_csv(['id', 'name'], rows))))),
+                     [['id', 'name'], ['1', 'no record'], ['2', '']])
+
+    def test_make_csv_from_dicts(self):
+        output = controllers.make_csv_from_dicts([
+            OrderedDict((('id', 1), ('name', u'a'))), {'id': 2}])
+        assert_equal(list(csv.reader(StringIO.StringIO(output))),
+                     [['id', 'name'], ['1', 'a'], ['2', 'no record']])
+
+
+class TestIterJsonMissingValues(object):
+    def test_missing_values_are_left_out(self):
+        rows = [[1, table.MISSING], [2, None]]
+        output = ''.join(controllers.iter_json(['id', 'name'], rows,
+                                               generated_at=None))
+        assert_equal(json.loads(output)['table'],
+                     [{'id': 1}, {'id': 2, 'name': None}])
+
+
+class TestAnonymiseUserNames(object):
+    def test_names_are_looked_up_before_streaming(self):
+        # the rows are generated after the request's session is removed, so
+        # the user names must be looked up beforehand
+        with mock.patch.object(controllers.dguhelpers, 'user_link_info',
+                               side_effect=lambda name, organisation=None:
+                                   (name.upper(), None)) as user_link_info:
+            rows = controllers.anonymise_user_names(
+                ['name', 'user'], [['a', 'bob'], ['b', 'bob'], ['c', 'sue']])
+            assert_equal(user_link_info.call_count, 2)
+        assert_equal(list(rows), [['a', 'BOB'], ['b', 'BOB'], ['c', 'SUE']])
+
+    def test_no_user_columns(self):
+        rows = [['a', 'bob']]
+        assert controllers.anonymise_user_names(['name', 'owner'],
+                                                rows) is rows
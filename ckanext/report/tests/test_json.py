@@ -0,0 +1,121 @@
+import copy
+import datetime
+import json
+import time
+
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.report import cache
+from ckanext.report import model as report_model
+from ckanext.report import table
+from ckanext.report.json import (TypedJsonEncoder, TypedJsonDecoder,
+                                 DateTimeJsonEncoder, DateTimeJsonDecoder,
+                                 parse_isoformat)
+from ckanext.report.tests import reset_db
+
+
+VALUE = {'table': [{'name': u'dataset',
+                    'created': datetime.datetime(2015, 3, 4, 5, 6, 7, 89),
+                    'modified': datetime.datetime(2015, 3, 4, 5, 6, 7),
+                    'notes': u'Created 2015-03-04T05:06:07'}],
+         'nested': {'dates': [datetime.datetime(2014, 1, 1)]},
+         # looks like a date, but is in a list, so stays a string
+         'tags': [u'2015-03-04T05:06:07'],
+         'num_packages': 1}
+
+# Strings in ISO format, as reports may return dates
+ISO_VALUE = {'table': [{'name': u'dataset',
+                        'created': u'2015-01-02T03:04:05.123456',
+                        'modified': u'2015-01-02T03:04:05'}],
+             'checked': u'2015-01-02T03:04:05Z'}
+
+
+class TestTypedJson(object):
+    def test_round_trip(self):
+        encoded = json.dumps(VALUE, cls=TypedJsonEncoder)
+        assert_equal(json.loads(encoded, cls=TypedJsonDecoder), VALUE)
+
+    def test_datetimes_are_tagged(self):
+        encoded = json.loads(json.dumps(
+            {'date': datetime.datetime(2015, 1, 2)}, cls=TypedJsonEncoder))
+        assert_equal(encoded, {'date': {'__datetime__': '2015-01-02T00:00:00'}})
+
+    def test_parse_isoformat(self):
+        for value in (datetime.datetime(2015, 1, 2, 3, 4, 5),
+                      datetime.datetime(2015, 1, 2, 3, 4, 5, 6)):
+            assert_equal(parse_isoformat(value.isoformat()), value)
+        # with a timezone
+        assert_equal(parse_isoformat('2015-01-02T03:04:05+01:00').hour, 3)
+
+
+class TestEncodeDecodeJson(object):
+    def test_iso_strings_are_read_back_as_datetimes(self):
+        # as they always were, by DateTimeJsonDecoder
+        legacy = json.loads(json.dumps(ISO_VALUE), cls=DateTimeJsonDecoder)
+        assert isinstance(legacy['table'][0]['created'], datetime.datetime)
+        decoded = report_model.decode_json(report_model.encode_json(ISO_VALUE))
+        assert_equal(decoded, legacy)
+        assert_equal(decoded['table'][0]['created'],
+                     datetime.datetime(2015, 1, 2, 3, 4, 5, 123456))
+
+    def test_iso_strings_in_a_columnar_table(self):
+        columnar = table.to_columnar(ISO_VALUE)
+        decoded = report_model.decode_json(report_model.encode_json(columnar))
+        assert_equal([row.as_dict() for row in
+                      table.from_columnar(decoded)['table']],
+                     json.loads(json.dumps(ISO_VALUE),
+                                cls=DateTimeJsonDecoder)['table'])
+
+    def test_value_is_not_altered(self):
+        value = copy.deepcopy(ISO_VALUE)
+        report_model.encode_json(value)
+        assert_equal(value, ISO_VALUE)
+
+    def test_decoding_is_quicker_than_legacy(self):
+        data = {'table': [
+            {'name': u'dataset-%s' % i, 'title': u'Dataset %s' % i,
+             'url': u'http://example.com/%s.csv' % i,
+             'reason': u'URL unobtainable', 'failure_count': i % 10,
+             'created': datetime.datetime(2015, 1, 2, 3, 4, i % 60)}
+            for i in xrange(2000)]}
+        legacy = json.dumps(data, cls=DateTimeJsonEncoder)
+        typed = report_model.encode_json(data)
+        legacy_times = []
+        typed_times = []
+        for i in range(3):
+            start = time.time()
+            json.loads(legacy, cls=DateTimeJsonDecoder)
+            legacy_times.append(time.time() - start)
+            start = time.time()
+            report_model.decode_json(typed)
+            typed_times.append(time.time() - start)
+        assert min(typed_times) < min(legacy_times), \
+            (typed_times, legacy_times)
+
+    def test_round_trip(self):
+        encoded = report_model.encode_json(VALUE)
+        assert encoded.startswith(report_model.TYPED_JSON_PREFIX)
+        assert_equal(report_model.decode_json(encoded), VALUE)
+
+    def test_decode_legacy_value(self):
+        # stored before the typed format, with datetimes in ISO format
+        legacy = json.dumps({'created': datetime.datetime(2015, 1, 2),
+                             'name': u'dataset'}, cls=DateTimeJsonEncoder)
+        assert_equal(report_model.decode_json(legacy),
+                     {'created': datetime.datetime(2015, 1, 2),
+                      'name': u'dataset'})
+
+
+class TestDataCacheRoundTrip(object):
+    def setup(self):
+        reset_db()
+
+    def test_round_trip(self):
+        report_model.DataCache.set(None, u'report?a=1', VALUE,
+                                   convert_json=True)
+        model.Session.commit()
+        cache.decoded_values().clear()
+        value, date = report_model.DataCache.get(None, u'report?a=1',
+                                                 convert_json=True)
+        assert_equal(value, VALUE)
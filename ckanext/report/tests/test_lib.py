@@ -0,0 +1,189 @@
+import contextlib
+
+from nose.tools import assert_equal, assert_raises
+
+from ckan import model
+from ckanext.report import lib
+from ckanext.report.tests import reset_db, create_organization, create_dataset
+
+
+class TestOrganizationHierarchy(object):
+    '''The sub-organizations are found with a recursive query, or from the
+    memoized organization tree, with the same results.'''
+    def setup(self):
+        reset_db()
+        self.orgs = {}
+        for name, parent, state in (
+                ('parent', None, 'active'),
+                ('child', 'parent', 'active'),
+                ('grandchild', 'child', 'active'),
+                ('deleted-child', 'parent', 'deleted'),
+                ('child-of-deleted', 'deleted-child', 'active'),
+                ('deleted', None, 'deleted'),
+                ('child-of-deleted-root', 'deleted', 'active')):
+            self.orgs[name] = create_organization(
+                name, parent=self.orgs.get(parent), state=state)
+            create_dataset('dataset-of-%s' % name, self.orgs[name])
+        self.ids = dict((name, org.id) for name, org in self.orgs.items())
+        self.names = dict((id_, name) for name, id_ in self.ids.items())
+
+    def _subtree(self, name):
+        return sorted(self.names[id_] for id_ in
+                      lib.organization_subtree_ids(self.ids[name]))
+
+    def _datasets(self, organization, include_sub_organizations):
+        q = model.Session.query(model.Package.name)
+        q = lib.filter_by_organizations(q, organization,
+                                        include_sub_organizations)
+        return sorted(name.replace('dataset-of-', '') for name, in q)
+
+    def _check_subtrees(self):
+        assert_equal(self._subtree('parent'),
+                     ['child', 'grandchild', 'parent'])
+        assert_equal(self._subtree('child'), ['child', 'grandchild'])
+        assert_equal(self._subtree('grandchild'), ['grandchild'])
+        assert_equal(self._subtree('deleted'),
+                     ['child-of-deleted-root', 'deleted'])
+
+    def _check_filter(self):
+        for organization in ('parent', self.ids['parent'], self.orgs['parent']):
+            assert_equal(self._datasets(organization, True),
+                         ['child', 'grandchild', 'parent'])
+            assert_equal(self._datasets(organization, False), ['parent'])
+        for organization in ('deleted', self.ids['deleted']):
+            assert_equal(self._datasets(organization, True),
+                         ['child-of-deleted-root', 'deleted'])
+        assert_equal(self._datasets(None, True), sorted(self.orgs))
+        with assert_raises(AssertionError):
+            self._datasets('unknown', True)
+
+    def test_subtree_ids(self):
+        self._check_subtrees()
+
+    def test_subtree_ids_memoized(self):
+        with lib.memoized_organization_tree():
+            self._check_subtrees()
+
+    def test_filter_by_organizations(self):
+        self._check_filter()
+
+    def test_filter_by_organizations_memoized(self):
+        with lib.memoized_organization_tree():
+            self._check_filter()
+
+    def test_cycle(self):
+        model.Session.add(model.Member(group=self.orgs['parent'],
+                                       table_id=self.ids['grandchild'],
+                                       table_name='group', capacity='parent',
+                                       state='active'))
+        model.Session.commit()
+        assert_equal(self._subtree('child'), ['child', 'grandchild', 'parent'])
+        with lib.memoized_organization_tree():
+            assert_equal(self._subtree('child'),
+                         ['child', 'grandchild', 'parent'])
+
+    def test_go_down_tree(self):
+        for one_query in (True, False):
+            assert_equal([org.name for org in lib.go_down_tree(
+                self.orgs['parent'], one_query=one_query)],
+                ['parent', 'child', 'grandchild'])
+
+
+class TestOrganizationTotals(object):
+    def setup(self):
+        reset_db()
+        parent = create_organization('parent')
+        child = create_organization('child', parent=parent)
+        create_organization('deleted', state='deleted')
+        create_dataset('with-resources', parent, num_resources=2)
+        create_dataset('without-resources', parent)
+        create_dataset('deleted-dataset', parent, num_resources=1,
+                       state='deleted')
+        create_dataset('of-child', child, num_resources=1)
+
+    def _stored_totals(self):
+        from ckanext.report import model as report_model
+        return model.Session.execute(
+            report_model.organization_totals_table.select()).fetchall()
+
+    def _check(self, totals):
+        assert_equal(sorted(totals), ['child', 'parent'])
+        parent = totals['parent']
+        assert_equal((parent['num_packages'],
+                      parent['num_packages_with_resources'],
+                      parent['num_resources']), (2, 1, 2))
+        assert_equal(parent['title'], 'Parent')
+
+    def test_counted_outside_a_run_without_writing(self):
+        self._check(lib.organization_totals())
+        assert_equal(self._stored_totals(), [])
+
+    def test_read_from_the_table_in_a_run(self):
+        with lib.generation_run():
+            assert_equal(len(self._stored_totals()), 2)
+            self._check(lib.organization_totals())
+            # not recounted during the run
+            create_dataset('another', model.Group.by_name('parent'))
+            assert_equal(
+                lib.organization_totals()['parent']['num_packages'], 2)
+        assert_equal(lib.organization_totals()['parent']['num_packages'], 3)
+
+    def test_refresh_does_not_commit_the_session(self):
+        model.Session.add(model.Tag(name='uncommitted'))
+        model.Session.flush()
+        lib.refresh_organization_totals()
+        model.Session.rollback()
+        assert not model.Tag.by_name('uncommitted')
+        assert_equal(len(self._stored_totals()), 2)
+
+    def test_organization_totals_for(self):
+        for in_run in (False, True):
+            with lib.generation_run() if in_run else _nothing():
+                totals = lib.organization_totals_for('parent')
+                assert_equal((totals['num_packages'],
+                              totals['num_resources']), (2, 2))
+                totals = lib.organization_totals_for(
+                    'parent', include_sub_organizations=True)
+                assert_equal((totals['num_packages'],
+                              totals['num_resources']), (3, 3))
+                assert_equal(totals['title'], 'Parent')
+                assert_equal(lib.organization_totals_for('deleted'), None)
+                assert_equal(lib.organization_totals_for('unknown'), None)
+
+
+@contextlib.contextmanager
+def _nothing():
+    yield
+
+
+class TestStreamQuery(object):
+    def setup(self):
+        reset_db()
+        for i in range(5):
+            create_dataset('dataset-%s' % i)
+
+    def _query(self):
+        return model.Session.query(model.Package.name.label('name')) \
+                    .order_by(model.Package.name)
+
+    def test_all_rows_in_batches(self):
+        names = [row.name for row in lib.stream_query(self._query(),
+                                                      batch_size=2)]
+        assert_equal(names, ['dataset-%s' % i for i in range(5)])
+
+    def test_session_can_be_committed_while_reading(self):
+        names = []
+        for row in lib.stream_query(self._query(), batch_size=2):
+            names.append(row.name)
+            create_dataset('new-%s' % row.name)
+        assert_equal(len(names), 5)
+        assert_equal(model.Session.query(model.Package).count(), 10)
+
+    def test_connection_is_closed_when_abandoned(self):
+        pool = model.meta.engine.pool
+        checked_out = pool.checkedout()
+        rows = lib.stream_query(self._query(), batch_size=2)
+        next(rows)
+        assert_equal(pool.checkedout(), checked_out + 1)
+        rows.close()
+        assert_equal(pool.checkedout(), checked_out)
@@ -0,0 +1,51 @@
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.report import lock
+
+
+class TestTryLockMany(object):
+    def test_locks_are_held_and_released(self):
+        with lock.try_lock_many([u'a', u'b']) as locked_keys:
+            assert_equal(locked_keys, [u'a', u'b'])
+            assert lock.is_locked(u'a')
+            assert lock.is_locked(u'b')
+        assert not lock.is_locked(u'a')
+        assert not lock.is_locked(u'b')
+
+    def test_keys_locked_elsewhere_are_left_out(self):
+        with lock.try_lock(u'b') as locked:
+            assert locked
+            with lock.try_lock_many([u'a', u'b', u'c']) as locked_keys:
+                assert_equal(locked_keys, [u'a', u'c'])
+            assert lock.is_locked(u'b')
+        assert not lock.is_locked(u'b')
+
+
+class TestIsLockedByAnotherProcess(object):
+    def setup(self):
+        if model.meta.engine.dialect.name != 'postgresql':
+            raise SkipTest('Locks are only shared between processes on '
+                           'PostgreSQL')
+        # a connection of its own stands in for another process
+        self.conn = model.meta.engine.connect()
+
+    def teardown(self):
+        self.conn.close()
+
+    def test_is_locked(self):
+        id_ = lock.lock_id(u'report?a=1')
+        self.conn.execute('SELECT pg_advisory_lock(%s)', (id_,))
+        try:
+            assert lock.is_locked(u'report?a=1')
+            assert not lock.is_locked(u'report?a=2')
+            assert not lock.is_locked_locally(u'report?a=1')
+            with lock.try_lock_many([u'report?a=1', u'report?a=2']) \
+                    as locked_keys:
+                assert_equal(locked_keys, [u'report?a=2'])
+            # the one it didn't get isn't held locally either
+            assert not lock.is_locked_locally(u'report?a=1')
+        finally:
+            self.conn.execute('SELECT pg_advisory_unlock(%s)', (id_,))
+        assert not lock.is_locked(u'report?a=1')
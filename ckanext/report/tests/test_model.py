@@ -0,0 +1,354 @@
+import datetime
+import json
+
+import mock
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal
+from pylons import config
+from sqlalchemy import event, select, text
+
+from ckan import model
+from ckanext.report import cache
+from ckanext.report import model as report_model
+from ckanext.report.model import DataCache
+from ckanext.report.tests import reset_db
+
+
+def _stored_values():
+    table = report_model.data_cache_table
+    return dict(((object_id, key), value) for object_id, key, value in
+                model.Session.execute(select([table.c.object_id, table.c.key,
+                                              table.c.value])))
+
+
+class TestSetMany(object):
+    def setup(self):
+        reset_db()
+
+    def _set_twice(self):
+        DataCache.set_many([(None, u'report?a=1', u'1'),
+                            (u'org', u'report?a=1', u'2')])
+        DataCache.set_many([(None, u'report?a=1', u'3'),
+                            (None, u'report?a=2', u'4')])
+        model.Session.commit()
+        assert_equal(_stored_values(), {(None, u'report?a=1'): u'3',
+                                        (u'org', u'report?a=1'): u'2',
+                                        (None, u'report?a=2'): u'4'})
+
+    def test_upsert(self):
+        self._set_twice()
+
+    def test_without_upsert(self):
+        # e.g. PostgreSQL before 9.5
+        with mock.patch.object(report_model, 'supports_upsert',
+                               return_value=False):
+            self._set_twice()
+
+    def test_report_name(self):
+        DataCache.set_many([(None, u'report?a=1', u'1'),
+                            (None, u'report#watermark', u'2')])
+        table = report_model.data_cache_table
+        assert_equal(dict(model.Session.execute(
+            select([table.c.key, table.c.report_name])).fetchall()),
+            {u'report?a=1': u'report', u'report#watermark': None})
+
+
+class TestGetWithoutConvertJson(object):
+    '''Values are stored compressed and in the typed format, but get()
+    without convert_json returns the plain JSON text, as it always has.'''
+    value = {'date': datetime.datetime(2015, 3, 4, 5, 6, 7),
+             'text': u'x' * 20000}
+    plain = {'date': u'2015-03-04T05:06:07', 'text': u'x' * 20000}
+
+    def setup(self):
+        reset_db()
+
+    def test_compressed(self):
+        DataCache.set(None, u'report?a=1', self.value, convert_json=True)
+        model.Session.commit()
+        stored = _stored_values()[(None, u'report?a=1')]
+        assert stored.startswith(report_model.COMPRESSED_PREFIX), stored[:10]
+
+        value, date = DataCache.get(None, u'report?a=1')
+        assert_equal(json.loads(value), self.plain)
+        value, date = DataCache.get(None, u'report?a=1', convert_json=True)
+        assert_equal(value, self.value)
+
+    def test_get_many(self):
+        DataCache.set_many([(None, u'report?a=1', {'a': 1})],
+                           convert_json=True)
+        value, date = DataCache.get_many([(None, u'report?a=1')])[
+            (None, u'report?a=1')]
+        assert_equal(json.loads(value), {'a': 1})
+
+    def test_not_json(self):
+        DataCache.set(None, u'report?a=1', u'2112')
+        assert_equal(DataCache.get(None, u'report?a=1')[0], u'2112')
+
+    def test_get_created(self):
+        created = DataCache.set(None, u'report?a=1', u'2112')
+        assert_equal(DataCache.get_created(None, u'report?a=1'), created)
+        assert_equal(DataCache.get_created(None, u'report?a=2'), None)
+
+
+class TestMigrateTables(object):
+    def setup(self):
+        reset_db()
+
+    def test_can_run_again(self):
+        report_model.migrate_tables()
+        report_model.migrate_tables()
+        conn = model.Session.connection()
+        for index in ('idx_data_cache_object_id_key_unique',
+                      'idx_data_cache_report_name',
+                      report_model.BROKEN_LINKS_INDEX):
+            assert report_model._index_exists(conn, index), index
+
+    def test_replaces_old_broken_links_index(self):
+        with model.meta.engine.begin() as conn:
+            conn.execute(text('DROP INDEX %s' %
+                              report_model.BROKEN_LINKS_INDEX))
+            conn.execute(text('''
+                CREATE INDEX idx_task_status_broken_link
+                ON task_status (entity_id) WHERE key = 'error_code'
+                '''))
+        report_model.migrate_tables()
+        conn = model.Session.connection()
+        assert report_model._index_exists(conn,
+                                          report_model.BROKEN_LINKS_INDEX)
+        assert not report_model._index_exists(conn,
+                                              'idx_task_status_broken_link')
+
+    def test_rebuilds_invalid_broken_links_index(self):
+        # as left by a CREATE INDEX CONCURRENTLY that failed
+        if model.meta.engine.dialect.name != 'postgresql':
+            raise SkipTest('Only PostgreSQL builds the index concurrently')
+        is_valid = text('''
+            SELECT pg_index.indisvalid FROM pg_index
+            JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+            WHERE pg_class.relname = :name''')
+        with model.meta.engine.begin() as conn:
+            conn.execute(text('''
+                UPDATE pg_index SET indisvalid = false
+                FROM pg_class WHERE pg_class.oid = pg_index.indexrelid
+                AND pg_class.relname = :name'''),
+                name=report_model.BROKEN_LINKS_INDEX)
+            assert_equal(conn.execute(
+                is_valid, name=report_model.BROKEN_LINKS_INDEX).scalar(),
+                False)
+        report_model.migrate_tables()
+        assert_equal(model.meta.engine.execute(
+            is_valid, name=report_model.BROKEN_LINKS_INDEX).scalar(), True)
+
+    def test_removes_duplicates_and_fills_in_report_name(self):
+        table = report_model.data_cache_table
+        with model.meta.engine.begin() as conn:
+            conn.execute(text(
+                'DROP INDEX idx_data_cache_object_id_key_unique'))
+            conn.execute(table.insert(), [
+                {'id': u'1', 'object_id': None, 'key': u'report?a=1',
+                 'value': u'old', 'created': '2015-01-01'},
+                {'id': u'2', 'object_id': None, 'key': u'report?a=1',
+                 'value': u'new', 'created': '2015-01-02'},
+                {'id': u'3', 'object_id': u'org', 'key': u'report?a=1',
+                 'value': u'org old', 'created': '2015-01-01'},
+                {'id': u'4', 'object_id': u'org', 'key': u'report?a=1',
+                 'value': u'org new', 'created': '2015-01-03'},
+                {'id': u'5', 'object_id': u'org', 'key': u'report?a=1',
+                 'value': u'org older', 'created': '2014-01-01'},
+                {'id': u'6', 'object_id': u'org', 'key': u'report?a=2',
+                 'value': u'other', 'created': '2014-01-01'}])
+        report_model.migrate_tables()
+        assert_equal(
+            sorted(model.Session.execute(
+                select([table.c.value, table.c.report_name])).fetchall()),
+            [(u'new', u'report'), (u'org new', u'report'),
+             (u'other', u'report')])
+
+    def test_removes_duplicates_without_window_functions(self):
+        # e.g. on SQLite before 3.25 - only GROUP BY is used
+        statements = []
+
+        def before_execute(conn, clauseelement, multiparams, params):
+            statements.append(unicode(clauseelement))
+        event.listen(model.meta.engine, 'before_execute', before_execute)
+        try:
+            report_model.migrate_tables()
+        finally:
+            event.remove(model.meta.engine, 'before_execute', before_execute)
+        assert statements
+        assert not [statement for statement in statements
+                    if 'OVER' in statement.upper()]
+
+
+class TestReportNameIsSet(object):
+    '''Records stored before report_name existed get it when updated.'''
+    def setup(self):
+        reset_db()
+        table = report_model.data_cache_table
+        model.Session.execute(table.insert(), [
+            {'id': u'1', 'object_id': None, 'key': u'report?a=1',
+             'value': u'old', 'created': datetime.datetime(2015, 1, 1)}])
+        model.Session.commit()
+
+    def _report_names(self):
+        table = report_model.data_cache_table
+        return model.Session.execute(
+            select([table.c.report_name])).fetchall()
+
+    def test_set(self):
+        DataCache.set(None, u'report?a=1', u'new')
+        model.Session.commit()
+        assert_equal(self._report_names(), [(u'report',)])
+
+    def test_set_many_without_upsert(self):
+        with mock.patch.object(report_model, 'supports_upsert',
+                               return_value=False):
+            DataCache.set_many([(None, u'report?a=1', u'new')])
+        model.Session.commit()
+        assert_equal(self._report_names(), [(u'report',)])
+
+    def test_set_many(self):
+        DataCache.set_many([(None, u'report?a=1', u'new')])
+        model.Session.commit()
+        assert_equal(self._report_names(), [(u'report',)])
+
+
+class TestReportSummaries(object):
+    def setup(self):
+        reset_db()
+
+    def test_summaries(self):
+        DataCache.set_many([(None, u'report-a?a=1', u'12345'),
+                            (u'org', u'report-a?a=2', u'123'),
+                            (None, u'report-b?a=1', u'1'),
+                            (None, u'report-a#watermark', u'"2015"')])
+        model.Session.commit()
+        created = DataCache.get_created(None, u'report-a?a=1')
+        summaries = DataCache.get_report_summaries()
+        assert_equal(sorted(summaries), [u'report-a', u'report-b'])
+        assert_equal(summaries[u'report-a'], (2, created, created, 8))
+        assert_equal(summaries[u'report-b'][0], 1)
+
+    def test_get_created_for_keys(self):
+        created = DataCache.set(None, u'report-a?a=1', u'1')
+        assert_equal(DataCache.get_created_for_keys([u'report-a?a=1',
+                                                     u'report-a?a=2']),
+                     {u'report-a?a=1': created})
+        assert_equal(DataCache.get_created_for_keys([]), {})
+
+
+class TestDataCacheStatsSetMany(object):
+    def setup(self):
+        reset_db()
+
+    def _set_twice(self):
+        first = datetime.datetime(2015, 1, 1)
+        second = datetime.datetime(2015, 1, 2)
+        report_model.DataCacheStats.set_many(
+            [(None, u'report?a=1', u'report', {'wall_time': 1.0}),
+             (u'org', u'report?a=1', u'report', {'wall_time': 2.0})], first)
+        report_model.DataCacheStats.set_many(
+            [(None, u'report?a=1', u'report', {'wall_time': 3.0,
+                                               'num_rows': 10})], second)
+        model.Session.commit()
+        stats = sorted((s.object_id, s.wall_time, s.num_rows, s.created)
+                       for s in report_model.DataCacheStats.get_all())
+        assert_equal(stats, [(None, 3.0, 10, second),
+                             (u'org', 2.0, None, first)])
+
+    def test_upsert(self):
+        self._set_twice()
+
+    def test_without_upsert(self):
+        with mock.patch.object(report_model, 'supports_upsert',
+                               return_value=False):
+            self._set_twice()
+
+
+class TestAddViews(object):
+    def setup(self):
+        reset_db()
+
+    def _add_twice(self):
+        first = datetime.datetime(2015, 1, 1)
+        second = datetime.datetime(2015, 1, 2)
+        with model.meta.engine.begin() as conn:
+            report_model.DataCacheAccess.add_views(
+                conn, [(u'report?a=1', 2, second), (u'report?a=2', 1, first)])
+        with model.meta.engine.begin() as conn:
+            report_model.DataCacheAccess.add_views(
+                conn, [(u'report?a=1', 3, first)])
+        views = report_model.DataCacheAccess.get_views(u'report')
+        assert_equal(views, {u'report?a=1': (5, second),
+                             u'report?a=2': (1, first)})
+
+    def test_upsert(self):
+        self._add_twice()
+
+    def test_without_upsert(self):
+        with mock.patch.object(report_model, 'supports_upsert',
+                               return_value=False):
+            self._add_twice()
+
+
+class TestCompression(object):
+    def setup(self):
+        reset_db()
+
+    def _large_value(self):
+        return {'table': [{'name': u'dataset-%s' % i, 'notes': u'notes ' * 10}
+                          for i in range(1000)]}
+
+    def test_compress_value(self):
+        small = report_model.encode_json({'a': 1})
+        assert not small.startswith(report_model.COMPRESSED_PREFIX)
+        large = report_model.encode_json(self._large_value())
+        assert large.startswith(report_model.COMPRESSED_PREFIX)
+        assert len(large) < len(json.dumps(self._large_value())) / 10
+        assert_equal(report_model.decode_json(large), self._large_value())
+        # compressing again leaves it as it is
+        assert_equal(report_model.compress_value(large), large)
+
+    def test_threshold_config(self):
+        with mock.patch.dict(config, {
+                'ckanext-report.data_cache.compress_threshold': '5'}):
+            assert report_model.encode_json({'a': 1}).startswith(
+                report_model.COMPRESSED_PREFIX)
+        with mock.patch.dict(config, {
+                'ckanext-report.data_cache.compress': 'false'}):
+            assert not report_model.encode_json(
+                self._large_value()).startswith(
+                    report_model.COMPRESSED_PREFIX)
+
+    def test_stored_compressed(self):
+        DataCache.set(None, u'report?a=1', self._large_value(),
+                      convert_json=True)
+        model.Session.commit()
+        assert _stored_values()[(None, u'report?a=1')].startswith(
+            report_model.COMPRESSED_PREFIX)
+        cache.decoded_values().clear()
+        assert_equal(DataCache.get(None, u'report?a=1', convert_json=True)[0],
+                     self._large_value())
+
+    def test_compress_existing_values(self):
+        with mock.patch.dict(config, {
+                'ckanext-report.data_cache.compress': 'false'}):
+            DataCache.set_many([
+                (None, u'report?a=1', self._large_value()),
+                (None, u'report?a=2', {'a': 1}),
+                (None, u'other?a=1', self._large_value())],
+                convert_json=True)
+        model.Session.commit()
+        stats = report_model.compress_existing_values([u'report'],
+                                                      batch_size=1)
+        assert_equal((stats['values'], stats['compressed']), (2, 1))
+        assert stats['size_after'] < stats['size_before']
+        stored = _stored_values()
+        assert stored[(None, u'report?a=1')].startswith(
+            report_model.COMPRESSED_PREFIX)
+        assert not stored[(None, u'other?a=1')].startswith(
+            report_model.COMPRESSED_PREFIX)
+        cache.decoded_values().clear()
+        assert_equal(DataCache.get(None, u'report?a=1', convert_json=True)[0],
+                     self._large_value())
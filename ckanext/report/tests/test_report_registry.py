@@ -0,0 +1,579 @@
+import datetime
+import logging
+import time
+
+import mock
+from nose.tools import assert_equal, assert_raises
+from sqlalchemy import select
+
+from ckan import model
+from ckan.common import OrderedDict
+from ckanext.report import lock
+from ckanext.report import model as report_model
+from ckanext.report import report_registry
+from ckanext.report import reports
+from ckanext.report.command import ReportCommand
+from ckanext.report.report_registry import Report, ReportRegistry
+from ckanext.report.tests import reset_db, create_organization, create_dataset
+
+
+def _report(name='tagless-datasets'):
+    return ReportRegistry.instance().get_report(name)
+
+
+def _options(organization=None):
+    return {'organization': organization,
+            'include_sub_organizations': False}
+
+
+class TestRefreshEach(object):
+    def setup(self):
+        reset_db()
+        create_dataset('tagless', create_organization('test-org'))
+
+    def test_saved_while_locked(self):
+        report = _report()
+        key = report.generate_key(_options('test-org'))
+        locked_while_saving = []
+        save_to_cache = report._save_to_cache
+
+        def _save_to_cache(results):
+            locked_while_saving.append(lock.is_locked_locally(key))
+            return save_to_cache(results)
+        report._save_to_cache = _save_to_cache
+        try:
+            skipped = report._refresh_each([_options('test-org')])
+        finally:
+            del report._save_to_cache
+        assert_equal(skipped, [])
+        assert_equal(locked_while_saving, [True])
+        assert not lock.is_locked_locally(key)
+        data, date = report_model.DataCache.get(u'test-org', key,
+                                                convert_json=True)
+        assert_equal(data['num_packages'], 1)
+
+    def test_skips_options_being_generated(self):
+        report = _report()
+        key = report.generate_key(_options('test-org'))
+        with lock.try_lock(key) as locked:
+            assert locked
+            skipped = report._refresh_each([_options(None),
+                                            _options('test-org')])
+        assert_equal(skipped, [key])
+        model.Session.remove()
+        assert_equal(report_model.DataCache.get(u'test-org', key),
+                     (None, None))
+        assert report_model.DataCache.get(
+            None, report.generate_key(_options(None)))[0] is not None
+
+
+class TestGetMetadata(object):
+    def setup(self):
+        reset_db()
+
+    def test_metadata(self):
+        registry = ReportRegistry.instance()
+        report = _report()
+        report_model.DataCache.set_many([
+            (None, report.generate_key(report.option_defaults), u'1234'),
+            (u'org', report.generate_key(_options(u'org')), u'12'),
+            (None, u'%s#watermark' % report.name, u'"2015"')])
+        model.Session.commit()
+        metadata = registry.get_metadata()
+        assert_equal(sorted(metadata),
+                     sorted(name for plugin, name, title in
+                            registry.get_names()))
+        tagless = metadata[report.name]
+        assert_equal(tagless['num_cached'], 2)
+        assert_equal(tagless['size'], 6)
+        assert tagless['cached_date']
+        assert_equal(tagless['oldest_date'], tagless['cached_date'])
+        assert_equal(tagless['newest_date'], tagless['cached_date'])
+        assert_equal(metadata['broken-links'],
+                     {'cached_date': None, 'oldest_date': None,
+                      'newest_date': None, 'num_cached': 0, 'size': 0})
+
+
+class TestRefreshCacheInRun(object):
+    def setup(self):
+        reset_db()
+        self.generated = []
+        self.generated_in_bulk = []
+        self.delay = 0
+        self.registry = ReportRegistry.__new__(ReportRegistry)
+        self.registry._reports = {}
+        for name, bulk in (('bulk-test', True), ('each-test', False)):
+            info = {
+                'name': name,
+                'option_defaults': OrderedDict((('n', 0),)),
+                'option_combinations':
+                    lambda: [{'n': n} for n in range(5)],
+                'generate': self._generate,
+                'template': 'report/test.html',
+                }
+            if bulk:
+                info['generate_bulk'] = self._generate_bulk
+            self.registry._reports[name] = Report(info, 'test')
+
+    def _generate(self, n):
+        self.generated.append(n)
+        return {'n': n}
+
+    def _generate_bulk(self):
+        for n in range(5):
+            self.generated_in_bulk.append(n)
+            time.sleep(self.delay)
+            yield {'n': n}, {'n': n}
+
+    def _cached(self, name):
+        return sorted(key for object_id, key, created in
+                      report_model.DataCache.get_all_metadata(name))
+
+    def _keys(self, name, numbers):
+        return ['%s?n=%s' % (name, n) for n in numbers]
+
+    def test_run(self):
+        run, failures, complete = self.registry.refresh_cache_in_run()
+        assert complete
+        assert_equal(failures, [])
+        assert_equal(self.generated_in_bulk, range(5))
+        assert_equal(sorted(self.generated), range(5))
+        assert_equal(run.state, report_model.GenerationRun.COMPLETE)
+        assert_equal(self._cached('bulk-test'),
+                     self._keys('bulk-test', range(5)))
+        assert_equal(run.done_keys(),
+                     set(self._keys('bulk-test', range(5)) +
+                         self._keys('each-test', range(5)) +
+                         ['bulk-test#bulk']))
+
+    def test_bulk_report_stops_at_deadline_and_resumes(self):
+        self.delay = 0.6
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=1)
+        with mock.patch.object(report_registry, 'CACHE_WRITE_BATCH_SIZE', 2):
+            run, failures, complete = self.registry.refresh_cache_in_run(
+                ['bulk-test'], deadline=deadline)
+        assert not complete
+        assert_equal(run.state, report_model.GenerationRun.STOPPED)
+        # stopped after the first batch was saved
+        assert_equal(self._cached('bulk-test'),
+                     self._keys('bulk-test', [0, 1]))
+        assert_equal(run.done_keys(), set(self._keys('bulk-test', [0, 1])))
+
+        self.generated_in_bulk = []
+        resumed, failures, complete = self.registry.refresh_cache_in_run(
+            ['bulk-test'], resume=True)
+        assert complete
+        assert_equal(resumed.id, run.id)
+        # the rest are done one at a time
+        assert_equal(self.generated_in_bulk, [])
+        assert_equal(sorted(self.generated), [2, 3, 4])
+        assert_equal(self._cached('bulk-test'),
+                     self._keys('bulk-test', range(5)))
+
+    def test_skipped_items_are_left_to_resume(self):
+        key = 'each-test?n=3'
+        with lock.try_lock(key) as locked:
+            assert locked
+            run, failures, complete = self.registry.refresh_cache_in_run(
+                ['each-test'])
+        assert not complete
+        assert_equal(failures, [])
+        assert key not in run.done_keys()
+        assert_equal(sorted(self.generated), [0, 1, 2, 4])
+
+        resumed, failures, complete = self.registry.refresh_cache_in_run(
+            ['each-test'], resume=True)
+        assert complete
+        assert_equal(resumed.id, run.id)
+        assert_equal(sorted(self.generated), [0, 1, 2, 3, 4])
+        assert key in run.done_keys()
+
+    def test_bulk_generation_skips_keys_being_generated(self):
+        report = self.registry.get_report('bulk-test')
+        with lock.try_lock('bulk-test?n=2') as locked:
+            assert locked
+            report.refresh_cache_for_all_options()
+        assert_equal(self._cached('bulk-test'),
+                     self._keys('bulk-test', [0, 1, 3, 4]))
+
+    def test_checkpoints_skip_keys_being_generated(self):
+        checkpoints = []
+        report = self.registry.get_report('bulk-test')
+        with lock.try_lock('bulk-test?n=2') as locked:
+            assert locked
+            assert_equal(report.refresh_cache_with_checkpoints(
+                checkpoints.append), 'done')
+        assert_equal(checkpoints, self._keys('bulk-test', [0, 1, 3, 4]))
+
+    def test_refresh_while_the_bulk_report_is_generated(self):
+        report = self.registry.get_report('bulk-test')
+        report_model.DataCache.set(None, 'bulk-test?n=2', {'n': 'old'},
+                                   convert_json=True)
+        model.Session.commit()
+        with lock.try_lock('bulk-test#bulk') as locked:
+            assert locked
+            data, date = report.refresh_cache({'n': 2})
+            assert_equal(data, {'n': 'old'})
+            assert_equal(self.generated, [])
+            # not cached, so it has to be generated
+            data, date = report.refresh_cache({'n': 3})
+            assert_equal(data, {'n': 3})
+        data, date = report.refresh_cache({'n': 2})
+        assert_equal(data, {'n': 2})
+
+    def test_skipped_bulk_report(self):
+        with lock.try_lock('bulk-test#bulk') as locked:
+            assert locked
+            run, failures, complete = self.registry.refresh_cache_in_run(
+                ['bulk-test'])
+        assert not complete
+        assert_equal(run.done_keys(), set())
+        assert_equal(self.generated_in_bulk, [])
+
+
+class TestGenerateCommand(object):
+    def _generate(self, **options):
+        # (not instantiated, as that adds the options to the shared parser)
+        command = ReportCommand.__new__(ReportCommand)
+        command.options = mock.Mock(workers=1, incremental=False,
+                                    deadline=None, resume=False,
+                                    only_stale=False)
+        command.options.configure_mock(**options)
+        command.log = logging.getLogger(__name__)
+        command._generate()
+
+    def test_deadline_and_resume_need_a_run(self):
+        for options in ({'workers': 2, 'deadline': '2h'},
+                        {'workers': 2, 'resume': True},
+                        {'incremental': True, 'resume': True}):
+            with assert_raises(SystemExit):
+                self._generate(**options)
+
+
+class TestStaleWhileRevalidate(object):
+    def setup(self):
+        reset_db()
+        create_dataset('tagless', create_organization('test-org'))
+        self.report = _report()
+        self.key = self.report.generate_key(_options('test-org'))
+        report_model.DataCache.set(u'test-org', self.key,
+                                   {'num_packages': 5}, convert_json=True)
+        model.Session.execute(report_model.data_cache_table.update().values(
+            created=datetime.datetime.now() - datetime.timedelta(days=2)))
+        model.Session.commit()
+
+    def _get(self, enabled):
+        from pylons import config
+        with mock.patch.dict(config, {
+                'ckanext-report.stale_while_revalidate': str(enabled)}):
+            with mock.patch.object(Report, 'refresh_cache_in_background') \
+                    as refresh_in_background:
+                result = self.report.get_fresh_or_stale_report(
+                    **_options('test-org'))
+        return result, refresh_in_background
+
+    def test_stale_report_is_served(self):
+        (data, date, refreshing), refresh_in_background = self._get(True)
+        assert refreshing
+        assert_equal(data['num_packages'], 5)
+        refresh_in_background.assert_called_once_with(_options('test-org'))
+
+    def test_stale_report_is_regenerated_when_disabled(self):
+        (data, date, refreshing), refresh_in_background = self._get(False)
+        assert not refreshing
+        assert_equal(data['num_packages'], 1)
+        assert not refresh_in_background.called
+
+    def test_one_background_refresh_per_key(self):
+        with mock.patch.object(report_registry.threading, 'Thread') \
+                as thread:
+            self.report.refresh_cache_in_background(_options('test-org'))
+            self.report.refresh_cache_in_background(_options('test-org'))
+        assert_equal(thread.call_count, 1)
+        report_registry._background_refreshes.discard(self.key)
+
+    def test_background_refresh(self):
+        report_registry._background_refreshes.add(self.key)
+        self.report._refresh_cache_in_thread(_options('test-org'), self.key)
+        assert self.key not in report_registry._background_refreshes
+        data, date = report_model.DataCache.get_if_fresh(
+            u'test-org', self.key, convert_json=True)
+        assert_equal(data['num_packages'], 1)
+
+
+class TestRefreshCacheIncremental(object):
+    def setup(self):
+        reset_db()
+        self.report = _report('broken-links')
+        self.resources = {}
+        for name in ('org-a', 'org-b'):
+            create_dataset('%s-dataset' % name, create_organization(name),
+                           num_resources=1)
+        for resource in model.Session.query(model.Resource):
+            self.resources[resource.url.split('/')[3][:5]] = resource
+        self._break('org-a', datetime.datetime.now() -
+                    datetime.timedelta(hours=1))
+
+    def _break(self, organization, last_updated):
+        model.Session.add(model.TaskStatus(
+            entity_id=self.resources[organization].id,
+            entity_type='resource', task_type='archiver', key='error_code',
+            value='404', last_updated=last_updated))
+        model.Session.commit()
+
+    def _cached(self):
+        return dict((key, created) for object_id, key, created in
+                    report_model.DataCache.get_all_metadata(
+                        self.report.name))
+
+    def test_first_run_generates_everything(self):
+        self.report.refresh_cache_incremental()
+        assert_equal(sorted(self._cached()),
+                     [self.report.generate_key(_options(None)),
+                      self.report.generate_key(_options('org-a'))])
+        assert self.report.get_watermark()
+
+    def test_only_changed_options_are_generated(self):
+        self.report.refresh_cache_incremental()
+        before = self._cached()
+        self._break('org-b', datetime.datetime.now())
+        self.report.refresh_cache_incremental()
+        after = self._cached()
+        org_a_key = self.report.generate_key(_options('org-a'))
+        org_b_key = self.report.generate_key(_options('org-b'))
+        index_key = self.report.generate_key(_options(None))
+        assert_equal(after[org_a_key], before[org_a_key])
+        assert org_b_key in after
+        assert after[index_key] > before[index_key]
+        index, date = report_model.DataCache.get(None, index_key,
+                                                 convert_json=True)
+        assert_equal(index[0]['num_broken_resources'], 2)
+        assert_equal(self.report.get_watermark(),
+                     reports.broken_link_watermark())
+    def test_options_skipped_are_regenerated_by_the_next_run(self):
+        self.report.refresh_cache_incremental()
+        watermark = self.report.get_watermark()
+        self._break('org-b', datetime.datetime.now())
+        org_b_key = self.report.generate_key(_options('org-b'))
+        with lock.try_lock(org_b_key) as locked:
+            assert locked
+            self.report.refresh_cache_incremental()
+        assert org_b_key not in self._cached()
+        assert_equal(self.report.get_watermark(), watermark)
+
+        self.report.refresh_cache_incremental()
+        assert org_b_key in self._cached()
+        assert_equal(self.report.get_watermark(),
+                     reports.broken_link_watermark())
+
+    def test_summary_skipped(self):
+        self.report.refresh_cache_incremental()
+        watermark = self.report.get_watermark()
+        self._break('org-b', datetime.datetime.now())
+        index_key = self.report.generate_key(_options(None))
+        with lock.try_lock(index_key) as locked:
+            assert locked
+            self.report.refresh_cache_incremental()
+        assert_equal(self.report.get_watermark(), watermark)
+        self.report.refresh_cache_incremental()
+        index, date = report_model.DataCache.get(None, index_key,
+                                                 convert_json=True)
+        assert_equal(index[0]['num_broken_resources'], 2)
+
+
+def _numbered_report(name='numbered'):
+    '''Returns a report with option combinations n=0 to 4.'''
+    return Report({
+        'name': name,
+        'option_defaults': OrderedDict((('n', 0),)),
+        'option_combinations': lambda: [{'n': n} for n in range(5)],
+        'generate': lambda n: {'n': n},
+        'template': 'report/test.html',
+        }, 'test')
+
+
+def _cache_numbered(ages_in_days):
+    '''Caches the numbered report for the given n: age in days.'''
+    for n, days in ages_in_days.items():
+        key = u'numbered?n=%s' % n
+        report_model.DataCache.set(None, key, u'{}')
+        model.Session.execute(
+            report_model.data_cache_table.update()
+            .where(report_model.data_cache_table.c.key == key)
+            .values(created=datetime.datetime.now() -
+                    datetime.timedelta(days=days)))
+    model.Session.commit()
+
+
+class TestCacheStatus(object):
+    def setup(self):
+        reset_db()
+        self.report = _numbered_report()
+        # 3 and 4 are missing, 9 is not an option combination
+        _cache_numbered({0: 0, 1: 2, 2: 10, 9: 0})
+
+    def test_status(self):
+        status = self.report.cache_status()
+        assert_equal(status['num_combinations'], 5)
+        assert_equal(status['num_cached'], 3)
+        assert_equal(status['coverage'], 0.6)
+        assert_equal(status['num_fresh'], 1)
+        assert_equal(dict(status['ages']),
+                     {'<1h': 1, '<1d': 0, '<7d': 1, '>=7d': 1})
+        assert status['oldest_date'] < status['newest_date']
+        assert_equal(status['missing'], ['numbered?n=3', 'numbered?n=4'])
+        assert_equal(status['stale'], ['numbered?n=1', 'numbered?n=2'])
+        assert_equal(status['orphaned'], ['numbered?n=9'])
+
+    def test_given_option_combinations(self):
+        status = self.report.cache_status([{'n': 0}, {'n': 3}])
+        assert_equal(status['num_combinations'], 2)
+        assert_equal(status['coverage'], 0.5)
+        assert_equal(status['missing'], ['numbered?n=3'])
+        assert_equal(status['orphaned'],
+                     ['numbered?n=1', 'numbered?n=2', 'numbered?n=9'])
+
+    def test_nothing_cached(self):
+        reset_db()
+        status = self.report.cache_status()
+        assert_equal(status['num_cached'], 0)
+        assert_equal(status['oldest_date'], None)
+        assert_equal(len(status['missing']), 5)
+
+    def test_stale_option_combinations(self):
+        assert_equal(self.report.get_stale_option_combinations(),
+                     [{'n': 3}, {'n': 4}, {'n': 1}, {'n': 2}])
+
+
+class TestGarbageCollect(object):
+    def setup(self):
+        reset_db()
+        self.report = _numbered_report()
+        _cache_numbered({0: 0, 8: 0, 9: 0})
+        report_model.DataCache.set(None, u'numbered#watermark', u'"2015"')
+        report_model.DataCacheStats.set_many(
+            [(None, u'numbered?n=%s' % n, u'numbered', {'num_rows': 1})
+             for n in (0, 9)], datetime.datetime.now())
+        model.Session.commit()
+        with model.meta.engine.begin() as conn:
+            report_model.DataCacheAccess.add_views(
+                conn, [(u'numbered?n=9', 1, datetime.datetime.now())])
+
+    def _cached_keys(self, table):
+        return sorted(key for key, in model.Session.execute(
+            select([table.c.key])))
+
+    def test_orphaned_keys_are_deleted(self):
+        assert_equal(self.report.garbage_collect(), 2)
+        assert_equal(self._cached_keys(report_model.data_cache_table),
+                     [u'numbered#watermark', u'numbered?n=0'])
+        assert_equal(self._cached_keys(report_model.data_cache_stats_table),
+                     [u'numbered?n=0'])
+        assert_equal(self._cached_keys(report_model.data_cache_access_table),
+                     [])
+
+    def test_nothing_to_delete(self):
+        self.report.garbage_collect()
+        assert_equal(self.report.garbage_collect(), 0)
+
+    def test_delete_keys_in_batches(self):
+        deleted = report_model.DataCache.delete_keys(
+            u'numbered', [u'numbered?n=0', u'numbered?n=8', u'numbered?n=9'],
+            batch_size=2)
+        assert_equal(deleted, 3)
+        assert_equal(self._cached_keys(report_model.data_cache_table),
+                     [u'numbered#watermark'])
+
+    def test_delete_keys_of_another_report(self):
+        assert_equal(report_model.DataCache.delete_keys(
+            u'other', [u'numbered?n=9']), 0)
+        assert u'numbered?n=9' in \
+            self._cached_keys(report_model.data_cache_table)
+
+
+class TestRunItems(object):
+    def setup(self):
+        reset_db()
+        self.registry = ReportRegistry.__new__(ReportRegistry)
+        self.registry._reports = {'numbered': _numbered_report()}
+        # 2 and 3 are missing
+        _cache_numbered({0: 2, 1: 0.5, 4: 0.1})
+        now = datetime.datetime.now()
+        with model.meta.engine.begin() as conn:
+            report_model.DataCacheAccess.add_views(
+                conn, [(u'numbered?n=1', 5, now), (u'numbered?n=2', 3, now)])
+
+    def _keys(self, **kwargs):
+        return [key for report, option_dict, key
+                in self.registry._run_items(**kwargs)]
+
+    def test_missing_first_then_stale_and_popular(self):
+        assert_equal(self._keys(), ['numbered?n=2', 'numbered?n=3',
+                                    'numbered?n=1', 'numbered?n=0',
+                                    'numbered?n=4'])
+
+    def test_rarely_viewed_are_left_out(self):
+        from pylons import config
+        with mock.patch.dict(config,
+                             {'ckanext-report.lazy_refresh_after': '0.5'}):
+            assert_equal(self._keys(), ['numbered?n=2', 'numbered?n=3',
+                                        'numbered?n=1', 'numbered?n=0'])
+
+    def test_only_stale(self):
+        assert_equal(self._keys(only_stale=True),
+                     ['numbered?n=2', 'numbered?n=3', 'numbered?n=0'])
+
+    def test_bulk_report_is_one_item(self):
+        report = self.registry._reports['numbered']
+        report.generate_bulk = lambda: iter([])
+        items = self.registry._run_items()
+        assert_equal(items, [(report, None, 'numbered#bulk')])
+
+
+class TestRefreshCacheJob(object):
+    def setup(self):
+        reset_db()
+        create_dataset('tagless', create_organization('test-org'))
+
+    def test_job(self):
+        result = report_registry._refresh_cache_job(
+            ('tagless-datasets', _options('test-org')))
+        assert_equal(result,
+                     ('tagless-datasets', _options('test-org'), None, []))
+        data, date = report_model.DataCache.get(
+            u'test-org', _report().generate_key(_options('test-org')),
+            convert_json=True)
+        assert_equal(data['num_packages'], 1)
+
+    def test_failed_job(self):
+        with mock.patch.object(Report, '_generate_and_save',
+                               side_effect=ValueError('oops')):
+            result = report_registry._refresh_cache_job(
+                ('tagless-datasets', _options('test-org')))
+        assert_equal(result, ('tagless-datasets', _options('test-org'),
+                              'ValueError: oops', []))
+
+    def test_job_being_generated_elsewhere_is_skipped(self):
+        key = _report().generate_key(_options('test-org'))
+        with lock.try_lock(key) as locked:
+            assert locked
+            with mock.patch.object(Report, 'refresh_cache') as refresh_cache:
+                result = report_registry._refresh_cache_job(
+                    ('tagless-datasets', _options('test-org')))
+        assert not refresh_cache.called
+        assert_equal(result, ('tagless-datasets', _options('test-org'),
+                              None, [key]))
+        assert_equal(report_model.DataCache.get(u'test-org', key),
+                     (None, None))
+
+    def test_in_parallel(self):
+        failures, skipped = ReportRegistry.instance() \
+            .refresh_cache_in_parallel(['tagless-datasets'], workers=2)
+        assert_equal(failures, [])
+        assert_equal(skipped, [])
+        cached = sorted(key for object_id, key, created in
+                        report_model.DataCache.get_all_metadata(
+                            'tagless-datasets'))
+        assert_equal(cached, sorted(
+            _report().generate_key(options)
+            for options in (_options(None), _options('test-org'))))
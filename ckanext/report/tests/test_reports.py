@@ -0,0 +1,225 @@
+import datetime
+import json
+import uuid
+
+import mock
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.report import lib
+from ckanext.report import model as report_model
+from ckanext.report import reports
+from ckanext.report import stats
+from ckanext.report.tests import reset_db, create_organization, create_dataset
+
+
+def _add_error_codes(values):
+    for value in values:
+        model.Session.add(model.TaskStatus(
+            entity_id=unicode(uuid.uuid4()), entity_type='resource',
+            task_type='archiver', key='error_code', value=value,
+            last_updated=datetime.datetime.now()))
+    model.Session.commit()
+
+
+class TestBrokenLinkFilter(object):
+    def setup(self):
+        reset_db()
+
+    def test_filter(self):
+        _add_error_codes(['404', '500', '600', '511', '200', '399', '601',
+                          '4xx', '5ab', '40', '4000', ''])
+        q = model.Session.query(model.TaskStatus.value) \
+                 .filter(reports.broken_link_filter())
+        assert_equal(sorted(value for value, in q), ['404', '500', '600'])
+
+    def test_other_keys(self):
+        model.Session.add(model.TaskStatus(
+            entity_id=u'resource', entity_type='resource',
+            task_type='archiver', key='status', value='404',
+            last_updated=datetime.datetime.now()))
+        model.Session.commit()
+        assert_equal(model.Session.query(model.TaskStatus)
+                     .filter(reports.broken_link_filter()).count(), 0)
+
+
+class TestBrokenLinksIndex(object):
+    def setup(self):
+        if model.meta.engine.dialect.name != 'postgresql':
+            raise SkipTest('The query plan is checked on PostgreSQL')
+        reset_db()
+
+    def test_index_is_valid(self):
+        valid = model.Session.execute('''
+            SELECT pg_index.indisvalid FROM pg_index
+            JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+            WHERE pg_class.relname = :name
+            ''', {'name': report_model.BROKEN_LINKS_INDEX}).scalar()
+        assert_equal(valid, True)
+
+    def test_query_can_use_the_index(self):
+        # i.e. the index's condition matches the report's filter
+        _add_error_codes(['404', '500'] * 5 + ['200'] * 200)
+        q = model.Session.query(model.TaskStatus.entity_id) \
+                 .filter(reports.broken_link_filter())
+        compiled = q.statement.compile(dialect=model.meta.engine.dialect)
+        conn = model.Session.connection()
+        conn.execute('ANALYZE task_status')
+        conn.execute('SET LOCAL enable_seqscan = off')
+        plan = '\n'.join(row[0] for row in conn.execute(
+            'EXPLAIN ' + unicode(compiled), compiled.params))
+        model.Session.rollback()
+        assert report_model.BROKEN_LINKS_INDEX in plan, plan
+
+
+class TestTaglessReport(object):
+    def setup(self):
+        reset_db()
+        self.organization = create_organization('test-org')
+        create_dataset('two-tags', self.organization, tags=['a', 'b'])
+        create_dataset('one-tag', self.organization, tags=['a'])
+        create_dataset('tagless', self.organization)
+        create_dataset('other-tagless', create_organization('other-org'))
+
+    def test_organization(self):
+        data = reports.tagless_report('test-org')
+        assert_equal(data['num_packages'], 3)
+        assert_equal(data['num_tagless_packages'], 1)
+        assert_equal(data['average_tags_per_package'], 1.0)
+        assert_equal(data['packages_without_tags_percent'],
+                     lib.percent(1, 3))
+        assert_equal([row['name'] for row in data['table']], ['tagless'])
+
+    def test_all_organizations(self):
+        data = reports.tagless_report(None)
+        assert_equal(data['num_packages'], 4)
+        assert_equal(data['num_tagless_packages'], 2)
+        assert_equal(data['average_tags_per_package'], 0.8)
+        assert_equal([row['name'] for row in data['table']],
+                     ['other-tagless', 'tagless'])
+
+    def test_sub_organizations(self):
+        create_dataset('child-tagless',
+                       create_organization('child-org', self.organization))
+        data = reports.tagless_report('test-org',
+                                      include_sub_organizations=True)
+        assert_equal(data['num_packages'], 4)
+        assert_equal(data['num_tagless_packages'], 2)
+
+    def test_no_packages(self):
+        create_organization('empty-org')
+        data = reports.tagless_report('empty-org')
+        assert_equal(data['num_packages'], 0)
+        assert_equal(data['num_tagless_packages'], 0)
+        assert_equal(data['average_tags_per_package'], None)
+        assert_equal(data['table'], [])
+
+    def test_sample_size(self):
+        with mock.patch.object(reports, 'TAGLESS_SAMPLE_SIZE', 1):
+            data = reports.tagless_report(None)
+        assert_equal(data['num_tagless_packages'], 2)
+        assert_equal([row['name'] for row in data['table']],
+                     ['other-tagless'])
+
+
+def _add_task_status(resource, key, value):
+    model.Session.add(model.TaskStatus(
+        entity_id=resource.id, entity_type='resource', task_type='archiver',
+        key=key, value=value, last_updated=datetime.datetime.now()))
+
+
+class TestBrokenLinkReportBulk(object):
+    def setup(self):
+        reset_db()
+        for name in ('org-a', 'org-b', 'org-c'):
+            organization = create_organization(name)
+            for i in range(2):
+                create_dataset('%s-%s' % (name, i), organization,
+                               num_resources=2)
+        resources = dict(
+            (resource.url.split('/', 3)[-1], resource)
+            for resource in model.Session.query(model.Resource))
+        _add_task_status(resources['org-a-0/0'], 'error_code', '404')
+        _add_task_status(resources['org-a-0/0'], 'openness_score_reason',
+                         'Not found')
+        _add_task_status(resources['org-a-0/0'],
+                         'openness_score_failure_count', '3')
+        _add_task_status(resources['org-a-1/1'], 'error_code', '500')
+        _add_task_status(resources['org-b-0/1'], 'error_code', '404')
+        # not broken
+        _add_task_status(resources['org-c-0/0'], 'error_code', '200')
+        model.Session.commit()
+
+    def test_same_as_each_report(self):
+        results = list(reports.broken_link_report_bulk())
+        assert_equal([option_dict['organization']
+                      for option_dict, data in results],
+                     [None, 'org-a', 'org-b'])
+        for option_dict, data in results:
+            assert_equal(json.loads(json.dumps(data)),
+                         json.loads(json.dumps(
+                             reports.broken_link_report(**option_dict))))
+
+    def test_organization(self):
+        data = reports.broken_link_report('org-a')[0]
+        assert_equal(data['num_broken_packages'], 2)
+        assert_equal(data['num_broken_resources'], 2)
+        assert_equal(data['num_packages'], 2)
+        assert_equal(data['num_resources'], 4)
+        rows = dict((row['resource_url'].split('/', 3)[-1], row)
+                    for row in data['table'])
+        assert_equal(sorted(rows), ['org-a-0/0', 'org-a-1/1'])
+        assert_equal(rows['org-a-0/0']['reason'], 'Not found')
+        assert_equal(rows['org-a-0/0']['failure_count'], '3')
+        # it has no reason or failure count TaskStatus
+        assert_equal(rows['org-a-1/1']['reason'], None)
+        assert_equal(rows['org-a-1/1']['failure_count'], None)
+
+    def test_summary_is_the_same_as_the_index(self):
+        results = list(reports.broken_link_report_bulk())
+        assert_equal(
+            json.loads(json.dumps(reports.broken_link_summary(results[1:]))),
+            json.loads(json.dumps(results[0][1])))
+
+
+class TestBrokenLinkReportQueries(object):
+    def setup(self):
+        reset_db()
+
+    def _break_resources(self, organization_name, num_resources):
+        organization = create_organization(organization_name)
+        dataset = create_dataset('%s-dataset' % organization_name,
+                                 organization, num_resources=num_resources)
+        for resource in dataset.resources:
+            _add_task_status(resource, 'error_code', '404')
+            _add_task_status(resource, 'openness_score_reason', 'Not found')
+            _add_task_status(resource, 'openness_score_failure_count', '1')
+        model.Session.commit()
+
+    def _num_queries(self, organization):
+        with stats.measure() as measurement:
+            data = reports.broken_link_report(organization)
+        return measurement.num_queries, data[0]['num_broken_resources']
+
+    def test_queries_do_not_grow_with_broken_resources(self):
+        self._break_resources('small-org', 1)
+        self._break_resources('large-org', 20)
+        assert_equal(self._num_queries('small-org')[1], 1)
+        assert_equal(self._num_queries('large-org')[1], 20)
+        num_queries = self._num_queries('small-org')[0]
+        assert num_queries
+        assert_equal(self._num_queries('large-org')[0], num_queries)
+
+    def test_bulk_queries_do_not_grow_with_organizations(self):
+        self._break_resources('org-1', 2)
+        with stats.measure() as one_organization:
+            list(reports.broken_link_report_bulk())
+        for i in range(2, 6):
+            self._break_resources('org-%s' % i, 2)
+        with stats.measure() as five_organizations:
+            results = list(reports.broken_link_report_bulk())
+        assert_equal(len(results), 6)
+        assert one_organization.num_queries
+        assert_equal(five_organizations.num_queries,
+                     one_organization.num_queries)
@@ -0,0 +1,28 @@
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.report import lock, stats
+
+
+class TestMeasure(object):
+    def test_counts_queries(self):
+        with stats.measure() as measurement:
+            model.Session.execute('SELECT 1')
+            model.Session.execute('SELECT 2')
+        assert_equal(measurement.num_queries, 2)
+        assert measurement.wall_time >= 0
+        assert measurement.cpu_time >= 0
+
+    def test_not_counted(self):
+        with stats.measure() as measurement:
+            with stats.not_counted():
+                model.Session.execute('SELECT 1')
+            model.Session.execute('SELECT 2')
+        assert_equal(measurement.num_queries, 1)
+
+    def test_locks_are_not_counted(self):
+        with stats.measure() as measurement:
+            with lock.try_lock(u'test-report?a=1') as locked:
+                assert locked
+                model.Session.execute('SELECT 1')
+        assert_equal(measurement.num_queries, 1)
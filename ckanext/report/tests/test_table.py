@@ -0,0 +1,98 @@
+import datetime
+
+from nose.tools import assert_equal
+
+from ckanext.report import table
+
+
+def _data():
+    return {'num_packages': 3,
+            'table': [{'name': u'b', 'count': 2},
+                      {'name': u'C', 'count': 1},
+                      {'name': u'a', 'count': 3}],
+            'order': {'name': 0, 'count': 1}}
+
+
+class TestToColumnar(object):
+    def test_columns_and_rows(self):
+        data = _data()
+        columnar = table.to_columnar(data)
+        assert_equal(columnar['columns'], ['name', 'count'])
+        assert_equal(columnar['table'], [[u'b', 2], [u'C', 1], [u'a', 3]])
+        assert_equal(columnar['num_packages'], 3)
+        # the data passed in is not altered
+        assert_equal(data, _data())
+
+    def test_no_sort_index_is_stored(self):
+        assert 'sort_index' not in table.to_columnar(_data())
+
+    def test_list_of_records(self):
+        columnar = table.to_columnar([_data(), {'other': 1}])
+        assert_equal(columnar[0]['columns'], ['name', 'count'])
+        assert_equal(columnar[1], {'other': 1})
+
+    def test_rows_missing_columns_are_left_as_dicts(self):
+        data = {'table': [{'name': u'a', 'count': 1}, {'name': u'b'}],
+                'order': {'name': 0, 'count': 1}}
+        assert_equal(table.to_columnar(data), data)
+        assert_equal(table.columns_and_rows(data),
+                     (['name', 'count'],
+                      [[u'a', 1], [u'b', table.MISSING]]))
+
+    def test_round_trip(self):
+        record = table.from_columnar(table.to_columnar(_data()))
+        rows = list(record['table'])
+        assert_equal([row['name'] for row in rows], [u'b', u'C', u'a'])
+        assert_equal(rows[0].count, 2)
+        assert_equal(rows[0].as_dict(), {'name': u'b', 'count': 2})
+        assert 'name' in rows[0]
+        assert_equal(rows[0].get('missing', 'default'), 'default')
+
+
+class TestPage(object):
+    def _table(self):
+        return table.from_columnar(table.to_columnar(_data()))['table']
+
+    def test_page(self):
+        page, total = self._table().page(page=2, per_page=2)
+        assert_equal(total, 3)
+        assert_equal([row.name for row in page], [u'a'])
+
+    def test_sort(self):
+        page, total = self._table().page(sort='name')
+        # case-insensitive
+        assert_equal([row.name for row in page], [u'a', u'b', u'C'])
+        page, total = self._table().page(sort='count', descending=True,
+                                         per_page=2)
+        assert_equal([row.name for row in page], [u'a', u'b'])
+
+    def test_sort_unknown_column(self):
+        page, total = self._table().page(sort='nonsense', descending=True)
+        assert_equal([row.name for row in page], [u'b', u'C', u'a'])
+
+    def test_filter(self):
+        page, total = self._table().page(q='c', sort='name')
+        assert_equal(total, 1)
+        assert_equal([row.name for row in page], [u'C'])
+
+    def test_sort_order_is_kept_with_the_data(self):
+        # e.g. the decoded report in the memory cache
+        cached = table.to_columnar(_data())
+        table.from_columnar(cached)['table'].page(sort='count')
+        assert_equal(cached['sort_index'], {'count': [1, 0, 2]})
+        # the next request uses it
+        cached['sort_index']['count'] = [2, 1, 0]
+        page, total = table.from_columnar(cached)['table'].page(sort='count')
+        assert_equal([row.name for row in page], [u'a', u'C', u'b'])
+
+    def test_none_and_dates(self):
+        rows = [[datetime.datetime(2015, 1, 2)], [datetime.datetime(2014, 1, 1)]]
+        page, total = table.Table(['date'], rows).page(sort='date')
+        assert_equal([row.date.year for row in page], [2014, 2015])
+
+
+class TestNumRows(object):
+    def test_num_rows(self):
+        assert_equal(table.num_rows(_data()), 3)
+        assert_equal(table.num_rows([_data(), _data(), {'x': 1}]), 6)
+        assert_equal(table.num_rows(None), 0)